@@ -3,6 +3,7 @@ import torch
 import utils.constants as const
 
 DEVICE = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+BATCH_CHUNK_SIZE = 8  # default number of frames per forward pass for the batched annotator entry points
 models_path = f'{const.CWD}/pretrained_models'
 
 clip_vision_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'clip_vision')
@@ -12,8 +12,8 @@ import numpy as np
 
 from einops import rearrange
 import os
-from annotator.annotator_path import models_path, DEVICE
-from annotator.util import safe_step, nms
+from annotator.annotator_path import models_path, DEVICE, BATCH_CHUNK_SIZE
+from annotator.util import safe_step, nms, frame_batches
 
 
 class DoubleConvBlock(torch.nn.Module):
@@ -61,7 +61,7 @@ modeldir = os.path.join(models_path, "hed")
 old_modeldir = os.path.dirname(os.path.realpath(__file__))
 
 
-def apply_hed(input_image, is_safe=False):
+def load_hed_model():
     global netNetwork
     if netNetwork is None:
         modelpath = os.path.join(modeldir, "ControlNetHED.pth")
@@ -73,25 +73,38 @@ def apply_hed(input_image, is_safe=False):
             load_file_from_url(remote_model_path, model_dir=modeldir)
         netNetwork = ControlNetHED_Apache2().to(DEVICE)
         netNetwork.load_state_dict(torch.load(modelpath, map_location='cpu'))
-    netNetwork.to(DEVICE).float().eval()
 
+
+def apply_hed(input_image, is_safe=False):
     assert input_image.ndim == 3
-    H, W, C = input_image.shape
+    return apply_hed_batch(input_image[None], is_safe=is_safe)[0]
+
+
+def apply_hed_batch(input_images, is_safe=False, chunk_size=BATCH_CHUNK_SIZE):
+    """
+    Runs HED on an N x H x W x C uint8 array (or a list of frames) with one forward pass per chunk
+    and returns the N x H x W edge maps.
+    """
+    load_hed_model()
+    netNetwork.to(DEVICE).float().eval()
+
+    results = []
     with torch.no_grad():
-        image_hed = torch.from_numpy(input_image.copy()).float().to(DEVICE)
-        image_hed = rearrange(image_hed, 'h w c -> 1 c h w')
-        edges = netNetwork(image_hed)
-        edges = [e.detach().cpu().numpy().astype(np.float32)[0, 0] for e in edges]
-        edges = [cv2.resize(e, (W, H), interpolation=cv2.INTER_LINEAR) for e in edges]
-        edges = np.stack(edges, axis=2)
-        edge = 1 / (1 + np.exp(-np.mean(edges, axis=2).astype(np.float64)))
-        if is_safe:
-            edge = safe_step(edge)
-        edge = (edge * 255.0).clip(0, 255).astype(np.uint8)
-        return edge
+        for chunk in frame_batches(input_images, chunk_size):
+            _, H, W, C = chunk.shape
+            image_hed = torch.from_numpy(chunk.copy()).float().to(DEVICE)
+            image_hed = rearrange(image_hed, 'b h w c -> b c h w')
+            projections = [e.detach().cpu().numpy().astype(np.float32)[:, 0] for e in netNetwork(image_hed)]
+            for i in range(chunk.shape[0]):
+                edges = [cv2.resize(e[i], (W, H), interpolation=cv2.INTER_LINEAR) for e in projections]
+                edges = np.stack(edges, axis=2)
+                edge = 1 / (1 + np.exp(-np.mean(edges, axis=2).astype(np.float64)))
+                if is_safe:
+                    edge = safe_step(edge)
+                results.append((edge * 255.0).clip(0, 255).astype(np.uint8))
+    return np.stack(results, axis=0)
 
     
 def unload_hed_model():
     global netNetwork
-    if netNetwork is not None:
-        netNetwork.cpu()
+    netNetwork = None
@@ -23,16 +23,8 @@ remote_model_path_pix2pix = "https://huggingface.co/lllyasviel/Annotators/resolv
 model = None
 pix2pixmodel = None
 
-def unload_leres_model():
-    global model, pix2pixmodel
-    if model is not None:
-        model = model.cpu()
-    if pix2pixmodel is not None:
-        pix2pixmodel = pix2pixmodel.unload_network('G')
-
-
-def apply_leres(input_image, thr_a, thr_b, boost=False):
-    global model, pix2pixmodel
+def load_leres_model():
+    global model
     if model is None:
         model_path = os.path.join(base_model_path, "res101.pth")
         old_model_path = os.path.join(old_modeldir, "res101.pth")
@@ -52,6 +44,16 @@ def apply_leres(input_image, thr_a, thr_b, boost=False):
         model.load_state_dict(strip_prefix_if_present(checkpoint['depth_model'], "module."), strict=True)
         del checkpoint
 
+def unload_leres_model():
+    global model, pix2pixmodel
+    model = None
+    pix2pixmodel = None
+
+
+def apply_leres(input_image, thr_a, thr_b, boost=False):
+    global model, pix2pixmodel
+    load_leres_model()
+
     if boost and pix2pixmodel is None:
         pix2pixmodel_path = os.path.join(base_model_path, "latest_net_G.pth")
         if not os.path.exists(pix2pixmodel_path):
@@ -5,6 +5,8 @@ from basicsr.utils.download_util import load_file_from_url
 import torch.nn as nn
 from einops import rearrange
 import utils.constants as const
+from annotator.annotator_path import BATCH_CHUNK_SIZE
+from annotator.util import frame_batches
 
 DEVICE = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 models_path = f'{const.CWD}/pretrained_models'
@@ -114,19 +116,26 @@ class LineartDetector:
             self.model.cpu()
 
     def __call__(self, input_image):
+        assert input_image.ndim == 3
+        return self.batch(input_image[None])[0]
+
+    def batch(self, input_images, chunk_size=BATCH_CHUNK_SIZE):
+        """
+        Runs the detector on an N x H x W x C uint8 array (or a list of frames) with one forward pass per chunk
+        and returns the N x H x W line maps.
+        """
         if self.model is None:
             self.load_model(self.model_name)
         self.model.to(self.device)
 
-        assert input_image.ndim == 3
-        image = input_image
+        lines = []
         with torch.no_grad():
-            image = torch.from_numpy(image).float().to(self.device)
-            image = image / 255.0
-            image = rearrange(image, 'h w c -> 1 c h w')
-            line = self.model(image)[0][0]
-
-            line = line.cpu().numpy()
-            line = (line * 255.0).clip(0, 255).astype(np.uint8)
-
-            return line
\ No newline at end of file
+            for chunk in frame_batches(input_images, chunk_size):
+                image = torch.from_numpy(chunk).float().to(self.device)
+                image = image / 255.0
+                image = rearrange(image, 'b h w c -> b c h w')
+                line = self.model(image)[:, 0]
+
+                line = line.cpu().numpy()
+                lines.append((line * 255.0).clip(0, 255).astype(np.uint8))
+        return np.concatenate(lines, axis=0)
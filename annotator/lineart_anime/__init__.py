@@ -6,7 +6,8 @@ import functools
 import os
 import cv2
 from einops import rearrange
-from annotator.annotator_path import models_path, DEVICE
+from annotator.annotator_path import models_path, DEVICE, BATCH_CHUNK_SIZE
+from annotator.util import frame_batches
 
 
 class UnetGenerator(nn.Module):
@@ -138,23 +139,32 @@ class LineartAnimeDetector:
             self.model.cpu()
 
     def __call__(self, input_image):
+        return self.batch(input_image[None])[0]
+
+    def batch(self, input_images, chunk_size=BATCH_CHUNK_SIZE):
+        """
+        Runs the detector on an N x H x W x C uint8 array (or a list of frames) with one forward pass per chunk
+        and returns the N x H x W line maps.
+        """
         if self.model is None:
             self.load_model()
         self.model.to(self.device)
 
-        H, W, C = input_image.shape
-        Hn = 256 * int(np.ceil(float(H) / 256.0))
-        Wn = 256 * int(np.ceil(float(W) / 256.0))
-        img = cv2.resize(input_image, (Wn, Hn), interpolation=cv2.INTER_CUBIC)
+        lines = []
         with torch.no_grad():
-            image_feed = torch.from_numpy(img).float().to(self.device)
-            image_feed = image_feed / 127.5 - 1.0
-            image_feed = rearrange(image_feed, 'h w c -> 1 c h w')
-
-            line = self.model(image_feed)[0, 0] * 127.5 + 127.5
-            line = line.cpu().numpy()
-
-            line = cv2.resize(line, (W, H), interpolation=cv2.INTER_CUBIC)
-            line = line.clip(0, 255).astype(np.uint8)
-            return line
-
+            for chunk in frame_batches(input_images, chunk_size):
+                _, H, W, C = chunk.shape
+                Hn = 256 * int(np.ceil(float(H) / 256.0))
+                Wn = 256 * int(np.ceil(float(W) / 256.0))
+                img = np.stack([cv2.resize(frame, (Wn, Hn), interpolation=cv2.INTER_CUBIC) for frame in chunk], axis=0)
+                image_feed = torch.from_numpy(img).float().to(self.device)
+                image_feed = image_feed / 127.5 - 1.0
+                image_feed = rearrange(image_feed, 'b h w c -> b c h w')
+
+                line = self.model(image_feed)[:, 0] * 127.5 + 127.5
+                line = line.cpu().numpy()
+
+                for frame_line in line:
+                    frame_line = cv2.resize(frame_line, (W, H), interpolation=cv2.INTER_CUBIC)
+                    lines.append(frame_line.clip(0, 255).astype(np.uint8))
+        return np.stack(lines, axis=0)
@@ -6,7 +6,8 @@ import cv2
 import numpy as np
 from einops import rearrange
 
-from annotator.annotator_path import models_path, DEVICE
+from annotator.annotator_path import models_path, DEVICE, BATCH_CHUNK_SIZE
+from annotator.util import frame_batches
 
 
 class _bn_relu_conv(nn.Module):
@@ -229,16 +230,25 @@ class MangaLineExtration:
             self.model.cpu()
 
     def __call__(self, input_image):
+        return self.batch(input_image[None])[0]
+
+    def batch(self, input_images, chunk_size=BATCH_CHUNK_SIZE):
+        """
+        Runs the extractor on an N x H x W x C uint8 array (or a list of frames) with one forward pass per chunk
+        and returns the N x H x W line maps.
+        """
         if self.model is None:
             self.load_model()
         self.model.to(self.device)
-        img = cv2.cvtColor(input_image, cv2.COLOR_RGB2GRAY)
-        img = np.ascontiguousarray(img.copy()).copy()
-        with torch.no_grad():
-            image_feed = torch.from_numpy(img).float().to(self.device)
-            image_feed = rearrange(image_feed, 'h w -> 1 1 h w')
-            line = self.model(image_feed)
-            line = 255 - line.cpu().numpy()[0, 0]
-            return line.clip(0, 255).astype(np.uint8)
 
-    
+        lines = []
+        with torch.no_grad():
+            for chunk in frame_batches(input_images, chunk_size):
+                img = np.stack([cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY) for frame in chunk], axis=0)
+                img = np.ascontiguousarray(img.copy()).copy()
+                image_feed = torch.from_numpy(img).float().to(self.device)
+                image_feed = rearrange(image_feed, 'b h w -> b 1 h w')
+                line = self.model(image_feed)
+                line = 255 - line.cpu().numpy()[:, 0]
+                lines.append(line.clip(0, 255).astype(np.uint8))
+        return np.concatenate(lines, axis=0)
@@ -4,46 +4,59 @@ import torch
 
 from einops import rearrange
 from .api import MiDaSInference
-from annotator.annotator_path import DEVICE
+from annotator.annotator_path import DEVICE, BATCH_CHUNK_SIZE
+from annotator.util import frame_batches
 
 model = None
 
+def load_midas_model():
+    global model
+    if model is None:
+        model = MiDaSInference(model_type="dpt_hybrid")
+
 def unload_midas_model():
     global model
-    if model is not None:
-        model = model.cpu()
+    model = None
 
 def apply_midas(input_image, a=np.pi * 2.0, bg_th=0.1):
+    assert input_image.ndim == 3
+    depth_images, normal_images = apply_midas_batch(input_image[None], a, bg_th)
+    return depth_images[0], normal_images[0]
+
+
+def apply_midas_batch(input_images, a=np.pi * 2.0, bg_th=0.1, chunk_size=BATCH_CHUNK_SIZE):
+    """
+    Runs MiDaS on an N x H x W x C uint8 array (or a list of frames) with one forward pass per chunk
+    and returns the N x H x W depth maps and N x H x W x 3 normal maps.
+    """
     global model
-    if model is None:
-        model = MiDaSInference(model_type="dpt_hybrid")
+    load_midas_model()
     if DEVICE.type != 'mps':
         model = model.to(DEVICE)
-    
-    assert input_image.ndim == 3
-    image_depth = input_image
+
+    depth_images, normal_images = [], []
     with torch.no_grad():
-        image_depth = torch.from_numpy(image_depth).float()
-        if DEVICE.type != 'mps':
-            image_depth = image_depth.to(DEVICE)
-        image_depth = image_depth / 127.5 - 1.0
-        image_depth = rearrange(image_depth, 'h w c -> 1 c h w')
-        depth = model(image_depth)[0]
-
-        depth_pt = depth.clone()
-        depth_pt -= torch.min(depth_pt)
-        depth_pt /= torch.max(depth_pt)
-        depth_pt = depth_pt.cpu().numpy()
-        depth_image = (depth_pt * 255.0).clip(0, 255).astype(np.uint8)
-
-        depth_np = depth.cpu().numpy()
-        x = cv2.Sobel(depth_np, cv2.CV_32F, 1, 0, ksize=3)
-        y = cv2.Sobel(depth_np, cv2.CV_32F, 0, 1, ksize=3)
-        z = np.ones_like(x) * a
-        x[depth_pt < bg_th] = 0
-        y[depth_pt < bg_th] = 0
-        normal = np.stack([x, y, z], axis=2)
-        normal /= np.sum(normal ** 2.0, axis=2, keepdims=True) ** 0.5
-        normal_image = (normal * 127.5 + 127.5).clip(0, 255).astype(np.uint8)[:, :, ::-1]
-
-        return depth_image, normal_image
+        for chunk in frame_batches(input_images, chunk_size):
+            image_depth = torch.from_numpy(chunk).float()
+            if DEVICE.type != 'mps':
+                image_depth = image_depth.to(DEVICE)
+            image_depth = image_depth / 127.5 - 1.0
+            image_depth = rearrange(image_depth, 'b h w c -> b c h w')
+            for depth in model(image_depth):
+                depth_pt = depth.clone()
+                depth_pt -= torch.min(depth_pt)
+                depth_pt /= torch.max(depth_pt)
+                depth_pt = depth_pt.cpu().numpy()
+                depth_images.append((depth_pt * 255.0).clip(0, 255).astype(np.uint8))
+
+                depth_np = depth.cpu().numpy()
+                x = cv2.Sobel(depth_np, cv2.CV_32F, 1, 0, ksize=3)
+                y = cv2.Sobel(depth_np, cv2.CV_32F, 0, 1, ksize=3)
+                z = np.ones_like(x) * a
+                x[depth_pt < bg_th] = 0
+                y[depth_pt < bg_th] = 0
+                normal = np.stack([x, y, z], axis=2)
+                normal /= np.sum(normal ** 2.0, axis=2, keepdims=True) ** 0.5
+                normal_images.append((normal * 127.5 + 127.5).clip(0, 255).astype(np.uint8)[:, :, ::-1])
+
+    return np.stack(depth_images, axis=0), np.stack(normal_images, axis=0)
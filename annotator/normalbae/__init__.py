@@ -7,6 +7,8 @@ from einops import rearrange
 from .models.NNET import NNET
 from modules import devices
 from annotator.annotator_path import models_path
+from annotator.annotator_path import BATCH_CHUNK_SIZE
+from annotator.util import frame_batches
 import torchvision.transforms as transforms
 
 
@@ -56,26 +58,34 @@ class NormalBaeDetector:
             self.model.cpu()
 
     def __call__(self, input_image):
+        assert input_image.ndim == 3
+        return self.batch(input_image[None])[0]
+
+    def batch(self, input_images, chunk_size=BATCH_CHUNK_SIZE):
+        """
+        Runs the estimator on an N x H x W x C uint8 array (or a list of frames) with one forward pass per chunk
+        and returns the N x H x W x 3 normal maps.
+        """
         if self.model is None:
             self.load_model()
 
         self.model.to(self.device)
-        assert input_image.ndim == 3
-        image_normal = input_image
+        normal_images = []
         with torch.no_grad():
-            image_normal = torch.from_numpy(image_normal).float().to(self.device)
-            image_normal = image_normal / 255.0
-            image_normal = rearrange(image_normal, 'h w c -> 1 c h w')
-            image_normal = self.norm(image_normal)
-
-            normal = self.model(image_normal)
-            normal = normal[0][-1][:, :3]
-            # d = torch.sum(normal ** 2.0, dim=1, keepdim=True) ** 0.5
-            # d = torch.maximum(d, torch.ones_like(d) * 1e-5)
-            # normal /= d
-            normal = ((normal + 1) * 0.5).clip(0, 1)
-
-            normal = rearrange(normal[0], 'c h w -> h w c').cpu().numpy()
-            normal_image = (normal * 255.0).clip(0, 255).astype(np.uint8)
-
-            return normal_image
+            for chunk in frame_batches(input_images, chunk_size):
+                image_normal = torch.from_numpy(chunk).float().to(self.device)
+                image_normal = image_normal / 255.0
+                image_normal = rearrange(image_normal, 'b h w c -> b c h w')
+                image_normal = self.norm(image_normal)
+
+                normal = self.model(image_normal)
+                normal = normal[0][-1][:, :3]
+                # d = torch.sum(normal ** 2.0, dim=1, keepdim=True) ** 0.5
+                # d = torch.maximum(d, torch.ones_like(d) * 1e-5)
+                # normal /= d
+                normal = ((normal + 1) * 0.5).clip(0, 1)
+
+                normal = rearrange(normal, 'b c h w -> b h w c').cpu().numpy()
+                normal_images.append((normal * 255.0).clip(0, 255).astype(np.uint8))
+
+        return np.concatenate(normal_images, axis=0)
@@ -19,7 +19,8 @@ from .body import Body, BodyResult, Keypoint
 from .hand import Hand
 from .face import Face
 from .types import PoseResult, HandResult, FaceResult
-from annotator.annotator_path import models_path
+from annotator.annotator_path import models_path, BATCH_CHUNK_SIZE
+from annotator.util import frame_batches
 
 from typing import Tuple, List, Callable, Union, Optional
 
@@ -157,16 +158,19 @@ class OpenposeDetector:
 
     Attributes:
         model_dir (str): Path to the directory where the pose models are stored.
+        peaks_on_device (bool): Whether the body estimator finds its peaks on the model's device (see Body).
     """
     model_dir = os.path.join(models_path, "openpose")
 
-    def __init__(self):
+    def __init__(self, peaks_on_device=False):
         self.device = 'cuda'
+        self.peaks_on_device = peaks_on_device
         self.body_estimation = None
         self.hand_estimation = None
         self.face_estimation = None
 
         self.dw_pose_estimation = None
+        self.tracking_stats = None
 
     def load_model(self):
         """
@@ -188,7 +192,7 @@ class OpenposeDetector:
             from basicsr.utils.download_util import load_file_from_url
             load_file_from_url(face_model_path, model_dir=self.model_dir)
 
-        self.body_estimation = Body(body_modelpath)
+        self.body_estimation = Body(body_modelpath, peaks_on_device=self.peaks_on_device)
         self.hand_estimation = Hand(hand_modelpath)
         self.face_estimation = Face(face_modelpath)
     
@@ -257,6 +261,48 @@ class OpenposeDetector:
         
         return None
 
+    @staticmethod
+    def crop_peaks_to_keypoints(peaks, x, y, H, W) -> Union[List[Keypoint], None]:
+        # crop pixel peaks to normalized image keypoints, (0, 0) peaks are missing parts
+        peaks = peaks.astype(np.float32)
+        if peaks.ndim == 2 and peaks.shape[1] == 2:
+            peaks[:, 0] = np.where(peaks[:, 0] < 1e-6, -1, peaks[:, 0] + x) / float(W)
+            peaks[:, 1] = np.where(peaks[:, 1] < 1e-6, -1, peaks[:, 1] + y) / float(H)
+            return [
+                Keypoint(x=peak[0], y=peak[1])
+                for peak in peaks
+            ]
+        return None
+
+    def detect_hands_batch(self, bodies: List[BodyResult], oriImg) -> List[Tuple[Union[HandResult, None], Union[HandResult, None]]]:
+        """
+        detect_hands of all bodies at once, the hand crops of every body go through Hand.batch together.
+        Returns a (left_hand, right_hand) pair per body.
+        """
+        H, W, _ = oriImg.shape
+        crops = [(i, x, y, w, is_left) for i, body in enumerate(bodies) for x, y, w, is_left in util.handDetect(body, oriImg)]
+        all_peaks = self.hand_estimation.batch([oriImg[y:y+w, x:x+w, :] for _, x, y, w, _ in crops])
+
+        hands = [[None, None] for _ in bodies]
+        for (i, x, y, w, is_left), peaks in zip(crops, all_peaks):
+            hand_result = self.crop_peaks_to_keypoints(peaks, x, y, H, W)
+            if hand_result is not None:
+                hands[i][0 if is_left else 1] = hand_result
+        return [tuple(hand) for hand in hands]
+
+    def detect_faces_batch(self, bodies: List[BodyResult], oriImg) -> List[Union[FaceResult, None]]:
+        """
+        detect_face of all bodies at once, the face crops go through Face.batch_peaks together.
+        """
+        H, W, _ = oriImg.shape
+        crops = [(i, face) for i, face in enumerate(util.faceDetect(body, oriImg) for body in bodies) if face is not None]
+        all_peaks = self.face_estimation.batch_peaks([oriImg[y:y+w, x:x+w, :] for _, (x, y, w) in crops])
+
+        faces = [None] * len(bodies)
+        for (i, (x, y, w)), peaks in zip(crops, all_peaks):
+            faces[i] = self.crop_peaks_to_keypoints(peaks, x, y, H, W)
+        return faces
+
     def detect_poses(self, oriImg, include_hand=False, include_face=False) -> List[PoseResult]:
         """
         Detect poses in the given image.
@@ -285,14 +331,12 @@ class OpenposeDetector:
             candidate, subset = self.body_estimation(oriImg)
             bodies = self.body_estimation.format_body_result(candidate, subset)
 
+            # the hand and face crops of all bodies run batched
+            hands = self.detect_hands_batch(bodies, oriImg) if include_hand else [(None, None)] * len(bodies)
+            faces = self.detect_faces_batch(bodies, oriImg) if include_face else [None] * len(bodies)
+
             results = []
-            for body in bodies:
-                left_hand, right_hand, face = (None,) * 3
-                if include_hand:
-                    left_hand, right_hand = self.detect_hands(body, oriImg)
-                if include_face:
-                    face = self.detect_face(body, oriImg)
-                
+            for body, (left_hand, right_hand), face in zip(bodies, hands, faces):
                 results.append(PoseResult(BodyResult(
                     keypoints=[
                         Keypoint(
@@ -320,12 +364,75 @@ class OpenposeDetector:
         """
         from .wholebody import Wholebody # DW Pose
 
-        self.load_dw_model()
+        if self.dw_pose_estimation is None:
+            self.load_dw_model()
 
         with torch.no_grad():
             keypoints_info = self.dw_pose_estimation(oriImg.copy())
             return Wholebody.format_result(keypoints_info)
 
+    def detect_poses_dw_batch(self, oriImgs) -> List[List[PoseResult]]:
+        """
+        Detect poses in a batch of frames using DW Pose, the frames go through the detector together and all person
+        crops through the pose model together.
+
+        Args:
+            oriImgs (numpy.ndarray): N x H x W x C frames (or a list of frames) for pose detection.
+
+        Returns:
+            List[List[PoseResult]]: The PoseResult objects of every frame.
+        """
+        from .wholebody import Wholebody # DW Pose
+
+        if self.dw_pose_estimation is None:
+            self.load_dw_model()
+
+        with torch.no_grad():
+            return [Wholebody.format_result(keypoints_info) for keypoints_info in self.dw_pose_estimation.batch(list(oriImgs))]
+
+    def detect_poses_dw_video(self, oriImgs, keyframe_interval=8, min_score=0.3) -> List[List[PoseResult]]:
+        """
+        Detect poses in the consecutive frames of a video using DW Pose in video mode: the person detector only runs on
+        keyframes and when tracking confidence drops, the other frames refine the previous frame's people in local
+        crops (see PoseTracker). The detected / tracked frame counts are kept in tracking_stats.
+
+        Args:
+            oriImgs (numpy.ndarray): N x H x W x C frames (or a list of frames) in video order.
+            keyframe_interval (int, optional): Frames from one keyframe to the next. Defaults to 8.
+            min_score (float, optional): Mean body keypoint score under which a tracked frame is detected again.
+                Defaults to 0.3.
+
+        Returns:
+            List[List[PoseResult]]: The PoseResult objects of every frame.
+        """
+        from .wholebody import Wholebody, PoseTracker # DW Pose
+
+        if self.dw_pose_estimation is None:
+            self.load_dw_model()
+
+        tracker = PoseTracker(self.dw_pose_estimation, keyframe_interval, min_score)
+        with torch.no_grad():
+            results = [Wholebody.format_result(tracker(oriImg.copy())) for oriImg in oriImgs]
+        self.tracking_stats = {'detected_frames': tracker.detections, 'tracked_frames': tracker.tracked,
+                               'detection_ratio': tracker.detection_ratio}
+        return results
+
+    def batch(self, oriImgs, include_body=True, include_hand=True, include_face=True, chunk_size=BATCH_CHUNK_SIZE, video=False):
+        """
+        Detect and draw DW Pose poses in an N x H x W x C uint8 array (or a list of frames), chunk_size frames per
+        forward of the detector. video runs the frames, in video order, through detect_poses_dw_video instead.
+
+        Returns:
+            numpy.ndarray: The N x H x W x 3 drawn poses.
+        """
+        _, H, W, _ = np.shape(oriImgs)
+        if video:
+            all_poses = self.detect_poses_dw_video(oriImgs)
+        else:
+            all_poses = [poses for chunk in frame_batches(oriImgs, chunk_size) for poses in self.detect_poses_dw_batch(chunk)]
+        results = [draw_poses(poses, H, W, draw_body=include_body, draw_hand=include_hand, draw_face=include_face) for poses in all_poses]
+        return np.stack(results, axis=0)
+
     def __call__(
             self, oriImg, include_body=True, include_hand=True, include_face=True, 
             use_dw_pose=False, json_pose_callback: Callable[[str], None] = None,
@@ -13,8 +13,267 @@ from . import util
 from .model import bodypose_model
 from .types import Keypoint, BodyResult
 
+# find connection in the specified sequence, center 29 is in the position 15
+limbSeq = [[2, 3], [2, 6], [3, 4], [4, 5], [6, 7], [7, 8], [2, 9], [9, 10], \
+           [10, 11], [2, 12], [12, 13], [13, 14], [2, 1], [1, 15], [15, 17], \
+           [1, 16], [16, 18], [3, 17], [6, 18]]
+# the middle joints heatmap correpondence
+mapIdx = [[31, 32], [39, 40], [33, 34], [35, 36], [41, 42], [43, 44], [19, 20], [21, 22], \
+          [23, 24], [25, 26], [27, 28], [29, 30], [47, 48], [49, 50], [53, 54], [51, 52], \
+          [55, 56], [37, 38], [45, 46]]
+
+
+def connect_limbs_loop(all_peaks, paf_avg, image_height, thre2=0.05):
+    """
+    Scores every candidate limb of every limb type along its part affinity field and greedily keeps the best
+    connections, a pair at a time. Reference implementation of connect_limbs.
+    """
+    connection_all = []
+    special_k = []
+    mid_num = 10
+
+    for k in range(len(mapIdx)):
+        score_mid = paf_avg[:, :, [x - 19 for x in mapIdx[k]]]
+        candA = all_peaks[limbSeq[k][0] - 1]
+        candB = all_peaks[limbSeq[k][1] - 1]
+        nA = len(candA)
+        nB = len(candB)
+        indexA, indexB = limbSeq[k]
+        if (nA != 0 and nB != 0):
+            connection_candidate = []
+            for i in range(nA):
+                for j in range(nB):
+                    vec = np.subtract(candB[j][:2], candA[i][:2])
+                    norm = math.sqrt(vec[0] * vec[0] + vec[1] * vec[1])
+                    norm = max(0.001, norm)
+                    vec = np.divide(vec, norm)
+
+                    startend = list(zip(np.linspace(candA[i][0], candB[j][0], num=mid_num), \
+                                        np.linspace(candA[i][1], candB[j][1], num=mid_num)))
+
+                    vec_x = np.array([score_mid[int(round(startend[I][1])), int(round(startend[I][0])), 0] \
+                                      for I in range(len(startend))])
+                    vec_y = np.array([score_mid[int(round(startend[I][1])), int(round(startend[I][0])), 1] \
+                                      for I in range(len(startend))])
+
+                    score_midpts = np.multiply(vec_x, vec[0]) + np.multiply(vec_y, vec[1])
+                    score_with_dist_prior = sum(score_midpts) / len(score_midpts) + min(
+                        0.5 * image_height / norm - 1, 0)
+                    criterion1 = len(np.nonzero(score_midpts > thre2)[0]) > 0.8 * len(score_midpts)
+                    criterion2 = score_with_dist_prior > 0
+                    if criterion1 and criterion2:
+                        connection_candidate.append(
+                            [i, j, score_with_dist_prior, score_with_dist_prior + candA[i][2] + candB[j][2]])
+
+            connection_candidate = sorted(connection_candidate, key=lambda x: x[2], reverse=True)
+            connection = np.zeros((0, 5))
+            for c in range(len(connection_candidate)):
+                i, j, s = connection_candidate[c][0:3]
+                if (i not in connection[:, 3] and j not in connection[:, 4]):
+                    connection = np.vstack([connection, [candA[i][3], candB[j][3], s, i, j]])
+                    if (len(connection) >= min(nA, nB)):
+                        break
+
+            connection_all.append(connection)
+        else:
+            special_k.append(k)
+            connection_all.append([])
+    return connection_all, special_k
+
+
+def assemble_people_loop(all_peaks, connection_all, special_k):
+    """
+    Groups the limb connections into people. Reference implementation of assemble_people.
+    """
+    # last number in each row is the total parts number of that person
+    # the second last number in each row is the score of the overall configuration
+    subset = -1 * np.ones((0, 20))
+    candidate = np.array([item for sublist in all_peaks for item in sublist])
+
+    for k in range(len(mapIdx)):
+        if k not in special_k:
+            partAs = connection_all[k][:, 0]
+            partBs = connection_all[k][:, 1]
+            indexA, indexB = np.array(limbSeq[k]) - 1
+
+            for i in range(len(connection_all[k])):  # = 1:size(temp,1)
+                found = 0
+                subset_idx = [-1, -1]
+                for j in range(len(subset)):  # 1:size(subset,1):
+                    if subset[j][indexA] == partAs[i] or subset[j][indexB] == partBs[i]:
+                        subset_idx[found] = j
+                        found += 1
+
+                if found == 1:
+                    j = subset_idx[0]
+                    if subset[j][indexB] != partBs[i]:
+                        subset[j][indexB] = partBs[i]
+                        subset[j][-1] += 1
+                        subset[j][-2] += candidate[partBs[i].astype(int), 2] + connection_all[k][i][2]
+                elif found == 2:  # if found 2 and disjoint, merge them
+                    j1, j2 = subset_idx
+                    membership = ((subset[j1] >= 0).astype(int) + (subset[j2] >= 0).astype(int))[:-2]
+                    if len(np.nonzero(membership == 2)[0]) == 0:  # merge
+                        subset[j1][:-2] += (subset[j2][:-2] + 1)
+                        subset[j1][-2:] += subset[j2][-2:]
+                        subset[j1][-2] += connection_all[k][i][2]
+                        subset = np.delete(subset, j2, 0)
+                    else:  # as like found == 1
+                        subset[j1][indexB] = partBs[i]
+                        subset[j1][-1] += 1
+                        subset[j1][-2] += candidate[partBs[i].astype(int), 2] + connection_all[k][i][2]
+
+                # if find no partA in the subset, create a new subset
+                elif not found and k < 17:
+                    row = -1 * np.ones(20)
+                    row[indexA] = partAs[i]
+                    row[indexB] = partBs[i]
+                    row[-1] = 2
+                    row[-2] = sum(candidate[connection_all[k][i, :2].astype(int), 2]) + connection_all[k][i][2]
+                    subset = np.vstack([subset, row])
+    # delete some rows of subset which has few parts occur
+    deleteIdx = []
+    for i in range(len(subset)):
+        if subset[i][-1] < 4 or subset[i][-2] / subset[i][-1] < 0.4:
+            deleteIdx.append(i)
+    subset = np.delete(subset, deleteIdx, axis=0)
+    return candidate, subset
+
+
+def connect_limbs(all_peaks, paf_avg, image_height, thre2=0.05, mid_num=10):
+    """
+    Vectorized connect_limbs_loop: the mid_num sample points of all candidate pairs of a limb type are read from the
+    part affinity field with one fancy index. Every operation of the loop is kept elementwise and in order (linspace,
+    round half to even, the sequential sum) so the connections are bit-identical.
+    """
+    connection_all = []
+    special_k = []
+    ramp = np.arange(mid_num, dtype=np.float64)
+
+    for k in range(len(mapIdx)):
+        candA = all_peaks[limbSeq[k][0] - 1]
+        candB = all_peaks[limbSeq[k][1] - 1]
+        nA = len(candA)
+        nB = len(candB)
+        if nA == 0 or nB == 0:
+            special_k.append(k)
+            connection_all.append([])
+            continue
+
+        # all nA x nB pairs, A-major like the loop
+        peaksA = np.array([peak[:3] for peak in candA], dtype=np.float64)
+        peaksB = np.array([peak[:3] for peak in candB], dtype=np.float64)
+        ia, jb = np.repeat(np.arange(nA), nB), np.tile(np.arange(nB), nA)
+        start, stop = peaksA[ia, :2], peaksB[jb, :2]
+
+        vec = stop - start
+        norm = np.maximum(np.sqrt(vec[:, 0] * vec[:, 0] + vec[:, 1] * vec[:, 1]), 0.001)
+        vec = vec / norm[:, None]
+
+        # np.linspace(start, stop, mid_num) of every pair, x and y
+        startend = ramp[None, :, None] * ((stop - start) / (mid_num - 1))[:, None, :] + start[:, None, :]
+        startend[:, -1] = stop
+        startend = np.rint(startend).astype(int)
+
+        channel_x, channel_y = mapIdx[k][0] - 19, mapIdx[k][1] - 19
+        vec_x = paf_avg[startend[..., 1], startend[..., 0], channel_x]
+        vec_y = paf_avg[startend[..., 1], startend[..., 0], channel_y]
+
+        score_midpts = vec_x * vec[:, 0:1] + vec_y * vec[:, 1:2]
+        score_sum = np.zeros(len(score_midpts))
+        for I in range(mid_num):
+            score_sum = score_sum + score_midpts[:, I]
+        score_with_dist_prior = score_sum / mid_num + np.minimum(0.5 * image_height / norm - 1, 0)
+        criterion1 = np.count_nonzero(score_midpts > thre2, axis=1) > 0.8 * mid_num
+        criterion2 = score_with_dist_prior > 0
+        valid = np.nonzero(criterion1 & criterion2)[0]
+
+        # best first, ties keep the pair order as the stable sorted() of the loop
+        valid = valid[np.argsort(-score_with_dist_prior[valid], kind='stable')]
+        connection = []
+        used_A, used_B = set(), set()
+        for c in valid:
+            i, j = ia[c], jb[c]
+            if i not in used_A and j not in used_B:
+                connection.append([candA[i][3], candB[j][3], score_with_dist_prior[c], i, j])
+                used_A.add(i)
+                used_B.add(j)
+                if len(connection) >= min(nA, nB):
+                    break
+
+        connection_all.append(np.array(connection, dtype=np.float64) if connection else np.zeros((0, 5)))
+    return connection_all, special_k
+
+
+def assemble_people(all_peaks, connection_all, special_k):
+    """
+    assemble_people_loop with array operations: the people a connection touches are found with one comparison over
+    all rows, rows live in a preallocated array instead of being stacked one at a time and the final filter is a
+    mask. Connections still merge one after another as every merge depends on the ones before.
+    """
+    # last number in each row is the total parts number of that person
+    # the second last number in each row is the score of the overall configuration
+    candidate = np.array([item for sublist in all_peaks for item in sublist])
+    rows = sum(len(connection_all[k]) for k in range(len(mapIdx)) if k not in special_k)
+    subset = -1 * np.ones((rows, 20))
+    n = 0
+
+    for k in range(len(mapIdx)):
+        if k in special_k:
+            continue
+        connection = connection_all[k]
+        partAs = connection[:, 0]
+        partBs = connection[:, 1]
+        indexA, indexB = np.array(limbSeq[k]) - 1
+
+        for i in range(len(connection)):
+            subset_idx = np.nonzero((subset[:n, indexA] == partAs[i]) | (subset[:n, indexB] == partBs[i]))[0]
+            found = len(subset_idx)
+
+            if found == 1:
+                j = subset_idx[0]
+                if subset[j, indexB] != partBs[i]:
+                    subset[j, indexB] = partBs[i]
+                    subset[j, -1] += 1
+                    subset[j, -2] += candidate[partBs[i].astype(int), 2] + connection[i][2]
+            elif found == 2:  # if found 2 and disjoint, merge them
+                j1, j2 = subset_idx
+                membership = ((subset[j1] >= 0).astype(int) + (subset[j2] >= 0).astype(int))[:-2]
+                if not np.any(membership == 2):  # merge
+                    subset[j1, :-2] += (subset[j2, :-2] + 1)
+                    subset[j1, -2:] += subset[j2, -2:]
+                    subset[j1, -2] += connection[i][2]
+                    subset[j2:n - 1] = subset[j2 + 1:n]
+                    n -= 1
+                else:  # as like found == 1
+                    subset[j1, indexB] = partBs[i]
+                    subset[j1, -1] += 1
+                    subset[j1, -2] += candidate[partBs[i].astype(int), 2] + connection[i][2]
+
+            # if find no partA in the subset, create a new subset
+            elif not found and k < 17:
+                row = -1 * np.ones(20)
+                row[indexA] = partAs[i]
+                row[indexB] = partBs[i]
+                row[-1] = 2
+                row[-2] = sum(candidate[connection[i, :2].astype(int), 2]) + connection[i][2]
+                subset[n] = row
+                n += 1
+    # delete some rows of subset which has few parts occur
+    subset = subset[:n]
+    subset = subset[~((subset[:, -1] < 4) | (subset[:, -2] / subset[:, -1] < 0.4))]
+    return candidate, subset
+
+
 class Body(object):
-    def __init__(self, model_path):
+    # vectorized limb scoring and person assembly, False runs the reference loops
+    vectorized = True
+
+    def __init__(self, model_path, peaks_on_device=False):
+        # peaks_on_device runs the heatmap/PAF resizing, smoothing and peak detection on the model's device instead of
+        # in numpy on the host; off by default as the float32 torch resizing is close to but not bit-identical with the
+        # cv2/scipy reference
+        self.peaks_on_device = peaks_on_device
         self.model = bodypose_model()
         # if torch.cuda.is_available():
         #     self.model = self.model.cuda()
@@ -32,23 +291,85 @@ class Body(object):
         thre1 = 0.1
         thre2 = 0.05
         multiplier = [x * boxsize / oriImg.shape[0] for x in scale_search]
+
+        if self.peaks_on_device:
+            all_peaks, paf_avg = self.find_peaks_on_device(oriImg, multiplier, stride, padValue, thre1)
+        else:
+            all_peaks, paf_avg = self.find_peaks(oriImg, multiplier, stride, padValue, thre1)
+
+        if self.vectorized:
+            connection_all, special_k = connect_limbs(all_peaks, paf_avg, oriImg.shape[0], thre2)
+            candidate, subset = assemble_people(all_peaks, connection_all, special_k)
+        else:
+            # the reference loops slice the PAFs, so maps left on the device are copied to the host whole
+            if isinstance(paf_avg, util.DeviceMaps):
+                paf_avg = paf_avg.numpy()
+            connection_all, special_k = connect_limbs_loop(all_peaks, paf_avg, oriImg.shape[0], thre2)
+            candidate, subset = assemble_people_loop(all_peaks, connection_all, special_k)
+
+        # subset: n*20 array, 0-17 is the index in candidate, 18 is the total score, 19 is the total parts
+        # candidate: x, y, score, id
+        return candidate, subset
+
+    def network_outputs(self, oriImg, scale, stride, padValue):
+        """
+        Runs the model on oriImg resized by scale, returns the PAFs and heatmaps on the model's device with the padded
+        image shape and the padding.
+        """
+        imageToTest = util.smart_resize_k(oriImg, fx=scale, fy=scale)
+        imageToTest_padded, pad = util.padRightDownCorner(imageToTest, stride, padValue)
+        im = np.transpose(np.float32(imageToTest_padded[:, :, :, np.newaxis]), (3, 2, 0, 1)) / 256 - 0.5
+        im = np.ascontiguousarray(im)
+
+        data = torch.from_numpy(im).float()
+        if torch.cuda.is_available():
+            data = data.cuda()
+        # data = data.permute([2, 0, 1]).unsqueeze(0).float()
+        with torch.no_grad():
+            data = data.to(self.cn_device)
+            Mconv7_stage6_L1, Mconv7_stage6_L2 = self.model(data)
+        return Mconv7_stage6_L1, Mconv7_stage6_L2, imageToTest_padded.shape, pad
+
+    @torch.no_grad()
+    def find_peaks_on_device(self, oriImg, multiplier, stride, padValue, thre1):
+        """
+        find_peaks on the model's device: the heatmaps and PAFs of all parts are resized (bicubic in place of Lanczos),
+        smoothed and searched for peaks at once and only the peaks come back to the host. The PAFs stay on the device
+        behind a DeviceMaps view that connect_limbs reads its sample points from.
+        """
+        heatmap_avg, paf_avg = 0, 0
+        for m in range(len(multiplier)):
+            Mconv7_stage6_L1, Mconv7_stage6_L2, padded_shape, pad = self.network_outputs(oriImg, multiplier[m], stride, padValue)
+
+            # extract outputs, resize, and remove padding, heatmaps and PAFs together
+            maps = torch.cat([Mconv7_stage6_L2, Mconv7_stage6_L1], dim=1).float()
+            maps = util.smart_resize_tensor(maps, (maps.shape[2] * stride, maps.shape[3] * stride))
+            maps = maps[:, :, :padded_shape[0] - pad[2], :padded_shape[1] - pad[3]]
+            maps = util.smart_resize_tensor(maps, (oriImg.shape[0], oriImg.shape[1]))[0]
+
+            heatmap_avg = heatmap_avg + heatmap_avg + maps[:19] / len(multiplier)
+            paf_avg = paf_avg + maps[19:] / len(multiplier)
+
+        map_ori = heatmap_avg[:18]
+        one_heatmap = util.gaussian_filter_tensor(map_ori[None], sigma=3)[0]
+        peaks = util.find_peaks_tensor(one_heatmap, thre1)
+        scores = map_ori[peaks[:, 0], peaks[:, 1], peaks[:, 2]]
+        peaks, scores = peaks.cpu().numpy(), scores.double().cpu().numpy()
+
+        all_peaks = []
+        peak_counter = 0
+        for part in range(18):
+            part_peaks = np.nonzero(peaks[:, 0] == part)[0]
+            all_peaks.append([(peaks[i, 2], peaks[i, 1], scores[i], peak_counter + n) for n, i in enumerate(part_peaks)])
+            peak_counter += len(part_peaks)
+        return all_peaks, util.DeviceMaps(paf_avg)
+
+    def find_peaks(self, oriImg, multiplier, stride, padValue, thre1):
         heatmap_avg = np.zeros((oriImg.shape[0], oriImg.shape[1], 19))
         paf_avg = np.zeros((oriImg.shape[0], oriImg.shape[1], 38))
 
         for m in range(len(multiplier)):
-            scale = multiplier[m]
-            imageToTest = util.smart_resize_k(oriImg, fx=scale, fy=scale)
-            imageToTest_padded, pad = util.padRightDownCorner(imageToTest, stride, padValue)
-            im = np.transpose(np.float32(imageToTest_padded[:, :, :, np.newaxis]), (3, 2, 0, 1)) / 256 - 0.5
-            im = np.ascontiguousarray(im)
-
-            data = torch.from_numpy(im).float()
-            if torch.cuda.is_available():
-                data = data.cuda()
-            # data = data.permute([2, 0, 1]).unsqueeze(0).float()
-            with torch.no_grad():
-                data = data.to(self.cn_device)
-                Mconv7_stage6_L1, Mconv7_stage6_L2 = self.model(data)
+            Mconv7_stage6_L1, Mconv7_stage6_L2, padded_shape, pad = self.network_outputs(oriImg, multiplier[m], stride, padValue)
             Mconv7_stage6_L1 = Mconv7_stage6_L1.cpu().numpy()
             Mconv7_stage6_L2 = Mconv7_stage6_L2.cpu().numpy()
 
@@ -56,13 +377,13 @@ class Body(object):
             # heatmap = np.transpose(np.squeeze(net.blobs[output_blobs.keys()[1]].data), (1, 2, 0))  # output 1 is heatmaps
             heatmap = np.transpose(np.squeeze(Mconv7_stage6_L2), (1, 2, 0))  # output 1 is heatmaps
             heatmap = util.smart_resize_k(heatmap, fx=stride, fy=stride)
-            heatmap = heatmap[:imageToTest_padded.shape[0] - pad[2], :imageToTest_padded.shape[1] - pad[3], :]
+            heatmap = heatmap[:padded_shape[0] - pad[2], :padded_shape[1] - pad[3], :]
             heatmap = util.smart_resize(heatmap, (oriImg.shape[0], oriImg.shape[1]))
 
             # paf = np.transpose(np.squeeze(net.blobs[output_blobs.keys()[0]].data), (1, 2, 0))  # output 0 is PAFs
             paf = np.transpose(np.squeeze(Mconv7_stage6_L1), (1, 2, 0))  # output 0 is PAFs
             paf = util.smart_resize_k(paf, fx=stride, fy=stride)
-            paf = paf[:imageToTest_padded.shape[0] - pad[2], :imageToTest_padded.shape[1] - pad[3], :]
+            paf = paf[:padded_shape[0] - pad[2], :padded_shape[1] - pad[3], :]
             paf = util.smart_resize(paf, (oriImg.shape[0], oriImg.shape[1]))
 
             heatmap_avg += heatmap_avg + heatmap / len(multiplier)
@@ -93,124 +414,8 @@ class Body(object):
 
             all_peaks.append(peaks_with_score_and_id)
             peak_counter += len(peaks)
+        return all_peaks, paf_avg
 
-        # find connection in the specified sequence, center 29 is in the position 15
-        limbSeq = [[2, 3], [2, 6], [3, 4], [4, 5], [6, 7], [7, 8], [2, 9], [9, 10], \
-                   [10, 11], [2, 12], [12, 13], [13, 14], [2, 1], [1, 15], [15, 17], \
-                   [1, 16], [16, 18], [3, 17], [6, 18]]
-        # the middle joints heatmap correpondence
-        mapIdx = [[31, 32], [39, 40], [33, 34], [35, 36], [41, 42], [43, 44], [19, 20], [21, 22], \
-                  [23, 24], [25, 26], [27, 28], [29, 30], [47, 48], [49, 50], [53, 54], [51, 52], \
-                  [55, 56], [37, 38], [45, 46]]
-
-        connection_all = []
-        special_k = []
-        mid_num = 10
-
-        for k in range(len(mapIdx)):
-            score_mid = paf_avg[:, :, [x - 19 for x in mapIdx[k]]]
-            candA = all_peaks[limbSeq[k][0] - 1]
-            candB = all_peaks[limbSeq[k][1] - 1]
-            nA = len(candA)
-            nB = len(candB)
-            indexA, indexB = limbSeq[k]
-            if (nA != 0 and nB != 0):
-                connection_candidate = []
-                for i in range(nA):
-                    for j in range(nB):
-                        vec = np.subtract(candB[j][:2], candA[i][:2])
-                        norm = math.sqrt(vec[0] * vec[0] + vec[1] * vec[1])
-                        norm = max(0.001, norm)
-                        vec = np.divide(vec, norm)
-
-                        startend = list(zip(np.linspace(candA[i][0], candB[j][0], num=mid_num), \
-                                            np.linspace(candA[i][1], candB[j][1], num=mid_num)))
-
-                        vec_x = np.array([score_mid[int(round(startend[I][1])), int(round(startend[I][0])), 0] \
-                                          for I in range(len(startend))])
-                        vec_y = np.array([score_mid[int(round(startend[I][1])), int(round(startend[I][0])), 1] \
-                                          for I in range(len(startend))])
-
-                        score_midpts = np.multiply(vec_x, vec[0]) + np.multiply(vec_y, vec[1])
-                        score_with_dist_prior = sum(score_midpts) / len(score_midpts) + min(
-                            0.5 * oriImg.shape[0] / norm - 1, 0)
-                        criterion1 = len(np.nonzero(score_midpts > thre2)[0]) > 0.8 * len(score_midpts)
-                        criterion2 = score_with_dist_prior > 0
-                        if criterion1 and criterion2:
-                            connection_candidate.append(
-                                [i, j, score_with_dist_prior, score_with_dist_prior + candA[i][2] + candB[j][2]])
-
-                connection_candidate = sorted(connection_candidate, key=lambda x: x[2], reverse=True)
-                connection = np.zeros((0, 5))
-                for c in range(len(connection_candidate)):
-                    i, j, s = connection_candidate[c][0:3]
-                    if (i not in connection[:, 3] and j not in connection[:, 4]):
-                        connection = np.vstack([connection, [candA[i][3], candB[j][3], s, i, j]])
-                        if (len(connection) >= min(nA, nB)):
-                            break
-
-                connection_all.append(connection)
-            else:
-                special_k.append(k)
-                connection_all.append([])
-
-        # last number in each row is the total parts number of that person
-        # the second last number in each row is the score of the overall configuration
-        subset = -1 * np.ones((0, 20))
-        candidate = np.array([item for sublist in all_peaks for item in sublist])
-
-        for k in range(len(mapIdx)):
-            if k not in special_k:
-                partAs = connection_all[k][:, 0]
-                partBs = connection_all[k][:, 1]
-                indexA, indexB = np.array(limbSeq[k]) - 1
-
-                for i in range(len(connection_all[k])):  # = 1:size(temp,1)
-                    found = 0
-                    subset_idx = [-1, -1]
-                    for j in range(len(subset)):  # 1:size(subset,1):
-                        if subset[j][indexA] == partAs[i] or subset[j][indexB] == partBs[i]:
-                            subset_idx[found] = j
-                            found += 1
-
-                    if found == 1:
-                        j = subset_idx[0]
-                        if subset[j][indexB] != partBs[i]:
-                            subset[j][indexB] = partBs[i]
-                            subset[j][-1] += 1
-                            subset[j][-2] += candidate[partBs[i].astype(int), 2] + connection_all[k][i][2]
-                    elif found == 2:  # if found 2 and disjoint, merge them
-                        j1, j2 = subset_idx
-                        membership = ((subset[j1] >= 0).astype(int) + (subset[j2] >= 0).astype(int))[:-2]
-                        if len(np.nonzero(membership == 2)[0]) == 0:  # merge
-                            subset[j1][:-2] += (subset[j2][:-2] + 1)
-                            subset[j1][-2:] += subset[j2][-2:]
-                            subset[j1][-2] += connection_all[k][i][2]
-                            subset = np.delete(subset, j2, 0)
-                        else:  # as like found == 1
-                            subset[j1][indexB] = partBs[i]
-                            subset[j1][-1] += 1
-                            subset[j1][-2] += candidate[partBs[i].astype(int), 2] + connection_all[k][i][2]
-
-                    # if find no partA in the subset, create a new subset
-                    elif not found and k < 17:
-                        row = -1 * np.ones(20)
-                        row[indexA] = partAs[i]
-                        row[indexB] = partBs[i]
-                        row[-1] = 2
-                        row[-2] = sum(candidate[connection_all[k][i, :2].astype(int), 2]) + connection_all[k][i][2]
-                        subset = np.vstack([subset, row])
-        # delete some rows of subset which has few parts occur
-        deleteIdx = []
-        for i in range(len(subset)):
-            if subset[i][-1] < 4 or subset[i][-2] / subset[i][-1] < 0.4:
-                deleteIdx.append(i)
-        subset = np.delete(subset, deleteIdx, axis=0)
-
-        # subset: n*20 array, 0-17 is the index in candidate, 18 is the total score, 19 is the total parts
-        # candidate: x, y, score, id
-        return candidate, subset
-    
     @staticmethod
     def format_body_result(candidate: np.ndarray, subset: np.ndarray) -> List[BodyResult]:
         """
@@ -93,17 +93,7 @@ def preprocess(img, input_size, swap=(2, 0, 1)):
     padded_img = np.ascontiguousarray(padded_img, dtype=np.float32)
     return padded_img, r
 
-def inference_detector(session, oriImg):
-    input_shape = (640,640)
-    img, ratio = preprocess(oriImg, input_shape)
-
-    input = img[None, :, :, :]
-    outNames = session.getUnconnectedOutLayersNames()
-    session.setInput(input)
-    output = session.forward(outNames)
-
-    predictions = demo_postprocess(output[0], input_shape)[0]
-
+def postprocess_detections(predictions, ratio):
     boxes = predictions[:, :4]
     scores = predictions[:, 4:5] * predictions[:, 5:]
 
@@ -122,3 +112,22 @@ def inference_detector(session, oriImg):
     isbbox = [ i and j for (i, j) in zip(isscore, iscat)]
     final_boxes = final_boxes[isbbox]
     return final_boxes
+
+def inference_detector(session, oriImg):
+    """Person boxes of an H x W x C image, or a list of boxes per frame for a list / N x H x W x C array of frames,
+    which go through the detector in one forward."""
+    input_shape = (640,640)
+    is_batch = isinstance(oriImg, (list, tuple)) or oriImg.ndim == 4
+    imgs = oriImg if is_batch else [oriImg]
+    imgs, ratios = zip(*[preprocess(img, input_shape) for img in imgs])
+
+    input = np.stack(imgs, axis=0)
+    outNames = session.getUnconnectedOutLayersNames()
+    session.setInput(input)
+    output = session.forward(outNames)
+    if output[0].shape[0] != len(imgs):
+        raise ValueError('the detector does not take batched input')
+
+    predictions = demo_postprocess(output[0], input_shape)
+    final_boxes = [postprocess_detections(predictions[i], ratio) for i, ratio in enumerate(ratios)]
+    return final_boxes if is_batch else final_boxes[0]
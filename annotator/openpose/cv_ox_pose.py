@@ -48,16 +48,28 @@ def preprocess(
     return out_img, out_center, out_scale
 
 
-def inference(sess, img):
+def inference(sess, img, batched=True):
     """Inference DWPose model.
 
     Args:
         sess : ONNXRuntime session.
         img : Input image in shape.
+        batched (bool): Whether all crops go through the model in one
+            forward, graphs with a fixed batch dimension need False.
 
     Returns:
         outputs : Output of DWPose model.
     """
+    outNames = sess.getUnconnectedOutLayersNames()
+    if batched:
+        input = np.stack(img, axis=0).transpose(0, 3, 1, 2)
+        sess.setInput(np.ascontiguousarray(input, dtype=np.float32))
+        outputs = sess.forward(outNames)
+        if outputs[0].shape[0] != len(img):
+            raise ValueError('the pose model does not take batched input')
+        # split into the per crop outputs postprocess takes
+        return [tuple(output[i:i + 1] for output in outputs) for i in range(len(img))]
+
     all_out = []
     # build input
     for i in range(len(img)):
@@ -65,7 +77,6 @@ def inference(sess, img):
         input = img[i].transpose(2, 0, 1)
         input = input[None, :, :, :]
 
-        outNames = sess.getUnconnectedOutLayersNames()
         sess.setInput(input)
         outputs = sess.forward(outNames)
         all_out.append(outputs)
@@ -346,10 +357,28 @@ def decode(simcc_x: np.ndarray, simcc_y: np.ndarray,
     return keypoints, scores
 
 
-def inference_pose(session, out_bbox, oriImg):
+def inference_pose_batch(session, out_bboxes, oriImgs, batched=True):
+    """Keypoints and scores per frame, the person crops of all frames go
+    through the model together."""
+    model_input_size = (288, 384)
+    resized_img, center, scale, counts = [], [], [], []
+    for out_bbox, oriImg in zip(out_bboxes, oriImgs):
+        frame_img, frame_center, frame_scale = preprocess(oriImg, out_bbox, model_input_size)
+        resized_img += frame_img
+        center += frame_center
+        scale += frame_scale
+        counts.append(len(frame_img))
+    outputs = inference(session, resized_img, batched)
+    keypoints, scores = postprocess(outputs, model_input_size, center, scale)
+
+    splits = np.cumsum(counts)[:-1]
+    return list(zip(np.split(keypoints, splits), np.split(scores, splits)))
+
+
+def inference_pose(session, out_bbox, oriImg, batched=True):
     model_input_size = (288, 384)
     resized_img, center, scale = preprocess(oriImg, out_bbox, model_input_size)
-    outputs = inference(session, resized_img)
+    outputs = inference(session, resized_img, batched)
     keypoints, scores = postprocess(outputs, model_input_size, center, scale)
 
     return keypoints, scores
\ No newline at end of file
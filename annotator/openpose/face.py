@@ -359,4 +359,40 @@ class Face(object):
             y, x = positions[0][mi], positions[1][mi]
             all_peaks.append([x, y])
 
-        return np.array(all_peaks)
\ No newline at end of file
+        return np.array(all_peaks)
+
+    def batch_peaks(self, face_imgs):
+        """
+        compute_peaks_from_heatmaps(__call__(face_img)) for a list of face crops: the crops run in one forward and the
+        peaks are found at heatmap resolution on the model's device, then rescaled to each crop with the align_corners
+        mapping of the bilinear upsampling in __call__. Only the peaks come back to the host. Parts without a value over
+        0.05 are left out, like compute_peaks_from_heatmaps does.
+        """
+        if len(face_imgs) == 0:
+            return []
+        w_size = 384
+        x_data = torch.stack([
+            torch.from_numpy(util.smart_resize(face_img, (w_size, w_size))).permute([2, 0, 1])
+            for face_img in face_imgs
+        ]) / 256.0 - 0.5
+
+        x_data = x_data.to(self.cn_device)
+
+        with torch.no_grad():
+            heatmaps = self.model(x_data)[-1]
+            _, _, h, w = heatmaps.shape
+            values, indices = heatmaps.flatten(2).max(dim=2)
+        values, indices = values.cpu().numpy(), indices.cpu().numpy()
+
+        all_peaks = []
+        for face_img, part_values, part_indices in zip(face_imgs, values, indices):
+            H, W, C = face_img.shape
+            found = part_values > 0.05
+            if not np.any(found):
+                all_peaks.append(np.array([]))
+                continue
+            y, x = np.divmod(part_indices[found], w)
+            x = np.round(x * (W - 1) / max(w - 1, 1)).astype(int)
+            y = np.round(y * (H - 1) / max(h - 1, 1)).astype(int)
+            all_peaks.append(np.stack([x, y], axis=1))
+        return all_peaks
\ No newline at end of file
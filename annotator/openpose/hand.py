@@ -82,6 +82,72 @@ class Hand(object):
             all_peaks.append([x, y])
         return np.array(all_peaks)
 
+    def batch(self, oriImgsRaw):
+        """
+        __call__ for a list of hand crops: every scale of scale_search runs all crops in one forward (the scales differ
+        in size, so they do not share one), the heatmaps are resized (bicubic in place of Lanczos) and smoothed on the
+        model's device and the peaks are searched at the wsize x wsize heatmap resolution before their coordinates are
+        rescaled to each crop. Returns the 21 x 2 peaks of every crop.
+        """
+        if len(oriImgsRaw) == 0:
+            return []
+        scale_search = [0.5, 1.0, 1.5, 2.0]
+        boxsize = 368
+        stride = 8
+        padValue = 128
+        thre = 0.05
+        multiplier = [x * boxsize for x in scale_search]
+
+        wsize = 128
+        heatmap_avg = 0
+
+        oriImgs = [cv2.GaussianBlur(oriImgRaw, (0, 0), 0.8) for oriImgRaw in oriImgsRaw]
+
+        with torch.no_grad():
+            for m in range(len(multiplier)):
+                scale = multiplier[m]
+                # every crop is resized to scale x scale, so all crops share the padding
+                padded = [util.padRightDownCorner(util.smart_resize(oriImg, (scale, scale)), stride, padValue) for oriImg in oriImgs]
+                imageToTest_padded, pad = padded[0]
+                im = np.transpose(np.float32(np.stack([image for image, _ in padded])), (0, 3, 1, 2)) / 256 - 0.5
+                im = np.ascontiguousarray(im)
+
+                data = torch.from_numpy(im).float().to(self.cn_device)
+                output = self.model(data).float()
+
+                # extract outputs, resize, and remove padding
+                heatmap = util.smart_resize_tensor(output, (output.shape[2] * stride, output.shape[3] * stride))
+                heatmap = heatmap[:, :, :imageToTest_padded.shape[0] - pad[2], :imageToTest_padded.shape[1] - pad[3]]
+                heatmap = util.smart_resize_tensor(heatmap, (wsize, wsize))
+
+                heatmap_avg = heatmap_avg + heatmap / len(multiplier)
+
+            one_heatmaps = util.gaussian_filter_tensor(heatmap_avg, sigma=3).cpu().numpy()
+            heatmap_avg = heatmap_avg.double().cpu().numpy()
+
+        results = []
+        for oriImgRaw, maps, one_maps in zip(oriImgsRaw, heatmap_avg, one_heatmaps):
+            Hr, Wr, Cr = oriImgRaw.shape
+            all_peaks = []
+            for part in range(21):
+                map_ori = maps[part]
+                binary = np.ascontiguousarray(one_maps[part] > thre, dtype=np.uint8)
+
+                if np.sum(binary) == 0:
+                    all_peaks.append([0, 0])
+                    continue
+                label_img, label_numbers = label(binary, return_num=True, connectivity=binary.ndim)
+                max_index = np.argmax([np.sum(map_ori[label_img == i]) for i in range(1, label_numbers + 1)]) + 1
+                label_img[label_img != max_index] = 0
+                map_ori[label_img == 0] = 0
+
+                y, x = util.npmax(map_ori)
+                y = int(float(y) * float(Hr) / float(wsize))
+                x = int(float(x) * float(Wr) / float(wsize))
+                all_peaks.append([x, y])
+            results.append(np.array(all_peaks))
+        return results
+
 if __name__ == "__main__":
     hand_estimation = Hand('../model/hand_pose_model.pth')
 
@@ -2,6 +2,8 @@ import math
 import numpy as np
 import matplotlib
 import cv2
+import torch
+import torch.nn.functional as F
 from typing import List, Tuple, Union, Optional
 
 from .body import BodyResult, Keypoint
@@ -37,6 +39,73 @@ def smart_resize_k(x, fx, fy):
         return np.stack([smart_resize_k(x[:, :, i], fx, fy) for i in range(Co)], axis=2)
 
 
+def smart_resize_tensor(x, s):
+    """
+    smart_resize of N x C x H x W maps on their device, all channels at once: area when shrinking, bicubic in place of
+    Lanczos when enlarging.
+    """
+    Ht, Wt = s
+    Ho, Wo = x.shape[-2:]
+    k = float(Ht + Wt) / float(Ho + Wo)
+    if k < 1:
+        return F.interpolate(x, size=(int(Ht), int(Wt)), mode='area')
+    return F.interpolate(x, size=(int(Ht), int(Wt)), mode='bicubic', align_corners=False)
+
+
+def gaussian_filter_tensor(x, sigma, truncate=4.0):
+    """
+    scipy.ndimage.gaussian_filter of N x C x H x W maps over H and W (mode 'reflect', which repeats the edge sample
+    unlike torch's reflect padding), as two 1d convolutions.
+    """
+    radius = int(truncate * sigma + 0.5)
+    kernel = torch.arange(-radius, radius + 1, device=x.device, dtype=x.dtype)
+    kernel = torch.exp(-0.5 * kernel ** 2 / sigma ** 2)
+    kernel = kernel / kernel.sum()
+    N, C, H, W = x.shape
+    x = x.reshape(N * C, 1, H, W)
+    x = torch.cat([x[:, :, :radius].flip(2), x, x[:, :, -radius:].flip(2)], dim=2)
+    x = torch.cat([x[:, :, :, :radius].flip(3), x, x[:, :, :, -radius:].flip(3)], dim=3)
+    x = F.conv2d(x, kernel.view(1, 1, -1, 1))
+    x = F.conv2d(x, kernel.view(1, 1, 1, -1))
+    return x.reshape(N, C, H, W)
+
+
+def find_peaks_tensor(maps, thre):
+    """
+    Local maxima above thre of C x H x W maps, compared with their 4 neighbours (zero outside the map).
+    Returns the K x 3 (channel, y, x) indices of the peaks, in channel, row, column order.
+    """
+    padded = F.pad(maps, (1, 1, 1, 1))
+    center = padded[:, 1:-1, 1:-1]
+    peaks_binary = ((center >= padded[:, :-2, 1:-1]) & (center >= padded[:, 2:, 1:-1]) &
+                    (center >= padded[:, 1:-1, :-2]) & (center >= padded[:, 1:-1, 2:]) & (center > thre))
+    return torch.nonzero(peaks_binary)
+
+
+class DeviceMaps:
+    """
+    H x W x C view of C x H x W maps left on their device: indexing with (rows, columns, channel) index arrays copies
+    only the indexed values to the host, as float64.
+    """
+
+    def __init__(self, maps):
+        self.maps = maps
+
+    @property
+    def shape(self):
+        C, H, W = self.maps.shape
+        return H, W, C
+
+    def __getitem__(self, index):
+        rows, columns, channel = index
+        rows = torch.as_tensor(rows, device=self.maps.device)
+        columns = torch.as_tensor(columns, device=self.maps.device)
+        return self.maps[channel, rows, columns].double().cpu().numpy()
+
+    def numpy(self):
+        return self.maps.permute(1, 2, 0).double().cpu().numpy()
+
+
 def padRightDownCorner(img, stride, padValue):
     h = img.shape[0]
     w = img.shape[1]
@@ -3,7 +3,7 @@ import cv2
 import numpy as np
 
 from .cv_ox_det import inference_detector
-from .cv_ox_pose import inference_pose
+from .cv_ox_pose import inference_pose_batch
 
 from typing import List, Optional
 from .types import PoseResult, BodyResult, Keypoint
@@ -25,13 +25,48 @@ class Wholebody:
         self.session_pose.setPreferableBackend(backend)
         self.session_pose.setPreferableTarget(providers)
     
-    def __call__(self, oriImg) -> Optional[np.ndarray]:
-        det_result = inference_detector(self.session_det, oriImg)
-        if det_result is None:
-            return None
+        # one forward for all person crops (and frames), falls back to a forward per crop for graphs exported with
+        # a fixed batch dimension
+        self.batch_pose = True
+        self.batch_det = True
+
+    def pose(self, out_bboxes, oriImgs):
+        if self.batch_pose:
+            try:
+                return inference_pose_batch(self.session_pose, out_bboxes, oriImgs, batched=True)
+            except (cv2.error, ValueError):
+                self.batch_pose = False
+        return inference_pose_batch(self.session_pose, out_bboxes, oriImgs, batched=False)
+
+    def detect(self, oriImgs):
+        if self.batch_det and len(oriImgs) > 1:
+            try:
+                return inference_detector(self.session_det, oriImgs)
+            except (cv2.error, ValueError):
+                self.batch_det = False
+        return [inference_detector(self.session_det, oriImg) for oriImg in oriImgs]
 
-        keypoints, scores = inference_pose(self.session_pose, det_result, oriImg)
+    def __call__(self, oriImg) -> Optional[np.ndarray]:
+        return self.batch([oriImg])[0]
+
+    def batch(self, oriImgs) -> List[Optional[np.ndarray]]:
+        """
+        Keypoints of a list (or N x H x W x C array) of frames, the detector runs the frames in one forward and the pose
+        model all person crops of all frames in another.
+        """
+        det_results = self.detect(oriImgs)
+        frames = [i for i, det_result in enumerate(det_results) if det_result is not None]
+        results = [None] * len(det_results)
+        if len(frames) == 0:
+            return results
+
+        poses = self.pose([det_results[i] for i in frames], [oriImgs[i] for i in frames])
+        for i, (keypoints, scores) in zip(frames, poses):
+            results[i] = self.to_openpose(keypoints, scores)
+        return results
 
+    @staticmethod
+    def to_openpose(keypoints, scores) -> np.ndarray:
         keypoints_info = np.concatenate(
             (keypoints, scores[..., None]), axis=-1)
         # compute neck joint
@@ -98,3 +133,62 @@ class Wholebody:
             pose_results.append(PoseResult(body, left_hand, right_hand, face))
 
         return pose_results
+
+
+class PoseTracker:
+    """
+    Video mode of Wholebody for continuous frames. The person detector runs on keyframes, every keyframe_interval
+    frames, and whenever tracking confidence drops; in between, the pose model refines the previous frame's people in
+    boxes around their keypoints, grown by box_margin of the box size on each side. A tracked frame is detected again
+    when the mean body keypoint score of its weakest person falls below min_score.
+    detections and tracked count the frames of each kind.
+    """
+
+    def __init__(self, wholebody: Wholebody, keyframe_interval: int = 8, min_score: float = 0.3, box_margin: float = 0.1):
+        self.wholebody = wholebody
+        self.keyframe_interval = keyframe_interval
+        self.min_score = min_score
+        self.box_margin = box_margin
+        self.reset()
+
+    def reset(self):
+        self.previous = None
+        self.since_keyframe = 0
+        self.detections = 0
+        self.tracked = 0
+
+    @property
+    def detection_ratio(self) -> float:
+        frames = self.detections + self.tracked
+        return self.detections / frames if frames > 0 else 0.0
+
+    def track_boxes(self, keypoints_info: np.ndarray, img_shape) -> np.ndarray:
+        # x0, y0, x1, y1 boxes around the visible keypoints of every person of the previous frame
+        H, W = img_shape[:2]
+        boxes = []
+        for person in keypoints_info:
+            visible = person[person[:, 2] > 0.3, :2]
+            if len(visible) < 2:
+                continue
+            (x0, y0), (x1, y1) = visible.min(axis=0), visible.max(axis=0)
+            margin_x, margin_y = (x1 - x0) * self.box_margin, (y1 - y0) * self.box_margin
+            boxes.append([max(x0 - margin_x, 0), max(y0 - margin_y, 0), min(x1 + margin_x, W), min(y1 + margin_y, H)])
+        return np.array(boxes)
+
+    def __call__(self, oriImg) -> Optional[np.ndarray]:
+        if self.previous is not None and self.since_keyframe < self.keyframe_interval:
+            boxes = self.track_boxes(self.previous, oriImg.shape)
+            if len(boxes) > 0:
+                keypoints, scores = self.wholebody.pose([boxes], [oriImg])[0]
+                keypoints_info = Wholebody.to_openpose(keypoints, scores)
+                if keypoints_info[:, :18, 2].mean(axis=1).min() >= self.min_score:
+                    self.previous = keypoints_info
+                    self.since_keyframe += 1
+                    self.tracked += 1
+                    return keypoints_info
+
+        keypoints_info = self.wholebody(oriImg)
+        self.previous = keypoints_info
+        self.since_keyframe = 1
+        self.detections += 1
+        return keypoints_info
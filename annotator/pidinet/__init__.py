@@ -3,8 +3,8 @@ import torch
 import numpy as np
 from einops import rearrange
 from annotator.pidinet.model import pidinet
-from annotator.util import safe_step
-from annotator.annotator_path import models_path, DEVICE
+from annotator.util import safe_step, frame_batches
+from annotator.annotator_path import models_path, DEVICE, BATCH_CHUNK_SIZE
 import safetensors.torch
 # from modules.safe import unsafe_torch_load
 
@@ -25,7 +25,7 @@ remote_model_path = "https://huggingface.co/lllyasviel/Annotators/resolve/main/t
 modeldir = os.path.join(models_path, "pidinet")
 old_modeldir = os.path.dirname(os.path.realpath(__file__))
 
-def apply_pidinet(input_image, is_safe=False, apply_fliter=False):
+def load_pid_model():
     global netNetwork
     if netNetwork is None:
         modelpath = os.path.join(modeldir, "table5_pidinet.pth")
@@ -38,26 +38,39 @@ def apply_pidinet(input_image, is_safe=False, apply_fliter=False):
         netNetwork = pidinet()
         ckp = load_state_dict(modelpath)
         netNetwork.load_state_dict({k.replace('module.',''):v for k, v in ckp.items()})
-        
+
+def apply_pidinet(input_image, is_safe=False, apply_fliter=False):
+    assert input_image.ndim == 3
+    return apply_pidinet_batch(input_image[None], is_safe=is_safe, apply_fliter=apply_fliter)[0]
+
+
+def apply_pidinet_batch(input_images, is_safe=False, apply_fliter=False, chunk_size=BATCH_CHUNK_SIZE):
+    """
+    Runs PiDiNet on an N x H x W x C uint8 array (or a list of frames) with one forward pass per chunk
+    and returns the N x H x W edge maps.
+    """
+    global netNetwork
+    load_pid_model()
     netNetwork = netNetwork.to(DEVICE)
     netNetwork.eval()
-    assert input_image.ndim == 3
-    input_image = input_image[:, :, ::-1].copy()
+    results = []
     with torch.no_grad():
-        image_pidi = torch.from_numpy(input_image).float().to(DEVICE)
-        image_pidi = image_pidi / 255.0
-        image_pidi = rearrange(image_pidi, 'h w c -> 1 c h w')
-        edge = netNetwork(image_pidi)[-1]
-        edge = edge.cpu().numpy()
-        if apply_fliter:
-            edge = edge > 0.5 
-        if is_safe:
-            edge = safe_step(edge)
-        edge = (edge * 255.0).clip(0, 255).astype(np.uint8)
+        for chunk in frame_batches(input_images, chunk_size):
+            chunk = chunk[:, :, :, ::-1].copy()
+            image_pidi = torch.from_numpy(chunk).float().to(DEVICE)
+            image_pidi = image_pidi / 255.0
+            image_pidi = rearrange(image_pidi, 'b h w c -> b c h w')
+            edge = netNetwork(image_pidi)[-1]
+            edge = edge.cpu().numpy()
+            if apply_fliter:
+                edge = edge > 0.5 
+            if is_safe:
+                edge = safe_step(edge)
+            edge = (edge * 255.0).clip(0, 255).astype(np.uint8)
+            results.append(edge[:, 0])
         
-    return edge[0][0] 
+    return np.concatenate(results, axis=0)
 
 def unload_pid_model():
     global netNetwork
-    if netNetwork is not None:
-        netNetwork.cpu()
\ No newline at end of file
+    netNetwork = None
\ No newline at end of file
@@ -21,6 +21,17 @@ def HWC3(x):
         return y
 
 
+def frame_batches(input_images, chunk_size):
+    """
+    Yields chunk_size long N x H x W x C slices of a stacked uint8 array or of a list of equally sized frames.
+    """
+    if isinstance(input_images, (list, tuple)):
+        input_images = np.stack(input_images, axis=0)
+    assert input_images.ndim == 4
+    for i in range(0, input_images.shape[0], chunk_size):
+        yield input_images[i:i + chunk_size]
+
+
 def make_noise_disk(H, W, C, F):
     noise = np.random.uniform(low=0, high=1, size=((H // F) + 2, (W // F) + 2, C))
     noise = cv2.resize(noise, (W + 2 * F, H + 2 * F), interpolation=cv2.INTER_CUBIC)
@@ -6,7 +6,8 @@ import torch
 from einops import rearrange
 from .zoedepth.models.zoedepth.zoedepth_v1 import ZoeDepth
 from .zoedepth.utils.config import get_config
-from annotator.annotator_path import models_path, DEVICE
+from annotator.annotator_path import models_path, DEVICE, BATCH_CHUNK_SIZE
+from annotator.util import frame_batches
 
 
 
@@ -34,26 +35,32 @@ class ZoeDetector:
             self.model.cpu()
 
     def __call__(self, input_image):
+        assert input_image.ndim == 3
+        return self.batch(input_image[None])[0]
+
+    def batch(self, input_images, chunk_size=BATCH_CHUNK_SIZE):
+        """
+        Runs ZoeDepth on an N x H x W x C uint8 array (or a list of frames) with one forward pass per chunk
+        and returns the N x H x W depth maps, each normalised on its own percentiles.
+        """
         if self.model is None:
             self.load_model()
         self.model.to(self.device)
 
-        assert input_image.ndim == 3
-        image_depth = input_image
+        depth_images = []
         with torch.no_grad():
-            image_depth = torch.from_numpy(image_depth).float().to(self.device)
-            image_depth = image_depth / 255.0
-            image_depth = rearrange(image_depth, 'h w c -> 1 c h w')
-            depth = self.model.infer(image_depth)
-
-            depth = depth[0, 0].cpu().numpy()
-
-            vmin = np.percentile(depth, 2)
-            vmax = np.percentile(depth, 85)
+            for chunk in frame_batches(input_images, chunk_size):
+                image_depth = torch.from_numpy(chunk).float().to(self.device)
+                image_depth = image_depth / 255.0
+                image_depth = rearrange(image_depth, 'b h w c -> b c h w')
+                depths = self.model.infer(image_depth)[:, 0].cpu().numpy()
 
-            depth -= vmin
-            depth /= vmax - vmin
-            depth = 1.0 - depth
-            depth_image = (depth * 255.0).clip(0, 255).astype(np.uint8)
+                for depth in depths:
+                    vmin = np.percentile(depth, 2)
+                    vmax = np.percentile(depth, 85)
 
-            return depth_image
+                    depth -= vmin
+                    depth /= vmax - vmin
+                    depth = 1.0 - depth
+                    depth_images.append((depth * 255.0).clip(0, 255).astype(np.uint8))
+        return np.stack(depth_images, axis=0)
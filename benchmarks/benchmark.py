@@ -0,0 +1,163 @@
+'''
+Micro-benchmarks of the optimized code paths against the code they replace, on random inputs and random weights.
+Run from the repository root: python -m benchmarks.benchmark <name>
+'''
+import argparse
+import time
+
+import numpy as np
+import torch
+
+
+def timeit(fn, *args, repeat=5):
+    fn(*args)
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn(*args)
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / repeat
+
+
+def benchmark_shuffle():
+    # one RAVE shuffle (latents and one control) with the grid engine against prepare_key_grid_latents
+    import utils.feature_utils as fu
+
+    def shuffle_concat(x, grid, sample_size, rand_i):
+        grid_frame_number = grid[0] * grid[1]
+        return torch.cat([fu.prepare_key_grid_latents(x, grid, grid, rand_i[j*grid_frame_number:(j+1)*grid_frame_number])[0] for j in range(sample_size)], dim=0)
+
+    def shuffle_gather(x, grid, sample_size, rand_i):
+        return fu.permute_grids(x, grid, rand_i)
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    for grid_size, sample_size in [(2, 8), (3, 8), (3, 16), (4, 4)]:
+        grid = [grid_size, grid_size]
+        latents = torch.randn(sample_size, 4, 64 * grid_size, 64 * grid_size, device=device)
+        controls = torch.rand(sample_size, 3, 512 * grid_size, 512 * grid_size, device=device)
+        rand_i = torch.randperm(sample_size * grid_size**2).tolist()
+        for name, x in [('latents', latents), ('control', controls)]:
+            assert torch.equal(shuffle_concat(x, grid, sample_size, rand_i), shuffle_gather(x, grid, sample_size, rand_i))
+            t_concat = timeit(shuffle_concat, x, grid, sample_size, rand_i, repeat=10)
+            t_gather = timeit(shuffle_gather, x, grid, sample_size, rand_i, repeat=10)
+            print(f'{grid_size}x{grid_size} grids, sample_size {sample_size}, {name}: prepare_key_grid_latents {t_concat*1e3:.2f} ms, permute_grids {t_gather*1e3:.2f} ms ({t_concat/t_gather:.1f}x)')
+
+
+def benchmark_attention():
+    # grid self-attention throughput, FrameAnchorAttnProcessor against AttnProcessor2_0
+    from diffusers.models.attention_processor import Attention
+    from pipelines.attention_processor import AttnProcessor2_0, FrameAnchorAttnProcessor, GridLayout
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    frame_size = 64 if device == 'cuda' else 16  # top UNet level of a 512x512 frame on GPU, a smaller frame on CPU
+    attn = Attention(query_dim=320, heads=8, dim_head=40).to(device).eval()
+    with torch.no_grad():
+        for grid_size in [2, 3, 4]:
+            latent_size = (grid_size * frame_size, grid_size * frame_size)
+            hidden_states = torch.randn(2, latent_size[0] * latent_size[1], 320, device=device)
+            layout = GridLayout(grid_size, latent_size)
+            t_full = timeit(AttnProcessor2_0(), attn, hidden_states)
+            t_sparse = timeit(FrameAnchorAttnProcessor(layout), attn, hidden_states)
+            tokens = hidden_states.shape[0] * hidden_states.shape[1]
+            print(f'{grid_size}x{grid_size} grid, {hidden_states.shape[1]} tokens: AttnProcessor2_0 {tokens/t_full:.0f} tokens/s, FrameAnchorAttnProcessor {tokens/t_sparse:.0f} tokens/s ({t_full/t_sparse:.1f}x)')
+
+
+def benchmark_preview_decoder():
+    # decode throughput on CPU, the SD VAE decoder against the tiny preview decoder
+    from diffusers import AutoencoderKL
+    from utils.taesd import TinyDecoder
+
+    torch.set_grad_enabled(False)
+    vae = AutoencoderKL(block_out_channels=(128, 256, 512, 512), layers_per_block=2, latent_channels=4,
+                        down_block_types=('DownEncoderBlock2D',) * 4, up_block_types=('UpDecoderBlock2D',) * 4).eval()
+    tiny_decoder = TinyDecoder().eval()
+    for latent_size in [32, 64]:
+        latents = torch.randn(1, 4, latent_size, latent_size)
+        t_vae = timeit(lambda x: vae.decode(x, return_dict=False), latents, repeat=3)
+        t_tiny = timeit(tiny_decoder, latents, repeat=3)
+        print(f'{latent_size * 8}x{latent_size * 8}: AutoencoderKL {1 / t_vae:.2f} images/s, TinyDecoder {1 / t_tiny:.2f} images/s ({t_vae / t_tiny:.1f}x)')
+
+
+def synthetic_body_maps(num_people, height=368, width=368, distractors=3, seed=0):
+    """
+    Peaks and PAFs of num_people random skeletons (plus distractor peaks per part), in the layout of Body.find_peaks
+    """
+    from annotator.openpose.body import limbSeq, mapIdx
+
+    rng = np.random.default_rng(seed)
+    paf_avg = rng.normal(0, 0.02, (height, width, 38))
+    keypoints = rng.integers(8, [width - 8, height - 8], size=(num_people, 18, 2))
+    y, x = np.mgrid[0:height, 0:width]
+    for person in keypoints:
+        for (a, b), (ix, iy) in zip(limbSeq, mapIdx):
+            start, vec = person[a - 1], person[b - 1] - person[a - 1]
+            norm = max(np.hypot(*vec), 1e-3)
+            along = ((x - start[0]) * vec[0] + (y - start[1]) * vec[1]) / norm
+            across = np.abs((x - start[0]) * vec[1] - (y - start[1]) * vec[0]) / norm
+            limb = (along >= 0) & (along <= norm) & (across < 4)
+            paf_avg[limb, ix - 19] = vec[0] / norm
+            paf_avg[limb, iy - 19] = vec[1] / norm
+
+    all_peaks, peak_counter = [], 0
+    for part in range(18):
+        points = np.concatenate([keypoints[:, part], rng.integers(0, [width, height], size=(distractors, 2))])
+        all_peaks.append([(px, py, rng.random(), peak_counter + i) for i, (px, py) in enumerate(points)])
+        peak_counter += len(points)
+    return all_peaks, paf_avg
+
+
+def benchmark_body():
+    # OpenPose body limb scoring and person assembly, the reference loops against the vectorized functions
+    from annotator.openpose.body import connect_limbs_loop, assemble_people_loop, connect_limbs, assemble_people
+
+    def estimate(connect, assemble, all_peaks, paf_avg):
+        connection_all, special_k = connect(all_peaks, paf_avg, paf_avg.shape[0])
+        return assemble(all_peaks, connection_all, special_k)
+
+    for num_people in [1, 5, 10, 20]:
+        all_peaks, paf_avg = synthetic_body_maps(num_people)
+        outputs = [estimate(connect_limbs_loop, assemble_people_loop, all_peaks, paf_avg), estimate(connect_limbs, assemble_people, all_peaks, paf_avg)]
+        identical = all(a.shape == b.shape and a.tobytes() == b.tobytes() for a, b in zip(*outputs))
+        t_loop = timeit(estimate, connect_limbs_loop, assemble_people_loop, all_peaks, paf_avg, repeat=3)
+        t_vectorized = timeit(estimate, connect_limbs, assemble_people, all_peaks, paf_avg, repeat=3)
+        print(f'{num_people} people: loops {t_loop * 1000:.1f} ms, vectorized {t_vectorized * 1000:.1f} ms ({t_loop / t_vectorized:.1f}x), identical: {identical}')
+
+
+def benchmark_body_peaks():
+    # OpenPose body estimation with the peaks found on the host (cv2/scipy) against peaks_on_device (random weights)
+    import os
+    import tempfile
+    from annotator.openpose.body import Body, bodypose_model
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # random weights in the layout of body_pose_model.pth, whose keys lack the block name
+        model_path = os.path.join(tmp_dir, 'body_pose_model.pth')
+        torch.save({key.split('.', 1)[1]: value for key, value in bodypose_model().state_dict().items()}, model_path)
+        estimators = [Body(model_path, peaks_on_device=peaks_on_device) for peaks_on_device in [False, True]]
+    for estimator in estimators:
+        estimator.model.to(device)
+        estimator.cn_device = device
+
+    rng = np.random.default_rng(0)
+    for size in [256, 512]:
+        image = rng.integers(0, 256, (size, size, 3), dtype=np.uint8)
+        t_host, t_device = [timeit(estimator, image, repeat=3) for estimator in estimators]
+        print(f'{size}x{size}: host peaks {t_host * 1000:.1f} ms, peaks_on_device {t_device * 1000:.1f} ms ({t_host / t_device:.1f}x)')
+
+
+benchmarks = {
+    'shuffle': benchmark_shuffle,
+    'attention': benchmark_attention,
+    'preview_decoder': benchmark_preview_decoder,
+    'body': benchmark_body,
+    'body_peaks': benchmark_body_peaks,
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Runs one of the micro-benchmarks')
+    parser.add_argument('name', choices=list(benchmarks.keys()))
+    benchmarks[parser.parse_args().name]()
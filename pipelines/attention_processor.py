@@ -2,6 +2,47 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from collections import OrderedDict
+
+
+class CrossAttnKVCache:
+    r"""
+    Cache of cross-attention key/value projections shared by the attention processors of a pipeline.
+    Entries are keyed by the attention layer and the identity of the `encoder_hidden_states` tensor; the tensor is kept
+    alive by its entry and its in-place version is checked, so a hit always sees the same values. A pipeline that feeds
+    the same embedding tensor to every denoising step projects it once per layer, and calls `invalidate` when its
+    embeddings change.
+    Args:
+        max_entries (`int`, defaults to 256):
+            The number of (layer, embedding) entries kept, least recently used first out.
+    """
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def get(self, attn, encoder_hidden_states, project):
+        if torch.is_grad_enabled():
+            return project()
+        key = (id(attn), id(encoder_hidden_states), torch.is_autocast_enabled())
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] is encoder_hidden_states and entry[1] == encoder_hidden_states._version:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+        self.misses += 1
+        projections = project()
+        self._entries[key] = (encoder_hidden_states, encoder_hidden_states._version, projections)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return projections
+
+    def invalidate(self):
+        self._entries.clear()
 
 
 class AttnProcessor(nn.Module):
@@ -93,17 +134,39 @@ class IPAttnProcessor(nn.Module):
             The context length of the image features.
     """
 
-    def __init__(self, hidden_size, cross_attention_dim=None, scale=1.0, num_tokens=4):
+    def __init__(self, hidden_size, cross_attention_dim=None, scale=1.0, num_tokens=4, kv_cache=None):
         super().__init__()
 
         self.hidden_size = hidden_size
         self.cross_attention_dim = cross_attention_dim
         self.scale = scale
         self.num_tokens = num_tokens
+        self.kv_cache = kv_cache
+        # set by register_cross_attention_hook, maps are only computed while a recorder is attached
+        self.attn_recorder = None
+        self.layer_name = None
 
         self.to_k_ip = nn.Linear(cross_attention_dim or hidden_size, hidden_size, bias=False)
         self.to_v_ip = nn.Linear(cross_attention_dim or hidden_size, hidden_size, bias=False)
 
+    def project_kv(self, attn, encoder_hidden_states):
+        # get encoder_hidden_states, ip_hidden_states
+        end_pos = encoder_hidden_states.shape[1] - self.num_tokens
+        encoder_hidden_states, ip_hidden_states = (
+            encoder_hidden_states[:, :end_pos, :],
+            encoder_hidden_states[:, end_pos:, :],
+        )
+        if attn.norm_cross:
+            encoder_hidden_states = attn.norm_encoder_hidden_states(encoder_hidden_states)
+
+        key = attn.head_to_batch_dim(attn.to_k(encoder_hidden_states))
+        value = attn.head_to_batch_dim(attn.to_v(encoder_hidden_states))
+
+        # for ip-adapter
+        ip_key = attn.head_to_batch_dim(self.to_k_ip(ip_hidden_states))
+        ip_value = attn.head_to_batch_dim(self.to_v_ip(ip_hidden_states))
+        return key, value, ip_key, ip_value
+
     def __call__(
         self,
         attn,
@@ -137,36 +200,20 @@ class IPAttnProcessor(nn.Module):
 
         if encoder_hidden_states is None:
             encoder_hidden_states = hidden_states
-        else:
-            # get encoder_hidden_states, ip_hidden_states
-            end_pos = encoder_hidden_states.shape[1] - self.num_tokens
-            encoder_hidden_states, ip_hidden_states = (
-                encoder_hidden_states[:, :end_pos, :],
-                encoder_hidden_states[:, end_pos:, :],
-            )
-            if attn.norm_cross:
-                encoder_hidden_states = attn.norm_encoder_hidden_states(encoder_hidden_states)
-
-        key = attn.to_k(encoder_hidden_states)
-        value = attn.to_v(encoder_hidden_states)
+        # the text and image-prompt tokens are the same for every step, their projections come from the K/V cache
+        project = lambda: self.project_kv(attn, encoder_hidden_states)
+        key, value, ip_key, ip_value = project() if self.kv_cache is None else self.kv_cache.get(attn, encoder_hidden_states, project)
 
         query = attn.head_to_batch_dim(query)
-        key = attn.head_to_batch_dim(key)
-        value = attn.head_to_batch_dim(value)
 
         attention_probs = attn.get_attention_scores(query, key, attention_mask)
         hidden_states = torch.bmm(attention_probs, value)
         hidden_states = attn.batch_to_head_dim(hidden_states)
 
         # for ip-adapter
-        ip_key = self.to_k_ip(ip_hidden_states)
-        ip_value = self.to_v_ip(ip_hidden_states)
-
-        ip_key = attn.head_to_batch_dim(ip_key)
-        ip_value = attn.head_to_batch_dim(ip_value)
-
         ip_attention_probs = attn.get_attention_scores(query, ip_key, None)
-        self.attn_map = ip_attention_probs
+        if self.attn_recorder is not None and self.attn_recorder.wants(self.layer_name):
+            self.attn_recorder.record(ip_attention_probs, batch_size)
         ip_hidden_states = torch.bmm(ip_attention_probs, ip_value)
         ip_hidden_states = attn.batch_to_head_dim(ip_hidden_states)
 
@@ -279,6 +326,411 @@ class AttnProcessor2_0(torch.nn.Module):
         return hidden_states
 
 
+def chunked_attention(query, key, value, scale, chunk_size, attention_mask=None):
+    r"""
+    Exact softmax attention over (batch, heads, tokens, head_dim) tensors, computed chunk_size queries x chunk_size keys
+    at a time with an online softmax (running max and normaliser per query), so peak memory does not depend on the
+    number of tokens squared.
+    """
+    hidden_states = torch.empty_like(query)
+    for q_start in range(0, query.shape[2], chunk_size):
+        q_chunk = query[:, :, q_start:q_start + chunk_size].float() * scale
+        running_max = torch.full((*q_chunk.shape[:-1], 1), float("-inf"), device=query.device)
+        normaliser = torch.zeros_like(running_max)
+        acc = torch.zeros_like(q_chunk)
+        for k_start in range(0, key.shape[2], chunk_size):
+            scores = q_chunk @ key[:, :, k_start:k_start + chunk_size].float().transpose(-1, -2)
+            if attention_mask is not None:
+                mask = attention_mask[..., k_start:k_start + chunk_size]
+                if mask.shape[-2] > 1:
+                    mask = mask[..., q_start:q_start + chunk_size, :]
+                scores = scores + mask
+            new_max = torch.maximum(running_max, scores.amax(dim=-1, keepdim=True))
+            probs = torch.exp(scores - new_max)
+            correction = torch.exp(running_max - new_max)
+            normaliser = normaliser * correction + probs.sum(dim=-1, keepdim=True)
+            acc = acc * correction + probs @ value[:, :, k_start:k_start + chunk_size].float()
+            running_max = new_max
+        hidden_states[:, :, q_start:q_start + chunk_size] = (acc / normaliser).to(query.dtype)
+    return hidden_states
+
+
+class ChunkedAttnProcessor:
+    r"""
+    Memory-bounded processor for the self-attention (attn1) layers of large grids.
+    Gives the same result as `AttnProcessor2_0`, but never materialises more than chunk_size x chunk_size scores per head.
+    Args:
+        chunk_size (`int`, defaults to 1024):
+            The number of query and key tokens processed together.
+    """
+
+    def __init__(self, chunk_size=1024):
+        self.chunk_size = chunk_size
+
+    def __call__(
+        self,
+        attn,
+        hidden_states,
+        encoder_hidden_states=None,
+        attention_mask=None,
+        temb=None,
+        *args,
+        **kwargs,
+    ):
+        residual = hidden_states
+
+        if attn.spatial_norm is not None:
+            hidden_states = attn.spatial_norm(hidden_states, temb)
+
+        input_ndim = hidden_states.ndim
+
+        if input_ndim == 4:
+            batch_size, channel, height, width = hidden_states.shape
+            hidden_states = hidden_states.view(batch_size, channel, height * width).transpose(1, 2)
+
+        batch_size, sequence_length, _ = (
+            hidden_states.shape if encoder_hidden_states is None else encoder_hidden_states.shape
+        )
+
+        if attention_mask is not None:
+            attention_mask = attn.prepare_attention_mask(attention_mask, sequence_length, batch_size)
+            attention_mask = attention_mask.view(batch_size, attn.heads, -1, attention_mask.shape[-1])
+
+        if attn.group_norm is not None:
+            hidden_states = attn.group_norm(hidden_states.transpose(1, 2)).transpose(1, 2)
+
+        query = attn.to_q(hidden_states)
+
+        if encoder_hidden_states is None:
+            encoder_hidden_states = hidden_states
+        elif attn.norm_cross:
+            encoder_hidden_states = attn.norm_encoder_hidden_states(encoder_hidden_states)
+
+        key = attn.to_k(encoder_hidden_states)
+        value = attn.to_v(encoder_hidden_states)
+
+        inner_dim = key.shape[-1]
+        head_dim = inner_dim // attn.heads
+
+        query = query.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+        key = key.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+        value = value.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+
+        hidden_states = chunked_attention(query, key, value, attn.scale, self.chunk_size, attention_mask)
+
+        hidden_states = hidden_states.transpose(1, 2).reshape(batch_size, -1, attn.heads * head_dim)
+        hidden_states = hidden_states.to(query.dtype)
+
+        # linear proj
+        hidden_states = attn.to_out[0](hidden_states)
+        # dropout
+        hidden_states = attn.to_out[1](hidden_states)
+
+        if input_ndim == 4:
+            hidden_states = hidden_states.transpose(-1, -2).reshape(batch_size, channel, height, width)
+
+        if attn.residual_connection:
+            hidden_states = hidden_states + residual
+
+        hidden_states = hidden_states / attn.rescale_output_factor
+
+        return hidden_states
+
+
+class GridLayout:
+    r"""
+    Geometry of the RAVE grids shared by the pipeline with its grid-aware processors.
+    Args:
+        grid_size (`int`):
+            The number of frames along each side of a grid.
+        latent_size (`tuple`, defaults to None):
+            The (height, width) of the grid latents, set by the pipeline while it denoises grids, None otherwise.
+    """
+
+    def __init__(self, grid_size, latent_size=None):
+        self.grid_size = grid_size
+        self.latent_size = latent_size
+
+    def token_map_size(self, sequence_length):
+        # (height, width) of the token map of a UNet level, None when the inputs are not grid latents
+        if self.latent_size is None:
+            return None
+        latent_h, latent_w = self.latent_size
+        scale = int(round((latent_h * latent_w / sequence_length) ** 0.5))
+        if scale < 1:
+            return None
+        height, width = -(-latent_h // scale), -(-latent_w // scale)
+        if height * width != sequence_length:
+            return None
+        return height, width
+
+    def level_size(self, sequence_length):
+        # token_map_size, additionally None when the token map does not split into grid_size x grid_size frames
+        size = self.token_map_size(sequence_length)
+        if size is None or size[0] % self.grid_size != 0 or size[1] % self.grid_size != 0:
+            return None
+        return size
+
+
+class FrameAnchorAttnProcessor:
+    r"""
+    Sparse processor for the self-attention (attn1) layers of RAVE grids.
+    The tokens of each frame attend to their own frame plus anchor tokens, the keys and values of every frame of the grid
+    average-pooled over anchor_stride x anchor_stride windows, instead of to the whole grid. Inputs that are not grids of
+    the layout (e.g. the per-frame latents of the inversion) get full attention.
+    Args:
+        layout (`GridLayout`):
+            The grid geometry, updated by the pipeline.
+        anchor_stride (`int`, defaults to 4):
+            The pooling window of the anchor tokens, each frame contributes (h / anchor_stride) x (w / anchor_stride) anchors.
+    """
+
+    def __init__(self, layout, anchor_stride=4):
+        if not hasattr(F, "scaled_dot_product_attention"):
+            raise ImportError("FrameAnchorAttnProcessor requires PyTorch 2.0, to use it, please upgrade PyTorch to 2.0.")
+        self.layout = layout
+        self.anchor_stride = anchor_stride
+
+    def frame_anchor_attention(self, attn, query, key, value, height, width):
+        grid_size = self.layout.grid_size
+        batch_size, sequence_length, inner_dim = query.shape
+        head_dim = inner_dim // attn.heads
+        frame_h, frame_w = height // grid_size, width // grid_size
+        frame_number = grid_size * grid_size
+
+        def to_frames(x):
+            # batch x (grid_size * frame_h * grid_size * frame_w) x C -> (batch * frames) x frame_h x frame_w x C
+            x = x.view(batch_size, grid_size, frame_h, grid_size, frame_w, -1).permute(0, 1, 3, 2, 4, 5)
+            return x.reshape(batch_size * frame_number, frame_h, frame_w, -1)
+
+        def to_anchors(x):
+            # pooled tokens of all frames of a grid, repeated for every frame of that grid
+            anchors = F.avg_pool2d(x.permute(0, 3, 1, 2), self.anchor_stride, ceil_mode=True).flatten(2).transpose(1, 2)
+            anchors = anchors.reshape(batch_size, 1, -1, x.shape[-1]).expand(-1, frame_number, -1, -1)
+            return anchors.reshape(batch_size * frame_number, -1, x.shape[-1])
+
+        query, key, value = to_frames(query), to_frames(key), to_frames(value)
+        key = torch.cat([key.flatten(1, 2), to_anchors(key)], dim=1)
+        value = torch.cat([value.flatten(1, 2), to_anchors(value)], dim=1)
+        query = query.flatten(1, 2)
+
+        query = query.view(batch_size * frame_number, -1, attn.heads, head_dim).transpose(1, 2)
+        key = key.view(batch_size * frame_number, -1, attn.heads, head_dim).transpose(1, 2)
+        value = value.view(batch_size * frame_number, -1, attn.heads, head_dim).transpose(1, 2)
+
+        hidden_states = F.scaled_dot_product_attention(query, key, value, attn_mask=None, dropout_p=0.0, is_causal=False)
+
+        hidden_states = hidden_states.transpose(1, 2).reshape(batch_size, grid_size, grid_size, frame_h, frame_w, inner_dim)
+        return hidden_states.permute(0, 1, 3, 2, 4, 5).reshape(batch_size, sequence_length, inner_dim)
+
+    def __call__(
+        self,
+        attn,
+        hidden_states,
+        encoder_hidden_states=None,
+        attention_mask=None,
+        temb=None,
+        *args,
+        **kwargs,
+    ):
+        residual = hidden_states
+
+        if attn.spatial_norm is not None:
+            hidden_states = attn.spatial_norm(hidden_states, temb)
+
+        input_ndim = hidden_states.ndim
+
+        if input_ndim == 4:
+            batch_size, channel, height, width = hidden_states.shape
+            hidden_states = hidden_states.view(batch_size, channel, height * width).transpose(1, 2)
+
+        batch_size, sequence_length, _ = (
+            hidden_states.shape if encoder_hidden_states is None else encoder_hidden_states.shape
+        )
+
+        if attention_mask is not None:
+            attention_mask = attn.prepare_attention_mask(attention_mask, sequence_length, batch_size)
+            attention_mask = attention_mask.view(batch_size, attn.heads, -1, attention_mask.shape[-1])
+
+        if attn.group_norm is not None:
+            hidden_states = attn.group_norm(hidden_states.transpose(1, 2)).transpose(1, 2)
+
+        query = attn.to_q(hidden_states)
+
+        level_size = None
+        if encoder_hidden_states is None:
+            encoder_hidden_states = hidden_states
+            # only mask-free self-attention over grids of the layout is made sparse
+            if attention_mask is None:
+                level_size = self.layout.level_size(sequence_length)
+        elif attn.norm_cross:
+            encoder_hidden_states = attn.norm_encoder_hidden_states(encoder_hidden_states)
+
+        key = attn.to_k(encoder_hidden_states)
+        value = attn.to_v(encoder_hidden_states)
+
+        inner_dim = key.shape[-1]
+        head_dim = inner_dim // attn.heads
+
+        if level_size is not None:
+            hidden_states = self.frame_anchor_attention(attn, query, key, value, *level_size)
+        else:
+            query = query.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+            key = key.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+            value = value.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+
+            hidden_states = F.scaled_dot_product_attention(
+                query, key, value, attn_mask=attention_mask, dropout_p=0.0, is_causal=False
+            )
+            hidden_states = hidden_states.transpose(1, 2).reshape(batch_size, -1, attn.heads * head_dim)
+        hidden_states = hidden_states.to(query.dtype)
+
+        # linear proj
+        hidden_states = attn.to_out[0](hidden_states)
+        # dropout
+        hidden_states = attn.to_out[1](hidden_states)
+
+        if input_ndim == 4:
+            hidden_states = hidden_states.transpose(-1, -2).reshape(batch_size, channel, height, width)
+
+        if attn.residual_connection:
+            hidden_states = hidden_states + residual
+
+        hidden_states = hidden_states / attn.rescale_output_factor
+
+        return hidden_states
+
+
+def bipartite_soft_matching(metric, height, width, ratio, chunk_size=4096):
+    r"""
+    ToMe bipartite matching over a height x width token map (batch x tokens x C).
+    The first token of every 2x2 window is a destination, every other token a source; the int(tokens * ratio) sources
+    most similar to a destination (cosine similarity, anywhere in the map) are averaged into it. Destinations are picked
+    deterministically so the global random state, and with it the seeded sampling, is untouched.
+    Returns the merge and unmerge functions.
+    """
+    batch_size, sequence_length, _ = metric.shape
+    window_h, window_w = height // 2, width // 2
+
+    with torch.no_grad():
+        idx_buffer = torch.zeros(window_h, window_w, 4, device=metric.device, dtype=torch.int64)
+        idx_buffer[..., 0] = -1
+        idx_buffer = idx_buffer.view(window_h, window_w, 2, 2).transpose(1, 2).reshape(window_h * 2, window_w * 2)
+        if window_h * 2 < height or window_w * 2 < width:
+            # odd rows / columns left over by the windows are sources
+            idx_buffer = F.pad(idx_buffer, (0, width - window_w * 2, 0, height - window_h * 2))
+        rand_idx = idx_buffer.reshape(1, -1, 1).argsort(dim=1)
+
+        num_dst = window_h * window_w
+        a_idx = rand_idx[:, num_dst:, :]  # src
+        b_idx = rand_idx[:, :num_dst, :]  # dst
+
+        def split(x):
+            channels = x.shape[-1]
+            src = torch.gather(x, dim=1, index=a_idx.expand(x.shape[0], sequence_length - num_dst, channels))
+            dst = torch.gather(x, dim=1, index=b_idx.expand(x.shape[0], num_dst, channels))
+            return src, dst
+
+        metric = metric / metric.norm(dim=-1, keepdim=True)
+        a, b = split(metric)
+        r = min(a.shape[1], int(sequence_length * ratio))
+
+        # best destination of every source, chunked so the source x destination scores never exist at once
+        node_max, node_idx = [], []
+        for start in range(0, a.shape[1], chunk_size):
+            chunk_max, chunk_idx = (a[:, start:start + chunk_size] @ b.transpose(-1, -2)).max(dim=-1)
+            node_max.append(chunk_max)
+            node_idx.append(chunk_idx)
+        node_max, node_idx = torch.cat(node_max, dim=1), torch.cat(node_idx, dim=1)
+        edge_idx = node_max.argsort(dim=-1, descending=True)[..., None]
+
+        unm_idx = edge_idx[..., r:, :]  # unmerged sources
+        src_idx = edge_idx[..., :r, :]  # merged sources
+        dst_idx = torch.gather(node_idx[..., None], dim=-2, index=src_idx)
+
+    def merge(x, mode="mean"):
+        src, dst = split(x)
+        n, t1, c = src.shape
+        unm = torch.gather(src, dim=-2, index=unm_idx.expand(n, t1 - r, c))
+        src = torch.gather(src, dim=-2, index=src_idx.expand(n, r, c))
+        dst = dst.scatter_reduce(-2, dst_idx.expand(n, r, c), src, reduce=mode)
+        return torch.cat([unm, dst], dim=1)
+
+    def unmerge(x):
+        unm_len = unm_idx.shape[1]
+        unm, dst = x[..., :unm_len, :], x[..., unm_len:, :]
+        n, _, c = unm.shape
+        src = torch.gather(dst, dim=-2, index=dst_idx.expand(n, r, c))
+
+        out = torch.zeros(n, sequence_length, c, device=x.device, dtype=x.dtype)
+        out.scatter_(dim=-2, index=b_idx.expand(n, num_dst, c), src=dst)
+        out.scatter_(dim=-2, index=torch.gather(a_idx.expand(n, a_idx.shape[1], 1), dim=1, index=unm_idx).expand(n, unm_len, c), src=unm)
+        out.scatter_(dim=-2, index=torch.gather(a_idx.expand(n, a_idx.shape[1], 1), dim=1, index=src_idx).expand(n, r, c), src=src)
+        return out
+
+    return merge, unmerge
+
+
+class TokenMerging:
+    r"""
+    Settings and sampling state shared by the `ToMeAttnProcessor`s of a pipeline.
+    Args:
+        layout (`GridLayout`):
+            The grid geometry, updated by the pipeline.
+        ratio (`float`, defaults to 0.5):
+            The fraction of the tokens of a layer merged away before its self-attention.
+        step_cutoff (`float`, defaults to 1.0):
+            The fraction of the sampling steps after which tokens are no longer merged, the last steps keep full detail.
+    """
+
+    def __init__(self, layout, ratio=0.5, step_cutoff=1.0):
+        self.layout = layout
+        self.ratio = ratio
+        self.step_cutoff = step_cutoff
+        # set by the pipeline for every sampling step, None outside sampling
+        self.sampling_percent = None
+
+    def is_active(self):
+        return self.ratio > 0 and self.sampling_percent is not None and self.sampling_percent < self.step_cutoff
+
+
+class ToMeAttnProcessor:
+    r"""
+    Token merging around a self-attention (attn1) processor: similar tokens are merged before `processor` runs and the
+    result is copied back to every merged token after, so attention runs over (1 - ratio) of the tokens.
+    Args:
+        processor:
+            The wrapped attn1 processor, one that does not depend on the grid's token map (`AttnProcessor`,
+            `AttnProcessor2_0`, `ChunkedAttnProcessor`); the merged tokens do not form a `GridLayout` token map.
+        token_merging (`TokenMerging`):
+            The shared settings and sampling state.
+    """
+
+    def __init__(self, processor, token_merging):
+        self.processor = processor
+        self.token_merging = token_merging
+
+    def __call__(
+        self,
+        attn,
+        hidden_states,
+        encoder_hidden_states=None,
+        attention_mask=None,
+        temb=None,
+        *args,
+        **kwargs,
+    ):
+        token_map_size = None
+        if self.token_merging.is_active() and hidden_states.ndim == 3 and encoder_hidden_states is None and attention_mask is None and not attn.residual_connection:
+            token_map_size = self.token_merging.layout.token_map_size(hidden_states.shape[1])
+        if token_map_size is None:
+            return self.processor(attn, hidden_states, encoder_hidden_states, attention_mask, temb, *args, **kwargs)
+
+        merge, unmerge = bipartite_soft_matching(hidden_states, *token_map_size, self.token_merging.ratio)
+        hidden_states = self.processor(attn, merge(hidden_states), encoder_hidden_states, attention_mask, temb, *args, **kwargs)
+        return unmerge(hidden_states)
+
+
 class IPAttnProcessor2_0(torch.nn.Module):
     r"""
     Attention processor for IP-Adapater for PyTorch 2.0.
@@ -293,7 +745,7 @@ class IPAttnProcessor2_0(torch.nn.Module):
             The context length of the image features.
     """
 
-    def __init__(self, hidden_size, cross_attention_dim=None, scale=1.0, num_tokens=4):
+    def __init__(self, hidden_size, cross_attention_dim=None, scale=1.0, num_tokens=4, kv_cache=None):
         super().__init__()
 
         if not hasattr(F, "scaled_dot_product_attention"):
@@ -303,10 +755,42 @@ class IPAttnProcessor2_0(torch.nn.Module):
         self.cross_attention_dim = cross_attention_dim
         self.scale = scale
         self.num_tokens = num_tokens
+        self.kv_cache = kv_cache
+        # set by register_cross_attention_hook, maps are only computed while a recorder is attached
+        self.attn_recorder = None
+        self.layer_name = None
 
         self.to_k_ip = nn.Linear(cross_attention_dim or hidden_size, hidden_size, bias=False)
         self.to_v_ip = nn.Linear(cross_attention_dim or hidden_size, hidden_size, bias=False)
 
+    def project_kv(self, attn, encoder_hidden_states):
+        batch_size = encoder_hidden_states.shape[0]
+        # get encoder_hidden_states, ip_hidden_states
+        end_pos = encoder_hidden_states.shape[1] - self.num_tokens
+        encoder_hidden_states, ip_hidden_states = (
+            encoder_hidden_states[:, :end_pos, :],
+            encoder_hidden_states[:, end_pos:, :],
+        )
+        if attn.norm_cross:
+            encoder_hidden_states = attn.norm_encoder_hidden_states(encoder_hidden_states)
+
+        key = attn.to_k(encoder_hidden_states)
+        value = attn.to_v(encoder_hidden_states)
+
+        inner_dim = key.shape[-1]
+        head_dim = inner_dim // attn.heads
+
+        key = key.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+        value = value.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+
+        # for ip-adapter
+        ip_key = self.to_k_ip(ip_hidden_states)
+        ip_value = self.to_v_ip(ip_hidden_states)
+
+        ip_key = ip_key.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+        ip_value = ip_value.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+        return key, value, ip_key, ip_value
+
     def __call__(
         self,
         attn,
@@ -345,27 +829,14 @@ class IPAttnProcessor2_0(torch.nn.Module):
 
         if encoder_hidden_states is None:
             encoder_hidden_states = hidden_states
-        else:
-            # get encoder_hidden_states, ip_hidden_states
-            end_pos = encoder_hidden_states.shape[1] - self.num_tokens
-            encoder_hidden_states, ip_hidden_states = (
-                encoder_hidden_states[:, :end_pos, :],
-                encoder_hidden_states[:, end_pos:, :],
-            )
-            if attn.norm_cross:
-                encoder_hidden_states = attn.norm_encoder_hidden_states(encoder_hidden_states)
+        # the text and image-prompt tokens are the same for every step, their projections come from the K/V cache
+        project = lambda: self.project_kv(attn, encoder_hidden_states)
+        key, value, ip_key, ip_value = project() if self.kv_cache is None else self.kv_cache.get(attn, encoder_hidden_states, project)
 
-        key = attn.to_k(encoder_hidden_states)
-        value = attn.to_v(encoder_hidden_states)
-
-        inner_dim = key.shape[-1]
-        head_dim = inner_dim // attn.heads
+        head_dim = key.shape[-1]
 
         query = query.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
 
-        key = key.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
-        value = value.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
-
         # the output of sdp = (batch, num_heads, seq_len, head_dim)
         # TODO: add support for attn.scale when we move to Torch 2.1
         hidden_states = F.scaled_dot_product_attention(
@@ -376,20 +847,13 @@ class IPAttnProcessor2_0(torch.nn.Module):
         hidden_states = hidden_states.to(query.dtype)
 
         # for ip-adapter
-        ip_key = self.to_k_ip(ip_hidden_states)
-        ip_value = self.to_v_ip(ip_hidden_states)
-
-        ip_key = ip_key.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
-        ip_value = ip_value.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
-
         # the output of sdp = (batch, num_heads, seq_len, head_dim)
         # TODO: add support for attn.scale when we move to Torch 2.1
         ip_hidden_states = F.scaled_dot_product_attention(
             query, ip_key, ip_value, attn_mask=None, dropout_p=0.0, is_causal=False
         )
-        with torch.no_grad():
-            self.attn_map = query @ ip_key.transpose(-2, -1).softmax(dim=-1)
-            #print(self.attn_map.shape)
+        if self.attn_recorder is not None and self.attn_recorder.wants(self.layer_name):
+            self.attn_recorder.record((query @ ip_key.transpose(-2, -1) * attn.scale).softmax(dim=-1), batch_size)
 
         ip_hidden_states = ip_hidden_states.transpose(1, 2).reshape(batch_size, -1, attn.heads * head_dim)
         ip_hidden_states = ip_hidden_states.to(query.dtype)
@@ -422,12 +886,29 @@ class CNAttnProcessor:
 
 ## for controlnet
 class CNAttnProcessor:
-    def __init__(self, num_tokens=4, device="cuda"):
+    def __init__(self, num_tokens=4, device="cuda", kv_cache=None):
         self.num_tokens = num_tokens
         self.device = device
+        self.kv_cache = kv_cache
         if not torch.cuda.is_available() and device == "cuda":
             raise RuntimeError("CUDA is not available. Please check your GPU setup.")
 
+    def project_kv(self, attn, encoder_hidden_states):
+        key = attn.to_k(encoder_hidden_states)
+        value = attn.to_v(encoder_hidden_states)
+
+        # Ensure intermediate tensors are on GPU
+        key = attn.head_to_batch_dim(key).to(self.device)
+        value = attn.head_to_batch_dim(value).to(self.device)
+        return key, value
+
+    def project_text_kv(self, attn, encoder_hidden_states):
+        end_pos = encoder_hidden_states.shape[1] - self.num_tokens
+        encoder_hidden_states = encoder_hidden_states[:, :end_pos]  # only use text
+        if attn.norm_cross:
+            encoder_hidden_states = attn.norm_encoder_hidden_states(encoder_hidden_states)
+        return self.project_kv(attn, encoder_hidden_states)
+
     def __call__(self, attn, hidden_states, encoder_hidden_states=None, attention_mask=None, temb=None, *args, **kwargs):
         # Ensure inputs are on GPU
         hidden_states = hidden_states.to(self.device)
@@ -460,20 +941,14 @@ class CNAttnProcessor:
         query = attn.to_q(hidden_states)
 
         if encoder_hidden_states is None:
-            encoder_hidden_states = hidden_states
+            key, value = self.project_kv(attn, hidden_states)
         else:
-            end_pos = encoder_hidden_states.shape[1] - self.num_tokens
-            encoder_hidden_states = encoder_hidden_states[:, :end_pos]  # only use text
-            if attn.norm_cross:
-                encoder_hidden_states = attn.norm_encoder_hidden_states(encoder_hidden_states)
-
-        key = attn.to_k(encoder_hidden_states)
-        value = attn.to_v(encoder_hidden_states)
+            # the text tokens are the same for every step, their projections come from the K/V cache
+            project = lambda: self.project_text_kv(attn, encoder_hidden_states)
+            key, value = project() if self.kv_cache is None else self.kv_cache.get(attn, encoder_hidden_states, project)
 
         # Ensure intermediate tensors are on GPU
         query = attn.head_to_batch_dim(query).to(self.device)
-        key = attn.head_to_batch_dim(key).to(self.device)
-        value = attn.head_to_batch_dim(value).to(self.device)
 
         attention_probs = attn.get_attention_scores(query, key, attention_mask)
         hidden_states = torch.bmm(attention_probs, value)
@@ -496,13 +971,34 @@ class CNAttnProcessor:
 
 
 class CNAttnProcessor2_0:
-    def __init__(self, num_tokens=4, device="cuda"):
+    def __init__(self, num_tokens=4, device="cuda", kv_cache=None):
         if not hasattr(F, "scaled_dot_product_attention"):
             raise ImportError("AttnProcessor2_0 requires PyTorch 2.0, to use it, please upgrade PyTorch to 2.0.")
         if not torch.cuda.is_available() and device == "cuda":
             raise RuntimeError("CUDA is not available. Please check your GPU setup.")
         self.num_tokens = num_tokens
         self.device = device
+        self.kv_cache = kv_cache
+
+    def project_kv(self, attn, encoder_hidden_states):
+        batch_size = encoder_hidden_states.shape[0]
+        key = attn.to_k(encoder_hidden_states)
+        value = attn.to_v(encoder_hidden_states)
+
+        inner_dim = key.shape[-1]
+        head_dim = inner_dim // attn.heads
+
+        # Ensure intermediate tensors are on GPU
+        key = key.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2).to(self.device)
+        value = value.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2).to(self.device)
+        return key, value
+
+    def project_text_kv(self, attn, encoder_hidden_states):
+        end_pos = encoder_hidden_states.shape[1] - self.num_tokens
+        encoder_hidden_states = encoder_hidden_states[:, :end_pos]  # only use text
+        if attn.norm_cross:
+            encoder_hidden_states = attn.norm_encoder_hidden_states(encoder_hidden_states)
+        return self.project_kv(attn, encoder_hidden_states)
 
     def __call__(self, attn, hidden_states, encoder_hidden_states=None, attention_mask=None, temb=None, *args, **kwargs):
         # Ensure inputs are on GPU
@@ -539,23 +1035,16 @@ class CNAttnProcessor2_0:
         query = attn.to_q(hidden_states)
 
         if encoder_hidden_states is None:
-            encoder_hidden_states = hidden_states
+            key, value = self.project_kv(attn, hidden_states)
         else:
-            end_pos = encoder_hidden_states.shape[1] - self.num_tokens
-            encoder_hidden_states = encoder_hidden_states[:, :end_pos]  # only use text
-            if attn.norm_cross:
-                encoder_hidden_states = attn.norm_encoder_hidden_states(encoder_hidden_states)
-
-        key = attn.to_k(encoder_hidden_states)
-        value = attn.to_v(encoder_hidden_states)
+            # the text tokens are the same for every step, their projections come from the K/V cache
+            project = lambda: self.project_text_kv(attn, encoder_hidden_states)
+            key, value = project() if self.kv_cache is None else self.kv_cache.get(attn, encoder_hidden_states, project)
 
-        inner_dim = key.shape[-1]
-        head_dim = inner_dim // attn.heads
+        head_dim = key.shape[-1]
 
         # Ensure intermediate tensors are on GPU
         query = query.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2).to(self.device)
-        key = key.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2).to(self.device)
-        value = value.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2).to(self.device)
 
         hidden_states = F.scaled_dot_product_attention(
             query, key, value, attn_mask=attention_mask, dropout_p=0.0, is_causal=False
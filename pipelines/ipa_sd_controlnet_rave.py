@@ -22,8 +22,18 @@ from PIL import Image
 import utils.feature_utils as fu
 import utils.preprocesser_utils as pu
 import utils.image_process_utils as ipu
-
-from .utils import is_torch2_available
+from utils.control_cache import ControlCache
+from utils.latent_store import LatentStore, interpolate_trajectory
+from utils.controlnet_cache import ControlNetResidualCache
+from utils.deep_cache import DeepCache
+from utils.cfg_policy import CFGPolicy
+from utils.samplers import get_scheduler, get_inverse_scheduler, permute_solver_state, inversion_key
+from utils.lora import load_lora_state_dict, fuse_lora
+from utils.batch_tuner import BatchTuner
+from utils.tiled_vae import FrameTiledVAE
+from utils.taesd import load_tiny_decoder
+
+from .utils import is_torch2_available, AttnMapRecorder, register_cross_attention_hook, CachedCondEmbedding
 
 if is_torch2_available():
     from .attention_processor import (
@@ -37,6 +47,7 @@ if is_torch2_available():
     )
 else:
     from .attention_processor import AttnProcessor, CNAttnProcessor, IPAttnProcessor
+from .attention_processor import CrossAttnKVCache, ChunkedAttnProcessor, FrameAnchorAttnProcessor, GridLayout, TokenMerging, ToMeAttnProcessor
 
 logging.set_verbosity_error()
 
@@ -99,9 +110,11 @@ class IPA_RAVE(nn.Module):
         self.unet = pipe.unet
 
         self.controlnet = pipe.controlnet
+        self.controlnet.controlnet_cond_embedding = CachedCondEmbedding(self.controlnet.controlnet_cond_embedding)
         self.scheduler_config = pipe.scheduler.config        
         
         self.set_ip_adapter()
+        self.lora = None
         self._prepare_control_image = pipe.prepare_control_image
         self.run_safety_checker = pipe.run_safety_checker
         
@@ -126,7 +139,8 @@ class IPA_RAVE(nn.Module):
         ).to(self.device, dtype=torch.float)
         return image_proj_model
 
-    def set_ip_adapter(self):
+    def set_ip_adapter(self, self_attn_processor=None):
+        self.kv_cache = CrossAttnKVCache()
         attn_procs = {}
         for name in self.unet.attn_processors.keys():
             cross_attention_dim = None if name.endswith("attn1.processor") else self.unet.config.cross_attention_dim
@@ -139,17 +153,65 @@ class IPA_RAVE(nn.Module):
                 block_id = int(name[len("down_blocks.")])
                 hidden_size = self.unet.config.block_out_channels[block_id]
             if cross_attention_dim is None:
-                attn_procs[name] = AttnProcessor()
+                attn_procs[name] = AttnProcessor() if self_attn_processor is None else self_attn_processor(name)
             else:
                 attn_procs[name] = IPAttnProcessor(
                     hidden_size=hidden_size,
                     cross_attention_dim=cross_attention_dim,
                     scale=1.0,
                     num_tokens=self.num_tokens,
+                    kv_cache=self.kv_cache,
                 ).to(self.device, dtype=torch.float)
         self.unet.set_attn_processor(attn_procs)
-        self.controlnet.set_attn_processor(CNAttnProcessor(num_tokens=self.num_tokens))
+        self.controlnet.set_attn_processor(CNAttnProcessor(num_tokens=self.num_tokens, device=self.device, kv_cache=self.kv_cache))
+
+
+    def set_lora(self, lora_path, lora_scale=1.0):
+        # the LoRA is fused into the unet weights next to the IP-adapter processors, a different LoRA or scale unfuses the previous one first
+        lora = None if lora_path in (None, 'None') else (lora_path, lora_scale)
+        if lora == self.lora:
+            return
+        if self.lora is not None:
+            fuse_lora(self.unet, load_lora_state_dict(self.lora[0]), -self.lora[1])
+        if lora is not None:
+            fuse_lora(self.unet, load_lora_state_dict(lora[0]), lora[1])
+        self.lora = lora
+        self.kv_cache.invalidate()
+
+    def set_self_attn_processor(self, self_attn_processor=None):
+        # swaps the attn1 processors only, the IP-adapter processors keep their loaded weights
+        # self_attn_processor maps a processor name to a new processor, None restores the default one
+        attn_procs = {}
+        for name, processor in self.unet.attn_processors.items():
+            if name.endswith("attn1.processor"):
+                attn_procs[name] = AttnProcessor() if self_attn_processor is None else self_attn_processor(name)
+            else:
+                attn_procs[name] = processor
+        self.unet.set_attn_processor(attn_procs)
 
+    def get_self_attn_processor(self, input_dict):
+        # attn1 processor factory for set_self_attn_processor, None keeps the default processor
+        self_attn_mode = input_dict['self_attn_mode']
+        if self_attn_mode == 'chunked':
+            base_processor = lambda name: ChunkedAttnProcessor(input_dict['attn_chunk_size'])
+        elif self_attn_mode == 'frame_anchor':
+            base_processor = lambda name: FrameAnchorAttnProcessor(self.grid_layout, input_dict['attn_anchor_stride'])
+        else:
+            assert self_attn_mode == 'full', f'unknown self_attn_mode {self_attn_mode}'
+            base_processor = None
+        if self.token_merging.ratio <= 0:
+            return base_processor
+        # the merged tokens no longer form the grid's token map, frame_anchor would silently fall back to full attention
+        assert self_attn_mode != 'frame_anchor', 'token merging (tome_ratio > 0) cannot be combined with self_attn_mode frame_anchor, use full or chunked'
+
+        # token merging wraps the attn1 processors of the layers named in tome_layers ('' for all)
+        tome_layers = [layer.strip() for layer in str(input_dict['tome_layers']).split(',') if layer.strip() != '']
+        def processor(name):
+            attn_processor = AttnProcessor() if base_processor is None else base_processor(name)
+            if len(tome_layers) == 0 or any(layer in name for layer in tome_layers):
+                return ToMeAttnProcessor(attn_processor, self.token_merging)
+            return attn_processor
+        return processor
 
     def load_ip_adapter(self):
         if os.path.splitext(self.ip_ckpt)[-1] == ".safetensors":
@@ -193,6 +255,20 @@ class IPA_RAVE(nn.Module):
         uncond_embeddings = self.text_encoder(uncond_input.input_ids.to(self.device))[0]
         return cond_embeddings, uncond_embeddings
 
+    def set_prompt_embeds(self, cond_embeddings, uncond_embeddings):
+        # the cross-attention K/V cache is keyed by embedding tensor identity, every change of embeddings has to go through here
+        self.cond_embeddings = cond_embeddings
+        self.uncond_embeddings = uncond_embeddings
+        self.txt_embeds = {}
+        self.kv_cache.invalidate()
+
+    def get_txt_embed(self, batch_size, branches=('uncond', 'cond')):
+        # one embedding tensor per chunk size and guidance branches, reused by every step so its K/V projections are computed once per layer
+        if (batch_size, branches) not in self.txt_embeds:
+            embeddings = {'uncond': self.uncond_embeddings, 'cond': self.cond_embeddings}
+            self.txt_embeds[(batch_size, branches)] = torch.cat([embeddings[branch] for branch in branches for _ in range(batch_size)])
+        return self.txt_embeds[(batch_size, branches)]
+
     @torch.no_grad()
     def prepare_control_image(self, control_pil, width, height):
         control_image = self._prepare_control_image(
@@ -207,11 +283,11 @@ class IPA_RAVE(nn.Module):
         return control_image
     
     @torch.no_grad()
-    def pred_controlnet_sampling(self, current_sampling_percent, latent_model_input, t, prompt_embeddings, control_image):
+    def pred_controlnet_sampling(self, current_sampling_percent, latent_model_input, t, prompt_embeddings, control_image, branches=('uncond', 'cond')):
         if (current_sampling_percent < self.controlnet_guidance_start or current_sampling_percent > self.controlnet_guidance_end):
             down_block_res_samples = None
             mid_block_res_sample = None
-        else:       
+        elif self.residual_cache.recompute:
             down_block_res_samples, mid_block_res_sample = self.controlnet(
                 latent_model_input,
                 t,
@@ -220,6 +296,13 @@ class IPA_RAVE(nn.Module):
                 controlnet_cond=control_image,
                 return_dict=False,
             )
+            self.residual_cache.store(down_block_res_samples, mid_block_res_sample, branches)
+        else:
+            down_block_res_samples, mid_block_res_sample = self.residual_cache.load(latent_model_input.shape[0] // len(branches), branches)
+        if self.deep_cache.enabled:
+            return self.deep_cache.unet_forward(self.unet, latent_model_input, t, prompt_embeddings,
+                                                down_block_additional_residuals=down_block_res_samples,
+                                                mid_block_additional_residual=mid_block_res_sample, branches=branches)
         noise_pred = self.unet(latent_model_input, t, encoder_hidden_states=prompt_embeddings,                    
                             down_block_additional_residuals=down_block_res_samples,
                             mid_block_additional_residual=mid_block_res_sample)['sample']
@@ -227,88 +310,116 @@ class IPA_RAVE(nn.Module):
     
     
     @torch.no_grad()
-    def denoising_step(self, latents, control_image, prompt_embeddings, t, guidance_scale, current_sampling_percent):
-        
-        latent_model_input = torch.cat([latents] * 2)
-        control_image = torch.cat([control_image] * 2)
-        latent_model_input = self.scheduler.scale_model_input(latent_model_input, t)
-
-
-        noise_pred = self.pred_controlnet_sampling(current_sampling_percent, latent_model_input, t, prompt_embeddings, control_image)
+    def predict_noise(self, latent_model_input, control_image, t, current_sampling_percent, branches):
+        # the chunk is repeated once per guidance branch and all branches run in one pass
+        self.cfg_policy.log_pass(latent_model_input.shape[0] * len(branches))
+        if self.attn_recorder is not None:
+            self.attn_recorder.set_branches(branches)
+        prompt_embeddings = self.get_txt_embed(latent_model_input.shape[0], branches)
+        latent_model_input = torch.cat([latent_model_input] * len(branches))
+        control_image = torch.cat([control_image] * len(branches))
+        return self.pred_controlnet_sampling(current_sampling_percent, latent_model_input, t, prompt_embeddings, control_image, branches)
 
-        noise_pred_uncond, noise_pred_text = noise_pred.chunk(2)
-        noise_pred = noise_pred_uncond + guidance_scale * (noise_pred_text - noise_pred_uncond)
+    @torch.no_grad()
+    def guided_noise_pred(self, latents, control_image, t, guidance_scale, current_sampling_percent):
+        latent_model_input = self.scheduler.scale_model_input(latents, t)
+        branches = self.cfg_policy.branches
+        uncond_batch_size = self.cfg_policy.uncond_batch_size
 
-        
-        latents = self.scheduler.step(noise_pred, t, latents)['prev_sample']
-        return latents
+        if len(branches) == 1:
+            noise_pred = self.predict_noise(latent_model_input, control_image, t, current_sampling_percent, branches)
+        else:
+            if 0 < uncond_batch_size < latents.shape[0]:
+                noise_pred_uncond = torch.cat([self.predict_noise(latent_split, control_split, t, current_sampling_percent, ('uncond',))
+                                               for latent_split, control_split in zip(latent_model_input.split(uncond_batch_size), control_image.split(uncond_batch_size))])
+                noise_pred_text = self.predict_noise(latent_model_input, control_image, t, current_sampling_percent, ('cond',))
+            else:
+                noise_pred_uncond, noise_pred_text = self.predict_noise(latent_model_input, control_image, t, current_sampling_percent, branches).chunk(2)
+            noise_pred = noise_pred_uncond + guidance_scale * (noise_pred_text - noise_pred_uncond)
+        return noise_pred
 
     @torch.no_grad()
     def image_prompt_process(self, image_prompt_pil):
-        depth_map = pu.pixel_perfect_process(np.array(image_prompt_pil, dtype='uint8'), self.preprocess_name)
+        depth_map = pu.pixel_perfect_process(np.array(image_prompt_pil, dtype='uint8'), self.preprocess_name, **self.preprocess_options)
         depth_img = PIL.Image.fromarray(depth_map.astype(np.uint8))
         return(depth_img)
     
     @torch.no_grad()
-    def preprocess_control_grid(self, image_pil):
-
-        list_of_image_pils = fu.pil_grid_to_frames(image_pil, grid_size=self.grid) # List[C, W, H] -> len = num_frames
-        list_of_pils = [pu.pixel_perfect_process(np.array(frame_pil, dtype='uint8'), self.preprocess_name) for frame_pil in list_of_image_pils]
-        control_images = np.array(list_of_pils, dtype='uint8')
-        control_img = ipu.create_grid_from_numpy(control_images, grid_size=self.grid)
-        control_img = PIL.Image.fromarray(control_img.astype(np.uint8))
-
-        return control_img
+    def preprocess_control_grids(self, image_pil_list):
+        # annotate the frames of every grid together so the preprocessor runs annotator_batch_size frames per forward pass,
+        # frames already annotated for this video (under any grid_size, pad or control combination) come from the control cache
+        list_of_image_pils = [frame_pil for image_pil in image_pil_list for frame_pil in fu.pil_grid_to_frames(image_pil, grid_size=self.grid)] # List[C, W, H] -> len = num_frames
+        frames = np.array([np.array(frame_pil, dtype='uint8') for frame_pil in list_of_image_pils], dtype='uint8')
+        control_images = self.control_cache.load_or_compute(pu.control_cache_name(self.preprocess_name, **self.preprocess_options), frames, self.frame_indices,
+                                                            lambda x: pu.pixel_perfect_process(x, self.preprocess_name, self.annotator_batch_size, **self.preprocess_options))
+        control_images = np.array(control_images, dtype='uint8')
+
+        control_pils = []
+        for i in range(len(image_pil_list)):
+            control_img = ipu.create_grid_from_numpy(control_images[i*self.grid_frame_number:(i+1)*self.grid_frame_number], grid_size=self.grid)
+            control_pils.append(PIL.Image.fromarray(control_img.astype(np.uint8)))
+        return control_pils
     
+    @torch.no_grad()
+    def embed_controls(self, controlnet, control_frames):
+        # the ControlNet conditioning embedding runs once per source frame, the ControlNet is then given the embedding;
+        # the embeddings are kept on the CPU and each batch is moved to the device when it is used
+        return torch.cat([controlnet.controlnet_cond_embedding(split).cpu() for split in control_frames.split(self.inv_batch_size, dim=0)], dim=0)
+
     @torch.no_grad()
     def shuffle_latents(self, latents, control_image, indices):
         rand_i = torch.randperm(self.total_frame_number).tolist()
         
-        latents_l, controls_l, randx = [], [], []
-        for j in range(self.sample_size):
-            rand_indices = rand_i[j*self.grid_frame_number:(j+1)*self.grid_frame_number]
-
-            latents_keyframe, _ = fu.prepare_key_grid_latents(latents, self.grid, self.grid, rand_indices)
-            control_keyframe, _ = fu.prepare_key_grid_latents(control_image, self.grid, self.grid, rand_indices)
-            latents_l.append(latents_keyframe)
-            controls_l.append(control_keyframe)
-            randx.extend(rand_indices)
-        rand_i = randx.copy()
-        latents = torch.cat(latents_l, dim=0)
-        control_image = torch.cat(controls_l, dim=0)
+        latents = fu.permute_grids(latents, self.grid, rand_i)
+        control_image = fu.permute_grids(control_image, self.grid, rand_i)
+        self.control_embeds = fu.permute_grids(self.control_embeds, self.grid, rand_i)
+        self.residual_cache.permute(self.grid, rand_i)
+        self.deep_cache.permute(self.grid, rand_i)
+        permute_solver_state(self.scheduler, self.grid, rand_i)
         indices = [indices[i] for i in rand_i]
         return latents, indices, control_image
     
     @torch.no_grad()
     def batch_denoise(self, latents, control_image, indices, t, guidance_scale, current_sampling_percent):
-        latents_l, controls_l = [], []
+        noise_l, controls_l = [], []
         control_split = control_image.split(self.batch_size, dim=0)
+        control_embed_split = self.control_embeds.split(self.batch_size, dim=0)
         latents_split = latents.split(self.batch_size, dim=0)
         for idx in range(len(control_split)):
-            txt_embed = torch.cat([self.uncond_embeddings] * len(latents_split[idx]) + [self.cond_embeddings] * len(latents_split[idx])) 
-
-
-            latents = self.denoising_step(latents_split[idx], control_split[idx], txt_embed, t, guidance_scale, current_sampling_percent)
-            
-            latents_l.append(latents)
+            noise_l.append(self.guided_noise_pred(latents_split[idx], control_embed_split[idx].to(self.device), t, guidance_scale, current_sampling_percent))
             controls_l.append(control_split[idx])
-        latents = torch.cat(latents_l, dim=0)
+        # the solver steps all grids at once, multistep solvers keep their previous model outputs for the whole batch
+        latents = self.scheduler.step(torch.cat(noise_l, dim=0), t, latents)['prev_sample']
         controls = torch.cat(controls_l, dim=0)
         return latents, indices, controls
     
     @torch.no_grad()
     def reverse_diffusion(self, latents=None, control_image=None, guidance_scale=7.5, indices=None):
         self.scheduler.set_timesteps(self.num_inference_steps, device=self.device)
+        timesteps = self.scheduler.timesteps[self.sampling_start:]
+        self.grid_layout.latent_size = tuple(latents.shape[-2:])
+        self.cfg_policy.reset()
         with torch.autocast('cuda'):
-            for i, t in tqdm(enumerate(self.scheduler.timesteps), desc='reverse_diffusion'):
+            for i, t in tqdm(enumerate(timesteps, self.sampling_start), desc='reverse_diffusion', total=len(timesteps)):
                 indices = list(indices)
                 current_sampling_percent = i / len(self.scheduler.timesteps)
+                step_guidance_scale = self.cfg_policy.begin_step(i, current_sampling_percent, guidance_scale if self.cond_step_start < current_sampling_percent else 0.0)
+                if self.attn_recorder is not None:
+                    self.attn_recorder.set_step(i, latents.shape[-2:])
+                self.token_merging.sampling_percent = current_sampling_percent
                 if self.is_shuffle:
                     latents, indices, control_image = self.shuffle_latents(latents, control_image, indices)                    
-                if self.cond_step_start < current_sampling_percent:
-                    latents, indices, controls = self.batch_denoise(latents, control_image, indices, t, guidance_scale, current_sampling_percent)
-                else:
-                    latents, indices, controls = self.batch_denoise(latents, control_image, indices, t, 0.0, current_sampling_percent)
+                self.residual_cache.begin_step(i, latents, self.cfg_policy.branches)
+                self.deep_cache.begin_step(i, latents, self.cfg_policy.branches)
+                latents, indices, controls = self.batch_denoise(latents, control_image, indices, t, step_guidance_scale, current_sampling_percent)
+                self.residual_cache.end_step()
+                self.deep_cache.end_step()
+                if self.snapshot_interval > 0 and (i + 1 - self.sampling_start) % self.snapshot_interval == 0:
+                    self.snapshots.append((i, self.order_grids(self.decode_latents_preview(latents), indices)))
+        if self.attn_recorder is not None:
+            self.attn_recorder.set_step(None)
+        self.grid_layout.latent_size = None
+        self.token_merging.sampling_percent = None
         return latents, indices, controls
 
     @torch.no_grad()
@@ -317,17 +428,26 @@ class IPA_RAVE(nn.Module):
         splits = img_torch.split(self.batch_size_vae, dim=0)
         for split in splits:
             image = 2 * split - 1
-            posterior = self.vae.encode(image).latent_dist
-            latents = posterior.mean * self.vae.config.scaling_factor
+            latents = self.vae.encode(image).latent_dist.mean if self.vae_tiler is None else self.vae_tiler.encode(image)
+            latents = latents * self.vae.config.scaling_factor
             latents_l.append(latents)
         return torch.cat(latents_l, dim=0)
 
+    @torch.no_grad()
+    def decode_latents_preview(self, latents):
+        # approximate decode with the tiny decoder for previews and snapshots, it takes the scaled latents
+        image_l = []
+        for split in latents.split(self.batch_size, dim=0):
+            image_l.append(self.preview_decoder(split.to(self.dtype)))
+        return torch.cat(image_l, dim=0)
+
     @torch.no_grad()
     def decode_latents(self, latents: torch.Tensor):
         image_l = []
         splits = latents.split(self.batch_size_vae, dim=0)
         for split in splits:
-            image = self.vae.decode(split / self.vae.config.scaling_factor, return_dict=False)[0]
+            split = split / self.vae.config.scaling_factor
+            image = self.vae.decode(split, return_dict=False)[0] if self.vae_tiler is None else self.vae_tiler.decode(split)
             image = (image / 2 + 0.5).clamp(0, 1)
             image_l.append(image)
         return torch.cat(image_l, dim=0)
@@ -355,100 +475,182 @@ class IPA_RAVE(nn.Module):
         return noise_pred
 
     @torch.no_grad()
-    def ddim_inversion(self, latents, control_batch, indices):
-        k = None
-        els = os.listdir(self.inverse_path) 
-        els = [el for el in els if el.endswith('.pt')]
+    def tune_batch_sizes(self, image_size):
+        # probes one sampling step (UNet+ControlNet on grids with both guidance branches), one inversion step (on frames)
+        # and one VAE encode/decode on inputs of the run's geometry, and sets the largest batch sizes that fit the budget
+        height, width = image_size
+        scale = 2 ** (len(self.vae.config.block_out_channels) - 1)
+        latent_shape = (self.unet.config.in_channels, height // scale, width // scale)
+        text_shape = (self.tokenizer.model_max_length, self.unet.config.cross_attention_dim)
+        grid_control = fu.frames_to_grid(self.control_frame_embeds[:self.grid_frame_number], self.grid).to(self.device)
+
+        def sampling_step(batch_size):
+            latents = torch.randn(2 * batch_size, *latent_shape, device=self.device, dtype=self.dtype)
+            embeds = torch.zeros(2 * batch_size, text_shape[0] + self.num_tokens, text_shape[1], device=self.device, dtype=self.dtype)
+            t = self.scheduler.timesteps[self.sampling_start]
+            with torch.autocast('cuda'):
+                down_block_res_samples, mid_block_res_sample = self.controlnet(latents, t, conditioning_scale=self.controlnet_conditioning_scale, encoder_hidden_states=embeds,
+                                                                               controlnet_cond=grid_control.repeat(2 * batch_size, 1, 1, 1), return_dict=False)
+                self.unet(latents, t, encoder_hidden_states=embeds, down_block_additional_residuals=down_block_res_samples, mid_block_additional_residual=mid_block_res_sample)
+
+        def inversion_step(batch_size):
+            latents = torch.randn(batch_size, latent_shape[0], latent_shape[1] // self.grid, latent_shape[2] // self.grid, device=self.device, dtype=self.dtype)
+            embeds = torch.zeros(batch_size, *text_shape, device=self.device, dtype=self.dtype)
+            self.inversion_noise_pred(latents, self.timesteps[0], embeds, self.control_frame_embeds[:1].to(self.device).repeat(batch_size, 1, 1, 1))
+
+        def vae_call(batch_size):
+            images = torch.rand(batch_size, 3, height, width, device=self.device, dtype=self.dtype)
+            if self.vae_tiler is None:
+                self.vae.decode(self.vae.encode(2 * images - 1).latent_dist.mean, return_dict=False)
+            else:
+                self.vae_tiler.decode(self.vae_tiler.encode(2 * images - 1))
 
-        for k,inv_path in enumerate(sorted(els, key=lambda x: int(x.split('.')[0]))):
-            latents[k] = torch.load(os.path.join(self.inverse_path, inv_path)).to(device=self.device)
+        self.batch_size = max(self.batch_tuner.tune('batch_size', sampling_step, self.sample_size), 1)
+        if self.is_ddim_inversion:
+            self.inv_batch_size = max(self.batch_tuner.tune('inv_batch_size', inversion_step, self.total_frame_number), 1)
+        self.batch_size_vae = self.batch_tuner.tune('batch_size_vae', vae_call, self.sample_size)
+        if self.batch_size_vae == 0 and self.vae_tiler is None:
+            # a whole grid does not fit through the VAE, tile it one frame per tile
+            self.vae_tiler = FrameTiledVAE(self.vae, self.grid_size, 1, self.vae_tile_overlap)
+            self.batch_size_vae = self.batch_tuner.tune('batch_size_vae_tiled', vae_call, self.sample_size)
+        self.batch_size_vae = max(self.batch_size_vae, 1)
+        # the probes' embedding tensors must not leave entries in the cross-attention K/V cache
+        self.kv_cache.invalidate()
 
-        self.inverse_scheduler = DDIMScheduler.from_config(self.scheduler_config)
-        self.inverse_scheduler.set_timesteps(self.num_inversion_step, device=self.device)
-        self.timesteps = reversed(self.inverse_scheduler.timesteps)
+    @torch.no_grad()
+    def encode_frames(self, img_batch):
+        # VAE latents are stored per source frame, only the grids holding a frame missing from the store are encoded
+        missing = self.latent_store.missing('vae', self.frame_indices)
+        grid_ids = sorted(set(i // self.grid_frame_number for i in missing))
+        if len(grid_ids) > 0:
+            latents = fu.grid_to_frames(self.encode_imgs(img_batch[grid_ids]), self.grid)
+            frame_indices = [self.frame_indices[g * self.grid_frame_number + k] for g in grid_ids for k in range(self.grid_frame_number)]
+            self.latent_store.write('vae', frame_indices, latents)
+        latents = self.latent_store.read('vae', self.frame_indices).to(device=self.device, dtype=self.dtype)
+        return fu.frames_to_grid(latents, self.grid)
 
-        if k == (latents.shape[0]-1):
-            return latents, indices, control_batch
-        inv_cond = torch.cat([self.inv_uncond_embeddings] * 1 + [self.inv_cond_embeddings] * 1)[1].unsqueeze(0)
-        for i, t in enumerate(tqdm(self.timesteps)):
-            
-            alpha_prod_t = self.inverse_scheduler.alphas_cumprod[t]
-            alpha_prod_t_prev = (self.inverse_scheduler.alphas_cumprod[self.timesteps[i - 1]] if i > 0 else self.inverse_scheduler.final_alpha_cumprod)
-            
-            if k is not None:
-                if len(latents[:k+1].shape) == 3:
-                    latents[:k+1] = latents[:k+1].unsqueeze(0)
-            latents_l = [] if k is None else [latents[:k+1]]
-            latents_split = latents.split(self.inv_batch_size, dim=0) if k is None else latents[k+1:].split(self.inv_batch_size, dim=0)
-            control_batch_split = control_batch.split(self.inv_batch_size, dim=0) if k is None else control_batch[k+1:].split(self.inv_batch_size, dim=0)
-            for idx in range(len(latents_split)):
-                cond_batch = inv_cond.repeat(latents_split[idx].shape[0], 1, 1)
-                latents = self.ddim_step(latents_split[idx], t, cond_batch, alpha_prod_t, alpha_prod_t_prev, control_batch_split[idx])
-                latents_l.append(latents)
-            latents = torch.cat(latents_l, dim=0)
-            
-        for k,i in enumerate(latents):
-            torch.save(i.detach().cpu(), f'{self.inverse_path}/{str(k).zfill(5)}.pt')        
+    @torch.no_grad()
+    def ddim_inversion(self, latents, control_batch, indices):
+        solver = None if isinstance(self.inverse_scheduler, DDIMScheduler) else self.inverse_scheduler
+        # the start latents are interpolated from the trajectory when inversion does not end on the sampling start level
+        keep_trajectory = self.keep_inversion_trajectory or self.inversion_levels[-1] != self.sampling_start_level
+
+        # frames already in the latent store are skipped, the rest is inverted chunk by chunk and stored as soon as a chunk finishes
+        missing = self.latent_store.missing('inverted', self.frame_indices)
+        if keep_trajectory:
+            missing = sorted(set(missing).union(self.latent_store.missing('trajectory', self.frame_indices)))
 
+        inv_cond = torch.cat([self.inv_uncond_embeddings] * 1 + [self.inv_cond_embeddings] * 1)[1].unsqueeze(0)
+        for start in tqdm(range(0, len(missing), self.inv_batch_size), desc='ddim_inversion'):
+            chunk = missing[start:start + self.inv_batch_size]
+            latent_frames = latents[chunk]
+            control_frames = self.control_frame_embeds[chunk].to(self.device)
+            cond_batch = inv_cond.repeat(len(chunk), 1, 1)
+            trajectory = []
+            if solver is not None:
+                # clears the model outputs kept from the previous chunk
+                solver.set_timesteps(self.num_inversion_step, device=self.device)
+            for i, t in enumerate(self.timesteps):
+                if solver is not None:
+                    eps = self.inversion_noise_pred(latent_frames, t, cond_batch, control_frames)
+                    latent_frames = solver.step(eps, t, latent_frames)['prev_sample']
+                    if keep_trajectory:
+                        trajectory.append(latent_frames.cpu())
+                    continue
+                alpha_prod_t = self.inverse_scheduler.alphas_cumprod[t]
+                alpha_prod_t_prev = (self.inverse_scheduler.alphas_cumprod[self.timesteps[i - 1]] if i > 0 else self.inverse_scheduler.final_alpha_cumprod)
+                latent_frames = self.ddim_step(latent_frames, t, cond_batch, alpha_prod_t, alpha_prod_t_prev, control_frames)
+                if keep_trajectory:
+                    trajectory.append(latent_frames.cpu())
+            chunk_frame_indices = [self.frame_indices[k] for k in chunk]
+            self.latent_store.write('inverted', chunk_frame_indices, latent_frames)
+            if keep_trajectory:
+                self.latent_store.write('trajectory', chunk_frame_indices, torch.stack(trajectory, dim=1))
+
+        if self.inversion_levels[-1] == self.sampling_start_level:
+            return self.latent_store.read('inverted', self.frame_indices).to(device=self.device, dtype=latents.dtype), indices, control_batch
+        # the clean latents are level 0 of the trajectory
+        trajectory = torch.cat([latents.float().cpu()[:, None], self.latent_store.read('trajectory', self.frame_indices)], dim=1)
+        latents = interpolate_trajectory(trajectory, [0] + self.inversion_levels, self.sampling_start_level).to(device=self.device, dtype=latents.dtype)
         return latents, indices, control_batch
     
    
+    def plan_schedules(self):
+        # sets the inversion timesteps, the noise level every inversion step ends on and the sampling step sampling starts from
+        # DDIM is inverted by ddim_step, the multistep solvers by their inverse scheduler
+        solver = get_inverse_scheduler(self.sampler, self.scheduler_config, self.solver_order)
+        self.inverse_scheduler = DDIMScheduler.from_config(self.scheduler_config) if solver is None else solver
+        self.inverse_scheduler.set_timesteps(self.num_inversion_step, device=self.device)
+        if self.sampler == 'lcm':
+            # DDIM inversion onto the consistency sampler's timesteps, so inversion ends where sampling starts
+            lcm_scheduler = get_scheduler('lcm', self.scheduler_config)
+            lcm_scheduler.set_timesteps(self.num_inversion_step, device=self.device)
+            timesteps = reversed(lcm_scheduler.timesteps)
+        else:
+            timesteps = reversed(self.inverse_scheduler.timesteps) if solver is None else self.inverse_scheduler.timesteps
+        # ddim_step ends on the timestep it is given, the inverse solver on the next one
+        levels = [int(t) for t in timesteps] if solver is None else [int(t) for t in timesteps[1:]] + [int(solver.noisiest_timestep)]
+
+        # SDEdit-style partial denoising: sampling_strength below 1 skips the noisiest sampling steps, and sampling never
+        # starts above the noisiest inverted level
+        sampling_timesteps = [int(t) for t in self.scheduler.timesteps]
+        start = min(int(round(len(sampling_timesteps) * (1 - self.sampling_strength))), len(sampling_timesteps) - 1)
+        if self.is_ddim_inversion:
+            while start < len(sampling_timesteps) - 1 and sampling_timesteps[start] > levels[-1]:
+                start += 1
+        self.sampling_start = start
+        self.sampling_start_level = sampling_timesteps[start]
+
+        # inversion stops at the first step reaching the sampling start level
+        num_steps = next((i + 1 for i, level in enumerate(levels) if level >= self.sampling_start_level), len(levels))
+        self.timesteps = timesteps[:num_steps]
+        self.inversion_levels = levels[:num_steps]
+
+    def inversion_noise_pred(self, latent_frames, t, cond_batch, control_batch):
+        if self.give_control_inversion:
+            return self.controlnet_pred(latent_frames, t, prompt_embed_input=cond_batch, controlnet_cond=control_batch)
+        return self.unet(latent_frames, t, encoder_hidden_states=cond_batch, return_dict=False)[0]
+
     def ddim_step(self, latent_frames, t, cond_batch, alpha_prod_t, alpha_prod_t_prev, control_batch):
         mu = alpha_prod_t ** 0.5
         mu_prev = alpha_prod_t_prev ** 0.5
         sigma = (1 - alpha_prod_t) ** 0.5
         sigma_prev = (1 - alpha_prod_t_prev) ** 0.5
-        if self.give_control_inversion:
-            eps = self.controlnet_pred(latent_frames, t, prompt_embed_input=cond_batch, controlnet_cond=control_batch)
-        else:
-            eps = self.unet(latent_frames, t, encoder_hidden_states=cond_batch, return_dict=False)[0]
+        eps = self.inversion_noise_pred(latent_frames, t, cond_batch, control_batch)
         pred_x0 = (latent_frames - sigma_prev * eps) / mu_prev
         latent_frames = mu * pred_x0 + sigma * eps
         return latent_frames
     
 
     def process_image_batch(self, image_pil_list):
-        if len(os.listdir(self.controls_path)) > 0:
-            control_torch = torch.load(os.path.join(self.controls_path, 'control.pt')).to(self.device)
-            img_torch = torch.load(os.path.join(self.controls_path, 'img.pt')).to(self.device)
-        else:
-            image_torch_list = []
-            control_torch_list = []
-            for image_pil in image_pil_list:
-                width, height = image_pil.size
-                control_pil = self.preprocess_control_grid(image_pil)
-                control_image = self.prepare_control_image(control_pil, width, height)
-                control_torch_list.append(control_image)
-                image_torch_list.append(ipu.pil_img_to_torch_tensor(image_pil))
-            control_torch = torch.cat(control_torch_list, dim=0).to(self.device)
-            img_torch = torch.cat(image_torch_list, dim=0).to(self.device)
-            torch.save(control_torch, os.path.join(self.controls_path, 'control.pt'))
-            torch.save(img_torch, os.path.join(self.controls_path, 'img.pt'))
+        image_torch_list = []
+        control_torch_list = []
+        control_pil_list = self.preprocess_control_grids(image_pil_list)
+        for image_pil, control_pil in zip(image_pil_list, control_pil_list):
+            width, height = image_pil.size
+            control_image = self.prepare_control_image(control_pil, width, height)
+            control_torch_list.append(control_image)
+            image_torch_list.append(ipu.pil_img_to_torch_tensor(image_pil))
+        control_torch = torch.cat(control_torch_list, dim=0).to(self.device)
+        img_torch = torch.cat(image_torch_list, dim=0).to(self.device)
             
         return img_torch, control_torch
         
-    def order_grids(self, list_of_pils, indices):
-        k = []
-        for i in range(len(list_of_pils)):
-            k.extend(fu.pil_grid_to_frames(list_of_pils[i], self.grid))
-            
-        frames = [k[indices.index(i)] for i in np.arange(len(indices))]    
-        return frames
+    def order_grids(self, grids_torch, indices):
+        frames = fu.grid_to_frames(grids_torch, self.grid)
+        frames = frames.index_select(0, fu.inverse_permutation(indices).to(frames.device))
+        return ipu.torch_to_pil_img_batch(frames)
 
     @torch.no_grad()
     def __preprocess_inversion_input(self, init_latents, control_batch):
-        list_of_flattens = [fu.flatten_grid(el.unsqueeze(0), self.grid) for el in init_latents]
-        init_latents = torch.cat(list_of_flattens, dim=-1)
-        init_latents = torch.cat(torch.chunk(init_latents, self.total_frame_number, dim=-1), dim=0)
-        control_batch_flattens = [fu.flatten_grid(el.unsqueeze(0), self.grid) for el in control_batch]
-        control_batch = torch.cat(control_batch_flattens, dim=-1)
-        control_batch = torch.cat(torch.chunk(control_batch, self.total_frame_number, dim=-1), dim=0)
+        init_latents = fu.grid_to_frames(init_latents, self.grid)
+        control_batch = fu.grid_to_frames(control_batch, self.grid)
         return init_latents, control_batch
     
     @torch.no_grad()
     def __postprocess_inversion_input(self, latents_inverted, control_batch):
-            latents_inverted = torch.cat([fu.unflatten_grid(torch.cat([a for a in latents_inverted[i*self.grid_frame_number:(i+1)*self.grid_frame_number]], dim=-1).unsqueeze(0), self.grid) for i in range(self.sample_size)] , dim=0)
-            control_batch = torch.cat([fu.unflatten_grid(torch.cat([a for a in control_batch[i*self.grid_frame_number:(i+1)*self.grid_frame_number]], dim=-1).unsqueeze(0), self.grid) for i in range(self.sample_size)] , dim=0)
+            latents_inverted = fu.frames_to_grid(latents_inverted, self.grid)
+            control_batch = fu.frames_to_grid(control_batch, self.grid)
             return latents_inverted, control_batch
     
     
@@ -474,11 +676,35 @@ class IPA_RAVE(nn.Module):
         self.batch_size = input_dict['batch_size']
         self.inv_batch_size = self.batch_size * self.grid_size * self.grid_size
         self.batch_size_vae = input_dict['batch_size_vae']
+        self.vae_tile_overlap = input_dict['vae_tile_overlap']
+        self.vae_tiler = FrameTiledVAE(self.vae, self.grid_size, input_dict['vae_tile_frames'], self.vae_tile_overlap) if input_dict['vae_tile_frames'] > 0 else None
+        preview_decoder = input_dict['preview_decoder']
+        self.preview_decoder = None if preview_decoder in (None, 'None') else load_tiny_decoder(preview_decoder, self.device, self.dtype)
+        self.preview_only = input_dict['preview_only']
+        self.snapshot_interval = input_dict['snapshot_interval']
+        assert self.preview_decoder is not None or not (self.preview_only or self.snapshot_interval > 0), 'preview_only and snapshot_interval need a preview_decoder'
+        self.snapshots = []
+        self.annotator_batch_size = input_dict['annotator_batch_size']
+        self.preprocess_options = {'peaks_on_device': input_dict['openpose_peaks_on_device']}
+        self.batch_tuner = BatchTuner(self.device, None if input_dict['auto_batch_memory'] < 0 else input_dict['auto_batch_memory'] * 1024**2) if input_dict['auto_batch_size'] else None
         
         self.num_inference_steps = input_dict['num_inference_steps']
         self.num_inversion_step = input_dict['num_inversion_step']
-        self.inverse_path = input_dict['inverse_path']
-        self.controls_path = input_dict['control_path']
+        self.sampler = input_dict['sampler']
+        self.solver_order = input_dict['solver_order']
+        self.pad = input_dict['pad']
+        self.frame_indices = [i * self.pad for i in range(self.total_frame_number)]
+        self.control_cache = ControlCache(input_dict['control_path'], input_dict['video_path'])
+        self.keep_inversion_trajectory = input_dict['keep_inversion_trajectory']
+        self.sampling_strength = input_dict['sampling_strength']
+        self.attn_recorder = AttnMapRecorder.from_config(input_dict['attn_map_layers'], input_dict['attn_map_steps']) if input_dict['capture_attn_maps'] else None
+        register_cross_attention_hook(self.unet, self.attn_recorder)
+        self.grid_layout = GridLayout(self.grid_size)
+        self.token_merging = TokenMerging(self.grid_layout, input_dict['tome_ratio'], input_dict['tome_step_cutoff'])
+        self.residual_cache = ControlNetResidualCache(input_dict['controlnet_cache_policy'], input_dict['controlnet_cache_interval'], input_dict['controlnet_cache_threshold'])
+        self.deep_cache = DeepCache(input_dict['deep_cache_interval'])
+        self.cfg_policy = CFGPolicy.from_config(input_dict['cfg_interval'], input_dict['cfg_uncond_batch_size'])
+        self.set_self_attn_processor(self.get_self_attn_processor(input_dict))
 
         self.image_path = input_dict['image_path']
         self.clip_image_embeds = input_dict['clip_embeds']
@@ -501,10 +727,27 @@ class IPA_RAVE(nn.Module):
         img_prompt_tensor = img_prompt_tensor.to(self.device) 
         
         img_batch, control_batch = self.process_image_batch(input_dict['image_pil_list'])
-        init_latents_pre = self.encode_imgs(img_batch)
-        
-        self.scheduler = DDIMScheduler.from_config(self.scheduler_config)
+        self.control_frame_embeds = self.embed_controls(self.controlnet, fu.grid_to_frames(control_batch, self.grid))
+        self.set_lora(input_dict['lora_path'], input_dict['lora_scale'])
+        self.scheduler = get_scheduler(self.sampler, self.scheduler_config, self.solver_order)
         self.scheduler.set_timesteps(self.num_inference_steps, device=self.device)
+        self.plan_schedules()
+        if self.batch_tuner is not None:
+            self.tune_batch_sizes(img_batch.shape[-2:])
+        self.latent_store = LatentStore(input_dict['inverse_path'], input_dict['video_path'], {
+            'model': input_dict['hf_path'] if input_dict['model_id'] in (None, 'None') else input_dict['model_id'],
+            'resolution': input_dict['image_pil_list'][0].size,
+            'grid_size': self.grid_size,
+            'num_inversion_step': self.num_inversion_step,
+            'inversion_end_level': self.inversion_levels[-1],
+            'inversion_solver': inversion_key(self.sampler, self.solver_order),
+            'lora': self.lora,
+            'inversion_prompt': self.inversion_prompt,
+            'give_control_inversion': self.give_control_inversion,
+            'preprocess_name': pu.control_cache_name(self.preprocess_name, **self.preprocess_options) if self.give_control_inversion else None,
+        })
+        init_latents_pre = self.encode_frames(img_batch)
+        
         self.inv_cond_embeddings, self.inv_uncond_embeddings = self.get_text_embeds(self.inversion_prompt, "")
         if self.is_ddim_inversion:
             init_latents, control_batch = self.__preprocess_inversion_input(init_latents_pre, control_batch)
@@ -513,7 +756,7 @@ class IPA_RAVE(nn.Module):
         else:
             init_latents_pre = torch.cat([init_latents_pre], dim=0) 
             noise = torch.randn_like(init_latents_pre)
-            latents_inverted = self.scheduler.add_noise(init_latents_pre, noise, self.scheduler.timesteps[:1])
+            latents_inverted = self.scheduler.add_noise(init_latents_pre, noise, self.scheduler.timesteps[self.sampling_start:self.sampling_start + 1])
 
             
         control_pil_image = self.image_prompt_process(pil_img_prompt)
@@ -560,14 +803,16 @@ class IPA_RAVE(nn.Module):
                 prompt,
                 negative_prompt=negative_prompt,
             )
-            self.cond_embeddings = torch.cat([prompt_embeds_, image_prompt_embeds], dim=1)
-            self.uncond_embeddings = torch.cat([negative_prompt_embeds_, uncond_image_prompt_embeds], dim=1)
+            self.set_prompt_embeds(torch.cat([prompt_embeds_, image_prompt_embeds], dim=1), torch.cat([negative_prompt_embeds_, uncond_image_prompt_embeds], dim=1))
 
 
+        # sampling shuffles the embeddings as grids together with the latents
+        self.control_embeds = fu.frames_to_grid(self.control_frame_embeds, self.grid)
+        del self.control_frame_embeds
         latents_denoised, indices, controls = self.reverse_diffusion(latents_inverted, control_batch, self.guidance_scale, indices=indices)
     
-        image_torch = self.decode_latents(latents_denoised)
-        ordered_img_frames = self.order_grids(ipu.torch_to_pil_img_batch(image_torch), indices)
-        ordered_control_frames = self.order_grids(ipu.torch_to_pil_img_batch(controls), indices)
+        image_torch = self.decode_latents_preview(latents_denoised) if self.preview_only else self.decode_latents(latents_denoised)
+        ordered_img_frames = self.order_grids(image_torch, indices)
+        ordered_control_frames = self.order_grids(controls, indices)
         return ordered_img_frames, ordered_control_frames
     
@@ -5,61 +5,82 @@ import numpy as np
 from PIL import Image
 from einops import rearrange
 
-attn_maps = {}
-def hook_fn(name):
-    def forward_hook(module, input, output):
-        if hasattr(module.processor, "attn_map"):
-            attn_maps[name] = module.processor.attn_map
-            del module.processor.attn_map
-
-    return forward_hook
-
-def register_cross_attention_hook(unet):
-    for name, module in unet.named_modules():
-        if name.split('.')[-1].startswith('attn2'):
-            module.register_forward_hook(hook_fn(name))
-
+class AttnMapRecorder:
+    '''
+    Streaming aggregate of the IP-adapter cross-attention maps, attached to the processors by register_cross_attention_hook.
+    Only layers whose name contains one of layers and sampling steps listed in steps are recorded (None records all).
+    Every recorded map is averaged over heads, resized to latent_size // downscale and folded into one running mean per
+    classifier-free-guidance branch ('uncond', 'cond') the step runs, so memory does not grow with the number of layers,
+    steps or grids.
+    '''
+
+    def __init__(self, layers=None, steps=None, downscale=4):
+        self.layers = layers
+        self.steps = None if steps is None else set(steps)
+        self.downscale = downscale
+        self.step = None
+        self.latent_size = None
+        self.branches = ('uncond', 'cond')
+        self.reset()
+
+    @classmethod
+    def from_config(cls, layers, steps):
+        # config values are comma separated strings (lists in the config are grid searched), '' records everything
+        layers = [layer.strip() for layer in str(layers).split(',') if layer.strip() != '']
+        steps = [int(step) for step in str(steps).split(',') if step.strip() != '']
+        return cls(layers if len(layers) > 0 else None, steps if len(steps) > 0 else None)
+
+    def reset(self):
+        self.mean = {}
+        self.count = {}
+
+    def set_step(self, step, latent_size=None):
+        # step None stops recording (e.g. during inversion)
+        self.step = step
+        if latent_size is not None:
+            self.latent_size = tuple(latent_size)
+
+    def set_branches(self, branches):
+        # the guidance branches stacked in the next UNet pass, set per pass since a step may run them in separate passes
+        self.branches = branches
+
+    def wants(self, layer_name):
+        if self.step is None or (self.steps is not None and self.step not in self.steps):
+            return False
+        return self.layers is None or any(layer in layer_name for layer in self.layers)
+
+    @torch.no_grad()
+    def record(self, attention_probs, batch_size):
+        # attention_probs: (batch * heads) x HW x tokens or batch x heads x HW x tokens
+        probs = attention_probs.float().reshape(batch_size, -1, *attention_probs.shape[-2:]).mean(dim=1)
+        latent_h, latent_w = self.latent_size
+        scale = int(round((latent_h * latent_w / probs.shape[1]) ** 0.5))
+        h, w = -(-latent_h // scale), -(-latent_w // scale)
+        assert h * w == probs.shape[1], "attention map does not match the latent size"
+
+        maps = probs.permute(0, 2, 1).reshape(batch_size, -1, h, w)
+        maps = F.interpolate(maps, size=(latent_h // self.downscale, latent_w // self.downscale), mode='bilinear', align_corners=False)
+        for branch, branch_maps in zip(self.branches, maps.chunk(len(self.branches))):
+            branch_maps = branch_maps.mean(dim=0)
+            self.count[branch] = self.count.get(branch, 0) + 1
+            if branch not in self.mean:
+                self.mean[branch] = branch_maps
+            else:
+                self.mean[branch] += (branch_maps - self.mean[branch]) / self.count[branch]
+
+    def get_net_attn_map(self, image_size, instance_or_negative=False):
+        branch = 'uncond' if instance_or_negative else 'cond'
+        attn_map = F.interpolate(self.mean[branch][None], size=image_size, mode='bilinear', align_corners=False)[0]
+        return torch.softmax(attn_map, dim=0)
+
+def register_cross_attention_hook(unet, recorder):
+    # recorder None detaches a previously registered recorder
+    for name, processor in unet.attn_processors.items():
+        if hasattr(processor, 'attn_recorder'):
+            processor.attn_recorder = recorder
+            processor.layer_name = name[:-len('.processor')]
     return unet
 
-def upscale(attn_map, target_size):
-    attn_map = torch.mean(attn_map, dim=0)
-    attn_map = attn_map.permute(1,0)
-    temp_size = None
-
-    for i in range(0,5):
-        scale = 2 ** i
-        if ( target_size[0] // scale ) * ( target_size[1] // scale) == attn_map.shape[1]*64:
-            temp_size = (target_size[0]//(scale*8), target_size[1]//(scale*8))
-            break
-
-    assert temp_size is not None, "temp_size cannot is None"
-
-    attn_map = attn_map.view(attn_map.shape[0], *temp_size)
-
-    attn_map = F.interpolate(
-        attn_map.unsqueeze(0).to(dtype=torch.float32),
-        size=target_size,
-        mode='bilinear',
-        align_corners=False
-    )[0]
-
-    attn_map = torch.softmax(attn_map, dim=0)
-    return attn_map
-def get_net_attn_map(image_size, batch_size=2, instance_or_negative=False, detach=True):
-
-    idx = 0 if instance_or_negative else 1
-    net_attn_maps = []
-
-    for name, attn_map in attn_maps.items():
-        attn_map = attn_map.cpu() if detach else attn_map
-        attn_map = torch.chunk(attn_map, batch_size)[idx].squeeze()
-        attn_map = upscale(attn_map, image_size) 
-        net_attn_maps.append(attn_map) 
-
-    net_attn_maps = torch.mean(torch.stack(net_attn_maps,dim=0),dim=0)
-
-    return net_attn_maps
-
 def attnmaps2images(net_attn_maps):
 
     #total_attn_scores = 0
@@ -82,6 +103,20 @@ def attnmaps2images(net_attn_maps):
 def is_torch2_available():
     return hasattr(F, "scaled_dot_product_attention")
 
+class CachedCondEmbedding(torch.nn.Module):
+    """Stand-in for ControlNetModel.controlnet_cond_embedding that lets precomputed embeddings through"""
+
+    def __init__(self, cond_embedding, conditioning_channels=3):
+        super().__init__()
+        self.cond_embedding = cond_embedding
+        self.conditioning_channels = conditioning_channels
+
+    def forward(self, conditioning):
+        # control images are embedded as before, an embedding (conditioning_embedding_out_channels) skips the stem
+        if conditioning.shape[1] != self.conditioning_channels:
+            return conditioning
+        return self.cond_embedding(conditioning)
+
 class ImageProjModel(torch.nn.Module):
     """Projection Model"""
 
@@ -13,6 +13,9 @@ from pipelines.ipa_sd_multicontrolnet_rave import IPA_RAVE_MultiControlNet
 
 import utils.constants as const
 import utils.video_grid_utils as vgu
+import utils.preprocesser_utils as pu
+from pipelines.utils import attnmaps2images
+from utils.model_registry import model_registry
 
 import warnings
 warnings.filterwarnings("ignore")
@@ -46,8 +49,8 @@ def init_paths(input_ns):
     input_ns.image_encoder_path = "pretrained_models/IP_models/models/image_encoder/"
     input_ns.ip_ckpt = "pretrained_models/IP_models/models/ip-adapter_sd15.bin"
     
-    input_ns.inverse_path = f'{const.GENERATED_DATA_PATH}/inverses/{input_ns.video_name}/{input_ns.preprocess_name}_{input_ns.model_id}_{input_ns.grid_size}x{input_ns.grid_size}_{input_ns.pad}'
-    input_ns.control_path = f'{const.GENERATED_DATA_PATH}/controls/{input_ns.video_name}/{input_ns.preprocess_name}_{input_ns.grid_size}x{input_ns.grid_size}_{input_ns.pad}'
+    input_ns.inverse_path = f'{const.GENERATED_DATA_PATH}/inverses' # per-frame latents, keyed by video content and inversion parameters inside LatentStore
+    input_ns.control_path = f'{const.GENERATED_DATA_PATH}/controls' # per-frame control maps, keyed by video content inside ControlCache
     os.makedirs(input_ns.control_path, exist_ok=True)
     os.makedirs(input_ns.inverse_path, exist_ok=True)
     os.makedirs(input_ns.save_path, exist_ok=True)
@@ -58,6 +61,69 @@ def run(input_ns):
 
     if 'model_id' not in list(input_ns.__dict__.keys()):
         input_ns.model_id = "None"
+    if 'annotator_memory_budget' not in list(input_ns.__dict__.keys()):
+        input_ns.annotator_memory_budget = -1
+    if 'annotator_batch_size' not in list(input_ns.__dict__.keys()):
+        input_ns.annotator_batch_size = 8
+    if 'openpose_peaks_on_device' not in list(input_ns.__dict__.keys()):
+        input_ns.openpose_peaks_on_device = False
+    if 'keep_inversion_trajectory' not in list(input_ns.__dict__.keys()):
+        input_ns.keep_inversion_trajectory = False
+    if 'capture_attn_maps' not in list(input_ns.__dict__.keys()):
+        input_ns.capture_attn_maps = False
+    if 'attn_map_layers' not in list(input_ns.__dict__.keys()):
+        input_ns.attn_map_layers = ''
+    if 'attn_map_steps' not in list(input_ns.__dict__.keys()):
+        input_ns.attn_map_steps = ''
+    if 'self_attn_mode' not in list(input_ns.__dict__.keys()):
+        input_ns.self_attn_mode = 'full'
+    if 'attn_chunk_size' not in list(input_ns.__dict__.keys()):
+        input_ns.attn_chunk_size = 1024
+    if 'attn_anchor_stride' not in list(input_ns.__dict__.keys()):
+        input_ns.attn_anchor_stride = 4
+    if 'tome_ratio' not in list(input_ns.__dict__.keys()):
+        input_ns.tome_ratio = 0.0
+    if 'tome_layers' not in list(input_ns.__dict__.keys()):
+        input_ns.tome_layers = 'down_blocks.0,up_blocks.3'
+    if 'tome_step_cutoff' not in list(input_ns.__dict__.keys()):
+        input_ns.tome_step_cutoff = 1.0
+    if 'controlnet_cache_policy' not in list(input_ns.__dict__.keys()):
+        input_ns.controlnet_cache_policy = 'none'
+    if 'controlnet_cache_interval' not in list(input_ns.__dict__.keys()):
+        input_ns.controlnet_cache_interval = 2
+    if 'controlnet_cache_threshold' not in list(input_ns.__dict__.keys()):
+        input_ns.controlnet_cache_threshold = 0.05
+    if 'deep_cache_interval' not in list(input_ns.__dict__.keys()):
+        input_ns.deep_cache_interval = 1
+    if 'cfg_interval' not in list(input_ns.__dict__.keys()):
+        input_ns.cfg_interval = '0.0,1.0'
+    if 'cfg_uncond_batch_size' not in list(input_ns.__dict__.keys()):
+        input_ns.cfg_uncond_batch_size = 0
+    if 'sampler' not in list(input_ns.__dict__.keys()):
+        input_ns.sampler = 'ddim'
+    if 'solver_order' not in list(input_ns.__dict__.keys()):
+        input_ns.solver_order = 2
+    if 'lora_path' not in list(input_ns.__dict__.keys()):
+        input_ns.lora_path = None
+    if 'lora_scale' not in list(input_ns.__dict__.keys()):
+        input_ns.lora_scale = 1.0
+    if 'sampling_strength' not in list(input_ns.__dict__.keys()):
+        input_ns.sampling_strength = 1.0
+    if 'auto_batch_size' not in list(input_ns.__dict__.keys()):
+        input_ns.auto_batch_size = False
+    if 'auto_batch_memory' not in list(input_ns.__dict__.keys()):
+        input_ns.auto_batch_memory = -1
+    if 'vae_tile_frames' not in list(input_ns.__dict__.keys()):
+        input_ns.vae_tile_frames = 0
+    if 'vae_tile_overlap' not in list(input_ns.__dict__.keys()):
+        input_ns.vae_tile_overlap = 8
+    if 'preview_decoder' not in list(input_ns.__dict__.keys()):
+        input_ns.preview_decoder = 'None'
+    if 'preview_only' not in list(input_ns.__dict__.keys()):
+        input_ns.preview_only = False
+    if 'snapshot_interval' not in list(input_ns.__dict__.keys()):
+        input_ns.snapshot_interval = 0
+    model_registry.set_memory_budget(None if input_ns.annotator_memory_budget < 0 else input_ns.annotator_memory_budget * 1024**2)
     device = init_device()
     input_ns = init_paths(input_ns)
     input_ns.clip_embeds = None 
@@ -92,9 +158,27 @@ def run(input_ns):
     else:
         control_vid[0].save(f"{input_ns.save_path}/control_{save_name}.gif", save_all=True, append_images=control_vid[1:], optimize=False, loop=10000)
 
+    for step, snapshot_vid in CN.snapshots:
+        snapshot_vid[0].save(f"{input_ns.save_path}/snapshot_{save_name}_{str(step).zfill(3)}.gif", save_all=True, append_images=snapshot_vid[1:], optimize=False, loop=10000)
+
+    if CN.attn_recorder is not None and 'cond' in CN.attn_recorder.mean:
+        width, height = res_vid[0].size
+        for k, attn_img in enumerate(attnmaps2images(CN.attn_recorder.get_net_attn_map((height, width)))):
+            attn_img.save(f"{input_ns.save_path}/attn_{save_name}_{k}.png")
+
     yaml_dict['total_time'] = (end_time - start_time).total_seconds()
     yaml_dict['total_number_of_frames'] = len(res_vid)
     yaml_dict['sec_per_frame'] = yaml_dict['total_time']/yaml_dict['total_number_of_frames']
+    yaml_dict['controlnet_calls'] = CN.residual_cache.calls
+    yaml_dict['controlnet_calls_saved'] = CN.residual_cache.saved_calls
+    yaml_dict['unet_deep_calls'] = CN.deep_cache.calls
+    yaml_dict['unet_deep_calls_saved'] = CN.deep_cache.saved_calls
+    yaml_dict['cfg_telemetry'] = CN.cfg_policy.telemetry
+    tracking_stats = pu.pose_tracking_stats()
+    if tracking_stats is not None:
+        yaml_dict['pose_tracking_stats'] = tracking_stats
+    if CN.batch_tuner is not None:
+        yaml_dict['auto_batch_sizes'] = CN.batch_tuner.choices
     with open(f'{input_ns.save_path}/config.yaml', 'w') as yaml_file:
         yaml.dump(yaml_dict, yaml_file)
         
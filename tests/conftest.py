@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the tests import the repository's packages (utils, pipelines, annotator) the way run_experiment.py does
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
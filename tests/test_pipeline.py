@@ -0,0 +1,118 @@
+'''
+CPU tests of the guidance branches and the grid shuffle of the IPA_RAVE sampling loop on tiny random-weight models
+'''
+import pytest
+import torch
+
+import utils.feature_utils as fu
+from utils.cfg_policy import CFGPolicy
+from utils.controlnet_cache import ControlNetResidualCache
+from utils.deep_cache import DeepCache
+from utils.samplers import get_scheduler
+from pipelines.ipa_sd_controlnet_rave import IPA_RAVE
+from pipelines.attention_processor import GridLayout, TokenMerging
+from pipelines.utils import CachedCondEmbedding
+
+from test_samplers import tiny_models, scheduler_config
+
+num_tokens = 4
+
+
+@torch.no_grad()
+def tiny_pipeline(grid_size=1, sample_size=4, batch_size=2, sampler='ddim', cfg_interval='0.0,1.0', cfg_uncond_batch_size=0):
+    # the attributes init_models and __call__ set, with the tiny models in place of the pretrained ones
+    pipe = IPA_RAVE('cpu', None, None, num_tokens=num_tokens)
+    pipe.unet, pipe.controlnet = tiny_models()
+    # the zero convolutions of a fresh ControlNet would hide which control embeddings a grid is given
+    for name, param in pipe.controlnet.named_parameters():
+        if name.startswith(('controlnet_down_blocks', 'controlnet_mid_block', 'controlnet_cond_embedding.conv_out')):
+            param.copy_(torch.randn_like(param) * 0.1)
+    pipe.controlnet.controlnet_cond_embedding = CachedCondEmbedding(pipe.controlnet.controlnet_cond_embedding)
+    pipe.set_ip_adapter()
+    pipe.scheduler = get_scheduler(sampler, scheduler_config(), solver_order=3)
+
+    pipe.grid_size = grid_size
+    pipe.grid = [grid_size, grid_size]
+    pipe.total_frame_number = grid_size * grid_size * sample_size
+    pipe.batch_size = batch_size
+    pipe.inv_batch_size = batch_size * grid_size * grid_size
+    pipe.num_inference_steps = 4
+    pipe.sampling_start = 0
+    pipe.cond_step_start = 0.0
+    pipe.controlnet_guidance_start = 0.0
+    pipe.controlnet_guidance_end = 1.0
+    pipe.controlnet_conditioning_scale = 1.0
+    pipe.is_shuffle = False
+    pipe.snapshot_interval = 0
+    pipe.attn_recorder = None
+    pipe.grid_layout = GridLayout(grid_size)
+    pipe.token_merging = TokenMerging(pipe.grid_layout, 0.0)
+    pipe.residual_cache = ControlNetResidualCache('none')
+    pipe.deep_cache = DeepCache(1)
+    pipe.cfg_policy = CFGPolicy.from_config(cfg_interval, cfg_uncond_batch_size)
+
+    # text tokens followed by the image prompt tokens
+    pipe.set_prompt_embeds(torch.randn(1, 77 + num_tokens, 32), torch.randn(1, 77 + num_tokens, 32))
+    control_frames = torch.rand(pipe.total_frame_number, 3, 32, 32)
+    pipe.control_embeds = fu.frames_to_grid(pipe.embed_controls(pipe.controlnet, control_frames), pipe.grid)
+    return pipe
+
+
+@torch.no_grad()
+def full_cfg_reference(pipe, latents, control_embeds, t, guidance_scale):
+    # both branches of every grid in one ControlNet + UNet pass, combined with the given guidance scale
+    latent_model_input = torch.cat([pipe.scheduler.scale_model_input(latents, t)] * 2)
+    prompt_embeds = torch.cat([pipe.uncond_embeddings] * latents.shape[0] + [pipe.cond_embeddings] * latents.shape[0])
+    down_block_res_samples, mid_block_res_sample = pipe.controlnet(latent_model_input, t, encoder_hidden_states=prompt_embeds,
+                                                                   controlnet_cond=torch.cat([control_embeds] * 2),
+                                                                   conditioning_scale=pipe.controlnet_conditioning_scale, return_dict=False)
+    noise_pred = pipe.unet(latent_model_input, t, encoder_hidden_states=prompt_embeds, down_block_additional_residuals=down_block_res_samples,
+                           mid_block_additional_residual=mid_block_res_sample).sample
+    noise_pred_uncond, noise_pred_text = noise_pred.chunk(2)
+    return noise_pred_uncond + guidance_scale * (noise_pred_text - noise_pred_uncond)
+
+
+@pytest.mark.parametrize('guidance_scale, cfg_interval, cfg_uncond_batch_size, step_guidance_scale, branches, unet_passes', [
+    (7.5, '0.0,1.0', 0, 7.5, 'uncond,cond', 1),  # both branches in one pass
+    (0.0, '0.0,1.0', 0, 0.0, 'uncond', 1),  # unconditional branch only
+    (1.0, '0.0,1.0', 0, 1.0, 'cond', 1),  # conditional branch only
+    (7.5, '0.0,0.25', 0, 1.0, 'cond', 1),  # step outside cfg_interval
+    (7.5, '0.0,1.0', 1, 7.5, 'uncond,cond', 3),  # unconditional branch split into single grid passes
+])
+@torch.no_grad()
+def test_guidance_branches_match_full_cfg(guidance_scale, cfg_interval, cfg_uncond_batch_size, step_guidance_scale, branches, unet_passes):
+    pipe = tiny_pipeline(cfg_interval=cfg_interval, cfg_uncond_batch_size=cfg_uncond_batch_size)
+    pipe.scheduler.set_timesteps(pipe.num_inference_steps)
+    t = pipe.scheduler.timesteps[2]
+    latents = torch.randn(pipe.batch_size, 4, 16, 16)
+    control_embeds = pipe.control_embeds[:pipe.batch_size]
+
+    assert pipe.cfg_policy.begin_step(2, 0.5, guidance_scale) == step_guidance_scale
+    noise_pred = pipe.guided_noise_pred(latents, control_embeds, t, step_guidance_scale, 0.5)
+    expected = full_cfg_reference(pipe, latents, control_embeds, t, step_guidance_scale)
+
+    assert torch.allclose(noise_pred, expected, atol=1e-5)
+    telemetry = pipe.cfg_policy.telemetry[-1]
+    assert telemetry['branches'] == branches
+    assert telemetry['unet_passes'] == unet_passes
+    assert telemetry['unet_batch'] == pipe.batch_size * len(branches.split(','))
+
+
+@pytest.mark.parametrize('sampler', ['ddim', 'dpmsolver++'])
+@torch.no_grad()
+def test_reverse_diffusion_shuffle_restores_order(sampler):
+    # with one frame per grid every grid is denoised on its own, so shuffling the grids before every step (together with
+    # their control embeddings and the solver state) and restoring the frame order at the end gives the unshuffled result
+    torch.manual_seed(1)
+    start = torch.randn(4, 4, 16, 16)
+    results = []
+    for is_shuffle in [False, True]:
+        pipe = tiny_pipeline(sampler=sampler)
+        pipe.is_shuffle = is_shuffle
+        torch.manual_seed(2)
+        control_image = pipe.control_embeds.clone()
+        latents, indices, _ = pipe.reverse_diffusion(start, control_image, guidance_scale=7.5, indices=list(range(pipe.total_frame_number)))
+        if is_shuffle:
+            assert indices != list(range(pipe.total_frame_number))
+        results.append(fu.permute_grids(latents, pipe.grid, fu.inverse_permutation(indices)))
+    assert torch.allclose(results[0], results[1], atol=1e-5)
@@ -0,0 +1,122 @@
+'''
+CPU tests of the samplers and the LoRA fusing on tiny random-weight UNet and ControlNet models
+'''
+import pytest
+import torch
+from diffusers import ControlNetModel, DDIMScheduler, UNet2DConditionModel
+
+import utils.feature_utils as fu
+from utils.lora import fuse_lora
+from utils.samplers import get_scheduler, permute_solver_state, samplers
+
+grid = [2, 2]
+num_inference_steps = 4
+
+
+def tiny_models():
+    torch.manual_seed(0)
+    blocks = dict(block_out_channels=(32, 64), layers_per_block=1, in_channels=4, cross_attention_dim=32, attention_head_dim=8,
+                  down_block_types=('CrossAttnDownBlock2D', 'DownBlock2D'))
+    unet = UNet2DConditionModel(sample_size=16, out_channels=4, up_block_types=('UpBlock2D', 'CrossAttnUpBlock2D'), **blocks).eval()
+    controlnet = ControlNetModel(conditioning_embedding_out_channels=(16, 32), **blocks).eval()
+    return unet, controlnet
+
+
+def scheduler_config():
+    return DDIMScheduler(beta_start=0.00085, beta_end=0.012, beta_schedule='scaled_linear', clip_sample=False, set_alpha_to_one=False).config
+
+
+@pytest.mark.parametrize('sampler', samplers)
+@torch.no_grad()
+def test_sampling_with_grid_shuffle(sampler):
+    # a few ControlNet + UNet steps on two 2x2 grids, shuffling the grids (and the solver state) before every step
+    unet, controlnet = tiny_models()
+    scheduler = get_scheduler(sampler, scheduler_config())
+    scheduler.set_timesteps(num_inference_steps)
+    latents = torch.randn(2, 4, 16, 16)
+    control_image = torch.rand(2, 3, 32, 32)
+    embeds = torch.randn(2, 77, 32)
+    for t in scheduler.timesteps:
+        rand_i = torch.randperm(2 * grid[0] * grid[1]).tolist()
+        latents = fu.permute_grids(latents, grid, rand_i)
+        control_image = fu.permute_grids(control_image, grid, rand_i)
+        permute_solver_state(scheduler, grid, rand_i)
+        down_block_res_samples, mid_block_res_sample = controlnet(latents, t, encoder_hidden_states=embeds, controlnet_cond=control_image, return_dict=False)
+        noise_pred = unet(latents, t, encoder_hidden_states=embeds, down_block_additional_residuals=down_block_res_samples,
+                          mid_block_additional_residual=mid_block_res_sample).sample
+        latents = scheduler.step(noise_pred, t, latents)['prev_sample']
+    assert latents.shape == (2, 4, 16, 16)
+    assert torch.isfinite(latents).all()
+
+
+@pytest.mark.parametrize('sampler', [sampler for sampler in samplers if sampler != 'lcm'])
+@torch.no_grad()
+def test_grid_shuffle_commutes_with_solver(sampler):
+    # with a per-frame model, shuffling the grids between steps and restoring the frame order at the end gives the
+    # unshuffled result, which holds for the multistep solvers only if their state is permuted with the grids
+    # (lcm is left out, it draws fresh noise for the whole batch on every step)
+    def model(latents, t):
+        return torch.sin(latents) * (t / 1000)
+
+    torch.manual_seed(0)
+    start = torch.randn(2, 4, 16, 16)
+    results = []
+    for shuffle in [False, True]:
+        scheduler = get_scheduler(sampler, scheduler_config(), solver_order=3)
+        scheduler.set_timesteps(num_inference_steps)
+        latents, order = start, list(range(2 * grid[0] * grid[1]))
+        for t in scheduler.timesteps:
+            if shuffle:
+                rand_i = torch.randperm(len(order)).tolist()
+                latents = fu.permute_grids(latents, grid, rand_i)
+                permute_solver_state(scheduler, grid, rand_i)
+                order = [order[i] for i in rand_i]
+            latents = scheduler.step(model(latents, t), t, latents)['prev_sample']
+        results.append(fu.permute_grids(latents, grid, fu.inverse_permutation(order)))
+    assert torch.equal(results[0], results[1])
+
+
+@torch.no_grad()
+def test_lora_unfuse_restores_weights():
+    # weights on a 2**-10 grid and LoRA factors on a 2**-4 grid keep every fused value exactly representable in
+    # float32, so unfusing has to give back the original weights bit for bit
+    unet, _ = tiny_models()
+    for param in unet.parameters():
+        param.copy_(torch.round(param * 2**10) / 2**10)
+    original = {name: param.clone() for name, param in unet.state_dict().items()}
+
+    def factors(*shape):
+        return torch.randint(-2, 3, shape).float() / 2**4
+
+    state_dict = {
+        # kohya format with alpha, on a conv and a linear layer
+        'lora_unet_conv_in.lora_down.weight': factors(4, 4, 3, 3),
+        'lora_unet_conv_in.lora_up.weight': factors(32, 4, 1, 1),
+        'lora_unet_conv_in.alpha': torch.tensor(2.0),
+        'lora_unet_down_blocks_0_attentions_0_transformer_blocks_0_attn1_to_q.lora_down.weight': factors(4, 32),
+        'lora_unet_down_blocks_0_attentions_0_transformer_blocks_0_attn1_to_q.lora_up.weight': factors(32, 4),
+        # peft format
+        'unet.up_blocks.1.attentions.0.transformer_blocks.0.attn2.to_out.0.lora_A.weight': factors(4, 32),
+        'unet.up_blocks.1.attentions.0.transformer_blocks.0.attn2.to_out.0.lora_B.weight': factors(32, 4),
+        # diffusers LoRA layer format
+        'unet.down_blocks.0.attentions.0.transformer_blocks.0.attn2.to_v.lora.down.weight': factors(4, 32),
+        'unet.down_blocks.0.attentions.0.transformer_blocks.0.attn2.to_v.lora.up.weight': factors(32, 4),
+        # diffusers attention-processor format
+        'unet.mid_block.attentions.0.transformer_blocks.0.attn2.processor.to_k_lora.down.weight': factors(4, 32),
+        'unet.mid_block.attentions.0.transformer_blocks.0.attn2.processor.to_k_lora.up.weight': factors(64, 4),
+        # text encoder layers are skipped
+        'lora_te_text_model_encoder_layers_0_self_attn_q_proj.lora_down.weight': factors(4, 32),
+        'lora_te_text_model_encoder_layers_0_self_attn_q_proj.lora_up.weight': factors(32, 4),
+    }
+
+    assert fuse_lora(unet, state_dict, 0.5) == 5
+    fused = unet.state_dict()
+    changed = [name for name in original if not torch.equal(original[name], fused[name])]
+    assert sorted(changed) == sorted(['conv_in.weight',
+                                      'down_blocks.0.attentions.0.transformer_blocks.0.attn1.to_q.weight',
+                                      'down_blocks.0.attentions.0.transformer_blocks.0.attn2.to_v.weight',
+                                      'up_blocks.1.attentions.0.transformer_blocks.0.attn2.to_out.0.weight',
+                                      'mid_block.attentions.0.transformer_blocks.0.attn2.to_k.weight'])
+
+    assert fuse_lora(unet, state_dict, -0.5) == 5
+    assert all(torch.equal(original[name], param) for name, param in unet.state_dict().items())
@@ -0,0 +1,97 @@
+import torch
+
+
+def _proc_status(field):
+    # kB value of a field of /proc/self/status (VmRSS, VmHWM)
+    with open('/proc/self/status', 'r') as f:
+        for line in f:
+            if line.startswith(field + ':'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def _reset_cpu_peak():
+    # writing 5 to clear_refs resets the peak RSS (VmHWM) of the process on Linux
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def available_memory(device):
+    '''
+    Bytes the next allocations can use: free accelerator memory plus what the caching allocator holds unused, or the
+    available system memory on CPU
+    '''
+    device = torch.device(device)
+    if device.type == 'cuda':
+        free, _ = torch.cuda.mem_get_info(device)
+        return free + torch.cuda.memory_reserved(device) - torch.cuda.memory_allocated(device)
+    with open('/proc/meminfo', 'r') as f:
+        for line in f:
+            if line.startswith('MemAvailable:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def peak_memory(fn, device):
+    '''
+    Returns the peak memory fn() allocates on top of what is allocated before the call, accelerator memory for cuda
+    devices and the process RSS otherwise
+    '''
+    device = torch.device(device)
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        base = torch.cuda.memory_allocated(device)
+        fn()
+        torch.cuda.synchronize(device)
+        return torch.cuda.max_memory_allocated(device) - base
+    _reset_cpu_peak()
+    base = _proc_status('VmRSS')
+    fn()
+    return max(_proc_status('VmHWM') - base, 0)
+
+
+class BatchTuner:
+    '''
+    Picks batch sizes from a memory budget.
+    Every stage is probed at batch size 1 and 2 after an unmeasured warm-up call (which moves offloaded weights and
+    fills the allocator); the difference of the two peaks is the cost of one more batch item and the rest a fixed
+    cost, the largest batch whose estimate stays within safety * budget is chosen.
+    memory_budget is the number of bytes a stage may allocate, None uses the memory available at probe time.
+    choices records every stage for config.yaml.
+    '''
+
+    def __init__(self, device, memory_budget=None, safety=0.9):
+        self.device = device
+        self.memory_budget = memory_budget
+        self.safety = safety
+        self.choices = {}
+
+    @torch.no_grad()
+    def tune(self, name, fn, max_batch_size):
+        '''
+        fn(batch_size) runs the stage once, returns the largest safe batch size up to max_batch_size, 0 when a single item
+        does not fit (or runs out of memory while probing)
+        '''
+        try:
+            fn(1)
+            peak_1 = peak_memory(lambda: fn(1), self.device)
+            peak_2 = peak_memory(lambda: fn(2), self.device) if max_batch_size > 1 else 2 * peak_1
+        except (torch.cuda.OutOfMemoryError, MemoryError):
+            self.choices[name] = {'batch_size': 0, 'out_of_memory': True}
+            if torch.device(self.device).type == 'cuda':
+                torch.cuda.empty_cache()
+            return 0
+        per_item = max(peak_2 - peak_1, 1)
+        fixed = max(peak_1 - per_item, 0)
+
+        budget = available_memory(self.device) if self.memory_budget is None else self.memory_budget
+        batch_size = int(min(max((self.safety * budget - fixed) // per_item, 0), max_batch_size))
+        self.choices[name] = {'batch_size': batch_size, 'peak_mb_1': round(peak_1 / 1024**2, 1),
+                              'peak_mb_2': round(peak_2 / 1024**2, 1), 'budget_mb': round(budget / 1024**2, 1)}
+        if torch.device(self.device).type == 'cuda':
+            torch.cuda.empty_cache()
+        return batch_size
@@ -0,0 +1,49 @@
+class CFGPolicy:
+    '''
+    Classifier-free guidance schedule of the sampling loop.
+    For every step it picks the guidance scale and the guidance branches ('uncond', 'cond') the UNet and ControlNet run:
+    guidance 0 only needs the unconditional prediction and guidance 1 only the conditional one, so those steps run on a
+    batch of half the size. Outside [interval_start, interval_end] (fractions of the sampling steps) guidance is turned
+    off, i.e. the step runs the conditional branch alone.
+    uncond_batch_size > 0 runs the unconditional branch of two-branch steps in separate passes of at most that many
+    grids, which lowers the peak memory of those steps.
+    Every step is logged in telemetry.
+    '''
+
+    def __init__(self, interval_start=0.0, interval_end=1.0, uncond_batch_size=0):
+        self.interval_start = interval_start
+        self.interval_end = interval_end
+        self.uncond_batch_size = uncond_batch_size
+        self.branches = ('uncond', 'cond')
+        self.telemetry = []
+
+    @classmethod
+    def from_config(cls, interval, uncond_batch_size):
+        # interval is a comma separated 'start,end' string (lists in the config are grid searched)
+        interval_start, interval_end = [float(fraction) for fraction in str(interval).split(',')]
+        return cls(interval_start, interval_end, uncond_batch_size)
+
+    def reset(self):
+        self.branches = ('uncond', 'cond')
+        self.telemetry = []
+
+    def begin_step(self, step, sampling_percent, guidance_scale):
+        '''
+        Returns the guidance scale of the step and sets the branches it runs
+        '''
+        if guidance_scale != 0.0 and not self.interval_start <= sampling_percent <= self.interval_end:
+            guidance_scale = 1.0
+        if guidance_scale == 0.0:
+            self.branches = ('uncond',)
+        elif guidance_scale == 1.0:
+            self.branches = ('cond',)
+        else:
+            self.branches = ('uncond', 'cond')
+        self.telemetry.append({'step': step, 'sampling_percent': sampling_percent, 'guidance_scale': guidance_scale,
+                               'branches': ','.join(self.branches), 'unet_batch': 0, 'unet_passes': 0})
+        return guidance_scale
+
+    def log_pass(self, batch_size):
+        if len(self.telemetry) > 0:
+            self.telemetry[-1]['unet_batch'] += batch_size
+            self.telemetry[-1]['unet_passes'] += 1
@@ -28,6 +28,8 @@ PREPROCESSOR_DICT = {
     'depth_midas': 'lllyasviel/control_v11f1p_sd15_depth',
     'depth_zoe': 'lllyasviel/control_v11f1p_sd15_depth',
     'openpose': 'lllyasviel/control_v11p_sd15_openpose',
+    'dw_openpose': 'lllyasviel/control_v11p_sd15_openpose',
+    'dw_openpose_video': 'lllyasviel/control_v11p_sd15_openpose',
 }
 
 MODEL_IDS = {
@@ -0,0 +1,65 @@
+import os
+import hashlib
+from functools import lru_cache
+
+import numpy as np
+
+
+@lru_cache(maxsize=None)
+def _file_hash(path, size, mtime):
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+def video_hash(path):
+    '''
+    Content hash of the video file, memoised per (path, size, mtime) so a sweep hashes each video once
+    '''
+    stat = os.stat(path)
+    return _file_hash(os.path.realpath(path), stat.st_size, stat.st_mtime)
+
+
+class ControlCache:
+    '''
+    Content-addressed store of per-source-frame control maps.
+    A map lives at {root}/{video hash}/{preprocessor}/{W}x{H}/{frame index}.npy, so it is shared by every grid_size,
+    pad and preprocessor combination that samples the same frame of the same video at the same resolution.
+    '''
+
+    def __init__(self, root, video_path):
+        self.root = root
+        self.video_hash = video_hash(video_path)
+
+    def frame_path(self, preprocess_name, frame_idx, resolution):
+        width, height = resolution
+        return os.path.join(self.root, self.video_hash, preprocess_name, f'{width}x{height}', f'{str(frame_idx).zfill(5)}.npy')
+
+    def save(self, path, control_map):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.save(f, control_map)
+        os.replace(tmp_path, path)
+
+    def load_or_compute(self, preprocess_name, frames, frame_indices, compute):
+        '''
+        frames: N x H x W x C uint8 source frames, frame_indices: their index in the source video
+        compute: maps a stack of frames to a stack of control maps, only called for the frames missing from the cache
+        Returns the N control maps in the order of frames.
+        '''
+        resolution = (frames.shape[2], frames.shape[1])
+        paths = [self.frame_path(preprocess_name, frame_idx, resolution) for frame_idx in frame_indices]
+        missing = [i for i, path in enumerate(paths) if not os.path.exists(path)]
+
+        control_maps = [None] * len(paths)
+        if len(missing) > 0:
+            computed = compute(frames[missing])
+            for i, control_map in zip(missing, computed):
+                self.save(paths[i], control_map)
+                control_maps[i] = control_map
+        for i, path in enumerate(paths):
+            if control_maps[i] is None:
+                control_maps[i] = np.load(path)
+        return np.stack(control_maps, axis=0)
@@ -0,0 +1,111 @@
+import torch
+
+import utils.feature_utils as fu
+
+
+class GridStepCache:
+    '''
+    Per-grid tensors computed on some sampling steps and reused on the others.
+    Tensors are kept for every grid of the run and every classifier-free guidance branch ('uncond', 'cond') computed on
+    the last recomputing step, so they are permuted with permute_grids when the grids are shuffled. The chunks of a
+    branch are stored and loaded in the order batch_denoise runs them.
+    Subclasses decide in needs_recompute whether a step recomputes, a step that needs a branch the cache does not hold
+    always recomputes.
+    '''
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.calls = 0
+        self.saved_calls = 0
+        self.reset()
+
+    def reset(self):
+        self.tensors = {}
+        self.reference = None
+        self.last_step = None
+        self.recompute = True
+        self.offsets = {}
+        self.pending = {}
+
+    def needs_recompute(self, step, latents):
+        return True
+
+    def begin_step(self, step, latents, branches=('uncond', 'cond')):
+        '''
+        Decides whether this step recomputes the cached tensors, latents are the (shuffled) grid latents of the step and
+        branches the guidance branches it runs
+        '''
+        self.offsets = {branch: 0 for branch in branches}
+        self.pending = {branch: [] for branch in branches}
+        self.recompute = not self.enabled or any(branch not in self.tensors for branch in branches) or self.needs_recompute(step, latents)
+        if self.recompute:
+            self.step = step
+            self.step_latents = latents
+
+    def end_step(self):
+        if not self.recompute or not any(len(chunks) > 0 for chunks in self.pending.values()):
+            return
+        self.tensors = {branch: [torch.cat(level, dim=0) for level in zip(*chunks)] for branch, chunks in self.pending.items() if len(chunks) > 0}
+        self.reference = self.step_latents.float()
+        self.last_step = self.step
+        self.pending = {}
+
+    def permute(self, grid, indices):
+        self.tensors = {branch: [fu.permute_grids(tensor, grid, indices) for tensor in tensors] for branch, tensors in self.tensors.items()}
+        if self.reference is not None:
+            self.reference = fu.permute_grids(self.reference, grid, indices)
+
+    def store_tensors(self, tensors, branches):
+        '''
+        tensors: (len(branches) * batch_size) x C x H x W tensors computed for the next batch_size grids, one batch group
+        per branch
+        '''
+        self.calls += 1
+        if self.enabled:
+            groups = zip(*[tensor.chunk(len(branches), dim=0) for tensor in tensors])
+            for branch, group in zip(branches, groups):
+                self.pending[branch].append(list(group))
+
+    def load_tensors(self, batch_size, branches):
+        '''
+        Returns the cached tensors of the next batch_size grids for branches, batch groups in the order of branches
+        '''
+        self.saved_calls += 1
+        levels = []
+        for branch in branches:
+            offset = self.offsets[branch]
+            levels.append([tensor[offset:offset + batch_size] for tensor in self.tensors[branch]])
+            self.offsets[branch] = offset + batch_size
+        return [torch.cat(level, dim=0) for level in zip(*levels)]
+
+
+class ControlNetResidualCache(GridStepCache):
+    '''
+    Reuses the ControlNet down/mid residuals of the grids across sampling steps.
+    policy 'interval' recomputes them every interval steps, 'drift' once the relative change of the grid latents since
+    the last recomputation exceeds threshold, and 'none' on every step.
+    '''
+    policies = ('none', 'interval', 'drift')
+
+    def __init__(self, policy='none', interval=2, threshold=0.05):
+        assert policy in self.policies, f'unknown controlnet cache policy {policy}'
+        super().__init__(enabled=policy != 'none')
+        self.policy = policy
+        self.interval = interval
+        self.threshold = threshold
+
+    def needs_recompute(self, step, latents):
+        if self.policy == 'interval':
+            return step - self.last_step >= self.interval
+        drift = (latents.float() - self.reference).norm() / self.reference.norm()
+        return drift.item() > self.threshold
+
+    def store(self, down_block_res_samples, mid_block_res_sample, branches):
+        self.store_tensors(list(down_block_res_samples) + [mid_block_res_sample], branches)
+
+    def load(self, batch_size, branches):
+        '''
+        Returns the cached down and mid residuals of the next batch_size grids
+        '''
+        residuals = self.load_tensors(batch_size, branches)
+        return residuals[:-1], residuals[-1]
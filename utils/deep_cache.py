@@ -0,0 +1,80 @@
+import torch
+
+from utils.controlnet_cache import GridStepCache
+
+
+class DeepCache(GridStepCache):
+    '''
+    DeepCache for the UNet of the denoising loop.
+    Every interval steps the UNet runs in full and the input of its last up block (the output of the deep path) is
+    cached per grid; on the steps in between only conv_in, the first down block and the last up block run on top of the
+    cached features. interval 1 runs the full UNet on every step.
+    '''
+
+    def __init__(self, interval=1):
+        super().__init__(enabled=interval > 1)
+        self.interval = interval
+
+    def needs_recompute(self, step, latents):
+        return step - self.last_step >= self.interval
+
+    def unet_forward(self, unet, sample, timestep, encoder_hidden_states, down_block_additional_residuals=None, mid_block_additional_residual=None, branches=('uncond', 'cond')):
+        '''
+        UNet2DConditionModel.forward (diffusers 0.18, no class or added embeddings) with the deep path cached,
+        sample holds one batch group of the next grids per guidance branch in branches
+        '''
+        batch_size = sample.shape[0] // len(branches)
+        forward_upsample_size = any(s % 2**unet.num_upsamplers != 0 for s in sample.shape[-2:])
+        upsample_size = None
+
+        timesteps = timestep if torch.is_tensor(timestep) else torch.tensor([timestep], device=sample.device)
+        if len(timesteps.shape) == 0:
+            timesteps = timesteps[None].to(sample.device)
+        timesteps = timesteps.expand(sample.shape[0])
+        t_emb = unet.time_proj(timesteps).to(dtype=sample.dtype)
+        emb = unet.time_embedding(t_emb)
+        if unet.time_embed_act is not None:
+            emb = unet.time_embed_act(emb)
+
+        def run_block(block, hidden_states, **kwargs):
+            if hasattr(block, "has_cross_attention") and block.has_cross_attention:
+                return block(hidden_states=hidden_states, temb=emb, encoder_hidden_states=encoder_hidden_states, **kwargs)
+            return block(hidden_states=hidden_states, temb=emb, **kwargs)
+
+        sample = unet.conv_in(sample)
+
+        # the shallow path only needs the skip connections of the first down block
+        down_block_res_samples = (sample,)
+        for downsample_block in (unet.down_blocks if self.recompute else unet.down_blocks[:1]):
+            sample, res_samples = run_block(downsample_block, sample)
+            down_block_res_samples += res_samples
+
+        if down_block_additional_residuals is not None:
+            down_block_res_samples = tuple(
+                down_block_res_sample + down_block_additional_residual
+                for down_block_res_sample, down_block_additional_residual in zip(down_block_res_samples, down_block_additional_residuals)
+            )
+
+        if self.recompute:
+            if unet.mid_block is not None:
+                sample = unet.mid_block(sample, emb, encoder_hidden_states=encoder_hidden_states)
+            if mid_block_additional_residual is not None:
+                sample = sample + mid_block_additional_residual
+
+            for upsample_block in unet.up_blocks[:-1]:
+                res_samples = down_block_res_samples[-len(upsample_block.resnets):]
+                down_block_res_samples = down_block_res_samples[:-len(upsample_block.resnets)]
+                if forward_upsample_size:
+                    upsample_size = down_block_res_samples[-1].shape[2:]
+                sample = run_block(upsample_block, sample, res_hidden_states_tuple=res_samples, upsample_size=upsample_size)
+            self.store_tensors([sample], branches)
+        else:
+            sample = self.load_tensors(batch_size, branches)[0]
+            down_block_res_samples = down_block_res_samples[:len(unet.up_blocks[-1].resnets)]
+
+        sample = run_block(unet.up_blocks[-1], sample, res_hidden_states_tuple=down_block_res_samples, upsample_size=None)
+
+        if unet.conv_norm_out:
+            sample = unet.conv_norm_out(sample)
+            sample = unet.conv_act(sample)
+        return unet.conv_out(sample)
@@ -36,6 +36,42 @@ def prepare_key_grid_latents(latents_video, latent_grid_size=[2,2], key_grid_siz
     keyframe_grid = unflatten_grid(torch.cat([long_flatten[:,:,:,ind*(img_w):(ind+1)*(img_w)] for ind in rand_indices], dim=-1), key_grid_size)
     return keyframe_grid, rand_indices
 
+
+def grid_to_frames(x, grid_size=[2,2]):
+    '''
+    x: B x C x H x W grids -> (B * hs * ws) x C x (H // hs) x (W // ws) frames, in row-major order inside each grid
+    '''
+    B, C, H, W = x.size()
+    hs, ws = grid_size
+    frames = x.reshape(B, C, hs, H // hs, ws, W // ws).permute(0, 2, 4, 1, 3, 5)
+    return frames.reshape(B * hs * ws, C, H // hs, W // ws)
+
+def frames_to_grid(x, grid_size=[2,2]):
+    '''
+    x: N x C x h x w frames -> (N // (hs * ws)) x C x (h * hs) x (w * ws) grids, inverse of grid_to_frames
+    '''
+    N, C, h, w = x.size()
+    hs, ws = grid_size
+    grids = x.reshape(N // (hs * ws), hs, ws, C, h, w).permute(0, 3, 1, 4, 2, 5)
+    return grids.reshape(N // (hs * ws), C, hs * h, ws * w)
+
+def permute_grids(x, grid_size=[2,2], indices=None):
+    '''
+    Regroups the frames of the B x C x H x W grids x so that the k-th frame slot (over all grids) holds frame indices[k],
+    same result as prepare_key_grid_latents over consecutive slices of indices with a single index_select
+    '''
+    indices = torch.as_tensor(indices, device=x.device)
+    return frames_to_grid(grid_to_frames(x, grid_size).index_select(0, indices), grid_size)
+
+def inverse_permutation(indices):
+    '''
+    Returns inv such that inv[indices[k]] = k, i.e. the positions restoring the original frame order
+    '''
+    indices = indices if torch.is_tensor(indices) else torch.tensor([int(i) for i in indices])
+    inverse = torch.empty_like(indices)
+    inverse[indices] = torch.arange(indices.numel(), device=indices.device)
+    return inverse
+
     
 def pil_grid_to_frames(pil_grid, grid_size=[2,2]):
     w,h = pil_grid.size
@@ -0,0 +1,114 @@
+import os
+import json
+import hashlib
+
+import numpy as np
+import torch
+
+from utils.control_cache import video_hash
+
+
+class LatentStore:
+    '''
+    Memory-mapped per-frame latent store for one video and one set of inversion parameters.
+    Every kind of latent ('vae', 'inverted', 'trajectory') is a raw float32 memmap under {root}/{key}/{kind}.bin
+    with one row per source frame; manifest.json records the row of each frame index and which rows are complete,
+    and is rewritten after every write so an interrupted run resumes from the frames already stored.
+    key hashes the video content together with params, so any change of model, prompt or step count gets a fresh store.
+    '''
+    kinds = ('vae', 'inverted', 'trajectory')
+
+    def __init__(self, root, video_path, params):
+        self.params = dict(params, video=video_hash(video_path))
+        key = hashlib.sha1(json.dumps(self.params, sort_keys=True, default=str).encode()).hexdigest()[:16]
+        self.path = os.path.join(root, key)
+        os.makedirs(self.path, exist_ok=True)
+
+        self.manifest_path = os.path.join(self.path, 'manifest.json')
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, 'r') as f:
+                self.manifest = json.load(f)
+        else:
+            self.manifest = {'params': self.params, 'frame_shape': None, 'trajectory_steps': None, 'rows': {}, 'done': {kind: [] for kind in self.kinds}}
+
+    def _row_shape(self, kind):
+        if kind == 'trajectory':
+            return [self.manifest['trajectory_steps']] + self.manifest['frame_shape']
+        return self.manifest['frame_shape']
+
+    def _memmap(self, kind, min_rows):
+        row_shape = self._row_shape(kind)
+        row_bytes = int(np.prod(row_shape)) * np.dtype(np.float32).itemsize
+        file_path = os.path.join(self.path, f'{kind}.bin')
+        rows = os.path.getsize(file_path) // row_bytes if os.path.exists(file_path) else 0
+        if rows < min_rows:
+            # grow the file in place, rows already written are kept
+            with open(file_path, 'ab') as f:
+                f.truncate(min_rows * row_bytes)
+            rows = min_rows
+        return np.memmap(file_path, dtype=np.float32, mode='r+', shape=tuple([rows] + row_shape))
+
+    def _save_manifest(self):
+        tmp_path = f'{self.manifest_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.manifest, f)
+        os.replace(tmp_path, self.manifest_path)
+
+    def missing(self, kind, frame_indices):
+        '''
+        Returns the positions in frame_indices whose latents of the given kind are not stored yet
+        '''
+        done = set(self.manifest['done'][kind])
+        return [i for i, frame_idx in enumerate(frame_indices) if frame_idx not in done]
+
+    def write(self, kind, frame_indices, latents):
+        '''
+        latents: N x C x h x w tensor ('trajectory': N x T x C x h x w) for the N source frames in frame_indices
+        '''
+        latents = latents.detach().float().cpu().numpy()
+        frame_shape = list(latents.shape[2:]) if kind == 'trajectory' else list(latents.shape[1:])
+        if self.manifest['frame_shape'] is None:
+            self.manifest['frame_shape'] = frame_shape
+        assert self.manifest['frame_shape'] == frame_shape, 'frame latent shape does not match the store'
+        if kind == 'trajectory':
+            if self.manifest['trajectory_steps'] is None:
+                self.manifest['trajectory_steps'] = latents.shape[1]
+            assert self.manifest['trajectory_steps'] == latents.shape[1]
+
+        rows = self.manifest['rows']
+        for frame_idx in frame_indices:
+            if str(frame_idx) not in rows:
+                rows[str(frame_idx)] = len(rows)
+        row_ids = [rows[str(frame_idx)] for frame_idx in frame_indices]
+
+        memmap = self._memmap(kind, max(row_ids) + 1)
+        memmap[row_ids] = latents
+        memmap.flush()
+        del memmap
+
+        done = set(self.manifest['done'][kind])
+        self.manifest['done'][kind] = sorted(done.union(int(frame_idx) for frame_idx in frame_indices))
+        self._save_manifest()
+
+    def read(self, kind, frame_indices):
+        '''
+        Returns the stored latents of the given kind for frame_indices as a float32 tensor
+        '''
+        assert len(self.missing(kind, frame_indices)) == 0, f'{kind} latents missing from the store'
+        row_ids = [self.manifest['rows'][str(frame_idx)] for frame_idx in frame_indices]
+        memmap = self._memmap(kind, max(row_ids) + 1)
+        latents = torch.from_numpy(np.array(memmap[row_ids]))
+        del memmap
+        return latents
+
+
+def interpolate_trajectory(trajectory, levels, level):
+    '''
+    trajectory: N x T x C x h x w latents at the ascending noise levels (timesteps) levels, returns the N latents at level,
+    linearly interpolated between the two neighbouring levels and clamped to the noisiest one
+    '''
+    upper = next((i for i, trajectory_level in enumerate(levels) if trajectory_level >= level), len(levels) - 1)
+    if upper == 0 or levels[upper] <= level:
+        return trajectory[:, upper]
+    weight = (level - levels[upper - 1]) / (levels[upper] - levels[upper - 1])
+    return torch.lerp(trajectory[:, upper - 1], trajectory[:, upper], weight)
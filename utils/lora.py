@@ -0,0 +1,78 @@
+import os
+
+import torch
+import torch.nn as nn
+import safetensors.torch
+from huggingface_hub import hf_hub_download
+
+# (down, up) key suffixes of the kohya, peft, diffusers LoRA layer and diffusers attention-processor
+# (processor.to_k_lora.down.weight) LoRA formats, the first matching suffix is used
+lora_key_suffixes = (
+    ('.lora_down.weight', '.lora_up.weight'),
+    ('.lora_A.weight', '.lora_B.weight'),
+    ('.lora.down.weight', '.lora.up.weight'),
+    ('.down.weight', '.up.weight'),
+)
+
+
+def load_lora_state_dict(lora_path, weight_name='pytorch_lora_weights.safetensors'):
+    '''
+    lora_path is a .safetensors / .bin file or a hub repo id holding weight_name
+    '''
+    if not os.path.isfile(lora_path):
+        lora_path = hf_hub_download(lora_path, weight_name)
+    if os.path.splitext(lora_path)[-1] == '.safetensors':
+        return safetensors.torch.load_file(lora_path, device='cpu')
+    return torch.load(lora_path, map_location='cpu')
+
+
+def _module_names(unet):
+    # kohya keys flatten the module path with underscores, the other formats keep it under a 'unet.' prefix
+    modules = {}
+    for name, module in unet.named_modules():
+        if isinstance(module, (nn.Linear, nn.Conv2d)):
+            modules[name] = module
+            modules['lora_unet_' + name.replace('.', '_')] = module
+    return modules
+
+
+def _module_name(layer_key):
+    layer_key = layer_key[len('unet.'):] if layer_key.startswith('unet.') else layer_key
+    layer_key = layer_key.replace('.processor.', '.')
+    if layer_key.endswith('_lora'):
+        layer_key = layer_key[:-len('_lora')]
+        if layer_key.endswith('to_out'):
+            layer_key += '.0'
+    return layer_key
+
+
+@torch.no_grad()
+def fuse_lora(unet, state_dict, scale=1.0):
+    '''
+    Adds scale * up @ down (times alpha / rank when the LoRA has alphas) to the weights of the UNet's linear and conv
+    layers. The attention processors are left alone, so the IP-adapter processors keep running on the LoRA'd
+    projections; fusing with -scale removes the LoRA again. Returns the number of fused layers.
+    '''
+    modules = _module_names(unet)
+    fused = 0
+    for key in state_dict:
+        for down_suffix, up_suffix in lora_key_suffixes:
+            if not key.endswith(down_suffix):
+                continue
+            layer_key = key[:-len(down_suffix)]
+            module = modules.get(layer_key, modules.get(_module_name(layer_key)))
+            if module is None:
+                # text encoder layers of the LoRA
+                break
+            down = state_dict[key].float()
+            up = state_dict[layer_key + up_suffix].float()
+            alpha = state_dict.get(layer_key + '.alpha')
+            factor = scale * (float(alpha) / down.shape[0] if alpha is not None else 1.0)
+
+            weight = module.weight
+            delta = (up.flatten(1) @ down.flatten(1)).reshape(weight.shape)
+            weight.data += (factor * delta).to(device=weight.device, dtype=weight.dtype)
+            fused += 1
+            break
+    assert fused > 0, 'no layer of the LoRA matches the unet'
+    return fused
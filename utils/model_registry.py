@@ -0,0 +1,94 @@
+import types
+from collections import OrderedDict
+from itertools import chain
+
+import torch
+
+
+def module_nbytes(obj, depth=2):
+    '''
+    Returns the number of bytes held by the parameters and buffers of every torch module reachable from obj.
+    obj can be a module, a detector wrapping modules (e.g. LineartDetector.model) or an annotator package keeping
+    its network in a global (e.g. annotator.hed.netNetwork).
+    '''
+    if isinstance(obj, torch.nn.Module):
+        return sum(t.numel() * t.element_size() for t in chain(obj.parameters(), obj.buffers()))
+    if depth == 0 or not hasattr(obj, '__dict__'):
+        return 0
+    skip = (type, types.ModuleType, types.FunctionType, types.BuiltinFunctionType)
+    return sum(module_nbytes(v, depth - 1) for v in vars(obj).values() if not isinstance(v, skip))
+
+
+class ModelRegistry:
+    '''
+    Process-wide store of loaded annotator models.
+    Entries are keyed by preprocessor name and the options used to build them, kept in LRU order and evicted
+    (through their unload hook) once the measured footprint exceeds memory_budget bytes. A budget of None keeps everything.
+    '''
+
+    def __init__(self, memory_budget=None):
+        self.memory_budget = memory_budget
+        self._entries = OrderedDict()
+
+    @staticmethod
+    def make_key(name, **options):
+        return (name, tuple(sorted(options.items())))
+
+    def set_memory_budget(self, memory_budget):
+        self.memory_budget = memory_budget
+        self._enforce_budget()
+
+    def get(self, name, factory, unload=None, **options):
+        '''
+        Returns the cached model for (name, options), building it with factory() on a miss.
+        factory should return the model with its weights loaded, as the budget is enforced on the measured footprint.
+        unload is called on eviction; it defaults to the model's own unload_model method.
+        '''
+        key = self.make_key(name, **options)
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            # the model may have loaded more weights since it was last measured (e.g. an optional network on first use)
+            self._enforce_budget()
+            return self._entries[key][0]
+
+        model = factory()
+        if unload is None:
+            unload = getattr(model, 'unload_model', None)
+        self._entries[key] = (model, unload)
+        self._enforce_budget()
+        return model
+
+    def peek(self, name, **options):
+        # the cached model for (name, options) or None, without building it or touching the LRU order
+        entry = self._entries.get(self.make_key(name, **options))
+        return None if entry is None else entry[0]
+
+    def nbytes(self):
+        return sum(module_nbytes(model) for model, _ in self._entries.values())
+
+    def evict(self, key):
+        model, unload = self._entries.pop(key)
+        if unload is not None:
+            unload()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def clear(self):
+        for key in list(self._entries.keys()):
+            self.evict(key)
+
+    def _enforce_budget(self):
+        if self.memory_budget is None:
+            return
+        # the most recently used entry is never evicted, it is the one about to run
+        while len(self._entries) > 1 and self.nbytes() > self.memory_budget:
+            self.evict(next(iter(self._entries)))
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+
+model_registry = ModelRegistry()
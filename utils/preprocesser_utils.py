@@ -2,16 +2,18 @@ import cv2
 import yaml
 
 import numpy as np
+import annotator.hed as hed_annotator
+import annotator.pidinet as pidinet_annotator
+import annotator.leres as leres_annotator
+import annotator.midas as midas_annotator
 from annotator.lineart import LineartDetector
 from annotator.zoe import ZoeDetector
 from annotator.manga_line import MangaLineExtration
 from annotator.lineart_anime import LineartAnimeDetector
 from annotator.openpose import OpenposeDetector
-from annotator.hed import apply_hed
 from annotator.canny import apply_canny
-from annotator.pidinet import apply_pidinet
-from annotator.leres import apply_leres
-from annotator.midas import apply_midas
+from annotator.annotator_path import BATCH_CHUNK_SIZE
+from utils.model_registry import model_registry
 
 
 def yaml_load(path):
@@ -71,6 +73,44 @@ def resize_image_with_pad(input_image, resolution, skip_hwc3=False):
     return safer_memory(img_padded), remove_pad
 
 
+def resize_images_with_pad(input_images, resolution, skip_hwc3=False):
+    '''
+    Batched resize_image_with_pad for N x H x W x C frames of the same size, remove_pad works on N x H x W (x C) outputs
+    '''
+    resized = [resize_image_with_pad(img, resolution, skip_hwc3) for img in input_images]
+    remove_pad_frame = resized[0][1]
+
+    def remove_pad(x):
+        return np.stack([remove_pad_frame(frame) for frame in x], axis=0)
+
+    return np.stack([img for img, _ in resized], axis=0), remove_pad
+
+
+
+module_annotators = {
+    'hed': (hed_annotator, hed_annotator.load_hed_model, hed_annotator.unload_hed_model),
+    'pidinet': (pidinet_annotator, pidinet_annotator.load_pid_model, pidinet_annotator.unload_pid_model),
+    'leres': (leres_annotator, leres_annotator.load_leres_model, leres_annotator.unload_leres_model),
+    'midas': (midas_annotator, midas_annotator.load_midas_model, midas_annotator.unload_midas_model),
+}
+
+def get_annotator(name):
+    '''
+    Returns the annotator package (keeping its network in a module global) through the model registry, eviction
+    drops that global so the network is freed and reloaded by the next get_annotator
+    '''
+    module, load, unload = module_annotators[name]
+
+    def factory():
+        load()
+        return module
+    return model_registry.get(name, factory, unload=unload)
+
+def loaded(model, load='load_model', *args):
+    # registry factories return their models with the weights loaded, the registry measures an entry when it inserts it
+    getattr(model, load)(*args)
+    return model
+
 
 def lineart_standard(img, res=512, **kwargs):
     img, remove_pad = resize_image_with_pad(img, res)
@@ -85,7 +125,7 @@ def lineart_standard(img, res=512, **kwargs):
 
 def lineart(img, res=512, **kwargs):
     img, remove_pad = resize_image_with_pad(img, res)    
-    model_lineart = LineartDetector('sk_model.pth')
+    model_lineart = model_registry.get('lineart', lambda: loaded(LineartDetector('sk_model.pth'), 'load_model', 'sk_model.pth'), model_name='sk_model.pth')
 
     # applied auto inversion
     result = 255 - model_lineart(img)
@@ -94,7 +134,7 @@ def lineart(img, res=512, **kwargs):
 
 def lineart_coarse(img, res=512, **kwargs):
     img, remove_pad = resize_image_with_pad(img, res)
-    model_lineart_coarse = LineartDetector('sk_model2.pth')
+    model_lineart_coarse = model_registry.get('lineart', lambda: loaded(LineartDetector('sk_model2.pth'), 'load_model', 'sk_model2.pth'), model_name='sk_model2.pth')
 
     # applied auto inversion
     result = 255 - model_lineart_coarse(img)
@@ -102,7 +142,7 @@ def lineart_coarse(img, res=512, **kwargs):
 
 def lineart_anime(img, res=512, **kwargs):
     img, remove_pad = resize_image_with_pad(img, res)
-    model_lineart_anime = LineartAnimeDetector()
+    model_lineart_anime = model_registry.get('lineart_anime', lambda: loaded(LineartAnimeDetector()))
 
     # applied auto inversion
     result = 255 - model_lineart_anime(img)
@@ -111,7 +151,7 @@ def lineart_anime(img, res=512, **kwargs):
 
 def lineart_anime_denoise(img, res=512, **kwargs):
     img, remove_pad = resize_image_with_pad(img, res)
-    model_manga_line = MangaLineExtration()
+    model_manga_line = model_registry.get('manga_line', lambda: loaded(MangaLineExtration()))
 
     # applied auto inversion
     result = model_manga_line(img)
@@ -129,54 +169,54 @@ def canny(img, res=512, thr_a=100, thr_b=200, **kwargs):
 
 def hed(img, res=512, **kwargs):
     img, remove_pad = resize_image_with_pad(img, res)
-    model_hed = apply_hed
+    model_hed = get_annotator('hed').apply_hed
     result = model_hed(img)
     return remove_pad(result), True
 
 
 def hed_safe(img, res=512, **kwargs):
     img, remove_pad = resize_image_with_pad(img, res)
-    model_hed = apply_hed
+    model_hed = get_annotator('hed').apply_hed
     result = model_hed(img, is_safe=True)
     return remove_pad(result), True
 
 def midas(img, res=512, a=np.pi * 2.0, **kwargs):
     img, remove_pad = resize_image_with_pad(img, res)
-    model_midas = apply_midas
+    model_midas = get_annotator('midas').apply_midas
     result, _ = model_midas(img, a)
     return remove_pad(result), True
 
 
 def leres(img, res=512, thr_a=0, thr_b=0, boost=False, **kwargs):
     img, remove_pad = resize_image_with_pad(img, res)
-    model_leres = apply_leres
+    model_leres = get_annotator('leres').apply_leres
     result = model_leres(img, thr_a, thr_b, boost=boost)
     return remove_pad(result), True
 
 def lerespp(img, res=512, thr_a=0, thr_b=0, boost=True, **kwargs):
     img, remove_pad = resize_image_with_pad(img, res)
-    model_leres = apply_leres
+    model_leres = get_annotator('leres').apply_leres
     result = model_leres(img, thr_a, thr_b, boost=boost)
     return remove_pad(result), True
 
 
 def pidinet(img, res=512, **kwargs):
     img, remove_pad = resize_image_with_pad(img, res)
-    model_pidinet = apply_pidinet
+    model_pidinet = get_annotator('pidinet').apply_pidinet
     result = model_pidinet(img)
     return remove_pad(result), True
 
 
 def pidinet_ts(img, res=512, **kwargs):
     img, remove_pad = resize_image_with_pad(img, res)
-    model_pidinet = apply_pidinet
+    model_pidinet = get_annotator('pidinet').apply_pidinet
     result = model_pidinet(img, apply_fliter=True)
     return remove_pad(result), True
 
 
 def pidinet_safe(img, res=512, **kwargs):
     img, remove_pad = resize_image_with_pad(img, res)
-    model_pidinet = apply_pidinet
+    model_pidinet = get_annotator('pidinet').apply_pidinet
     result = model_pidinet(img, is_safe=True)
     return remove_pad(result), True
 
@@ -184,14 +224,20 @@ def pidinet_safe(img, res=512, **kwargs):
 
 def zoe_depth(img, res=512, **kwargs):
     img, remove_pad = resize_image_with_pad(img, res)
-    model_zoe_depth = ZoeDetector()
+    model_zoe_depth = model_registry.get('zoe', lambda: loaded(ZoeDetector()))
     result = model_zoe_depth(img)
     return remove_pad(result), True
 
-def openpose(img, res=512, **kwargs):
+def openpose(img, res=512, peaks_on_device=False, **kwargs):
     img, remove_pad = resize_image_with_pad(img, res)
-    model_zoe_depth = OpenposeDetector()
-    result = model_zoe_depth(img)
+    model_openpose = model_registry.get('openpose', lambda: loaded(OpenposeDetector(peaks_on_device)), peaks_on_device=peaks_on_device)
+    result = model_openpose(img)
+    return remove_pad(result), True
+
+def dw_openpose(img, res=512, **kwargs):
+    img, remove_pad = resize_image_with_pad(img, res)
+    model_openpose = model_registry.get('openpose', lambda: loaded(OpenposeDetector(), 'load_dw_model'))
+    result = model_openpose(img, use_dw_pose=True)
     return remove_pad(result), True
 
 preprocessors_dict = {
@@ -210,13 +256,135 @@ preprocessors_dict = {
     'depth_midas': midas,
     'depth_zoe': zoe_depth,
     'openpose': openpose,
+    'dw_openpose': dw_openpose,
+    'dw_openpose_video': dw_openpose,
 }
 
-def pixel_perfect_process(input_image, p_name):
+def lineart_batch(imgs, res=512, chunk_size=BATCH_CHUNK_SIZE, **kwargs):
+    imgs, remove_pad = resize_images_with_pad(imgs, res)
+    model_lineart = model_registry.get('lineart', lambda: loaded(LineartDetector('sk_model.pth'), 'load_model', 'sk_model.pth'), model_name='sk_model.pth')
+    result = 255 - model_lineart.batch(imgs, chunk_size)
+    return remove_pad(result), True
+
+
+def lineart_coarse_batch(imgs, res=512, chunk_size=BATCH_CHUNK_SIZE, **kwargs):
+    imgs, remove_pad = resize_images_with_pad(imgs, res)
+    model_lineart_coarse = model_registry.get('lineart', lambda: loaded(LineartDetector('sk_model2.pth'), 'load_model', 'sk_model2.pth'), model_name='sk_model2.pth')
+    result = 255 - model_lineart_coarse.batch(imgs, chunk_size)
+    return remove_pad(result), True
+
+
+def lineart_anime_batch(imgs, res=512, chunk_size=BATCH_CHUNK_SIZE, **kwargs):
+    imgs, remove_pad = resize_images_with_pad(imgs, res)
+    model_lineart_anime = model_registry.get('lineart_anime', lambda: loaded(LineartAnimeDetector()))
+    result = 255 - model_lineart_anime.batch(imgs, chunk_size)
+    return remove_pad(result), True
+
+
+def lineart_anime_denoise_batch(imgs, res=512, chunk_size=BATCH_CHUNK_SIZE, **kwargs):
+    imgs, remove_pad = resize_images_with_pad(imgs, res)
+    model_manga_line = model_registry.get('manga_line', lambda: loaded(MangaLineExtration()))
+    result = model_manga_line.batch(imgs, chunk_size)
+    return remove_pad(result), True
+
+
+def hed_batch(imgs, res=512, chunk_size=BATCH_CHUNK_SIZE, **kwargs):
+    imgs, remove_pad = resize_images_with_pad(imgs, res)
+    result = get_annotator('hed').apply_hed_batch(imgs, chunk_size=chunk_size)
+    return remove_pad(result), True
+
+
+def hed_safe_batch(imgs, res=512, chunk_size=BATCH_CHUNK_SIZE, **kwargs):
+    imgs, remove_pad = resize_images_with_pad(imgs, res)
+    result = get_annotator('hed').apply_hed_batch(imgs, is_safe=True, chunk_size=chunk_size)
+    return remove_pad(result), True
+
+
+def midas_batch(imgs, res=512, a=np.pi * 2.0, chunk_size=BATCH_CHUNK_SIZE, **kwargs):
+    imgs, remove_pad = resize_images_with_pad(imgs, res)
+    result, _ = get_annotator('midas').apply_midas_batch(imgs, a, chunk_size=chunk_size)
+    return remove_pad(result), True
+
+
+def pidinet_batch(imgs, res=512, chunk_size=BATCH_CHUNK_SIZE, **kwargs):
+    imgs, remove_pad = resize_images_with_pad(imgs, res)
+    result = get_annotator('pidinet').apply_pidinet_batch(imgs, chunk_size=chunk_size)
+    return remove_pad(result), True
+
+
+def pidinet_safe_batch(imgs, res=512, chunk_size=BATCH_CHUNK_SIZE, **kwargs):
+    imgs, remove_pad = resize_images_with_pad(imgs, res)
+    result = get_annotator('pidinet').apply_pidinet_batch(imgs, is_safe=True, chunk_size=chunk_size)
+    return remove_pad(result), True
+
+
+def zoe_depth_batch(imgs, res=512, chunk_size=BATCH_CHUNK_SIZE, **kwargs):
+    imgs, remove_pad = resize_images_with_pad(imgs, res)
+    model_zoe_depth = model_registry.get('zoe', lambda: loaded(ZoeDetector()))
+    result = model_zoe_depth.batch(imgs, chunk_size)
+    return remove_pad(result), True
+
+def dw_openpose_batch(imgs, res=512, chunk_size=BATCH_CHUNK_SIZE, **kwargs):
+    imgs, remove_pad = resize_images_with_pad(imgs, res)
+    model_openpose = model_registry.get('openpose', lambda: loaded(OpenposeDetector(), 'load_dw_model'))
+    result = model_openpose.batch(imgs, chunk_size=chunk_size)
+    return remove_pad(result), True
+
+def dw_openpose_video_batch(imgs, res=512, chunk_size=BATCH_CHUNK_SIZE, **kwargs):
+    # the frames arrive in video order, most of them are tracked from the previous one instead of detected
+    imgs, remove_pad = resize_images_with_pad(imgs, res)
+    model_openpose = model_registry.get('openpose', lambda: loaded(OpenposeDetector(), 'load_dw_model'))
+    result = model_openpose.batch(imgs, chunk_size=chunk_size, video=True)
+    return remove_pad(result), True
+
+def pose_tracking_stats():
+    '''
+    Returns the detected / tracked frame counts of the last dw_openpose_video run and clears them, None when no
+    frames were annotated in that mode since the last call (e.g. the controls came from the control cache)
+    '''
+    model_openpose = model_registry.peek('openpose')
+    if model_openpose is None:
+        return None
+    stats, model_openpose.tracking_stats = model_openpose.tracking_stats, None
+    return stats
+
+# preprocessors whose networks run several frames per forward pass, the others fall back to a per-frame loop
+batch_preprocessors_dict = {
+    'lineart_realistic': lineart_batch,
+    'lineart_coarse': lineart_coarse_batch,
+    'lineart_anime': lineart_anime_batch,
+    'lineart_anime_denoise': lineart_anime_denoise_batch,
+    'softedge_hed': hed_batch,
+    'softedge_hedsafe': hed_safe_batch,
+    'softedge_pidinet': pidinet_batch,
+    'softedge_pidsafe': pidinet_safe_batch,
+    'depth_midas': midas_batch,
+    'depth_zoe': zoe_depth_batch,
+    'dw_openpose': dw_openpose_batch,
+    'dw_openpose_video': dw_openpose_video_batch,
+}
+
+def control_cache_name(p_name, **options):
+    # name the control maps of p_name are cached under, preprocessor options that change the maps get their own entry
+    if p_name == 'openpose' and options.get('peaks_on_device', False):
+        return p_name + '_peaks_on_device'
+    return p_name
+
+def pixel_perfect_process(input_image, p_name, chunk_size=BATCH_CHUNK_SIZE, **options):
+    '''
+    input_image: H x W x C frame, or N x H x W x C frames of the same size which are annotated chunk_size frames per forward pass
+    options are passed on to the preprocessor, which ignores those it does not use (e.g. peaks_on_device for 'openpose')
+    '''
     if len(input_image.shape) == 3:
         raw_H, raw_W, _ = input_image.shape
     if len(input_image.shape) == 4:
         _, raw_H, raw_W, _ = input_image.shape
     preprocessor_resolution = raw_H
-    detected_map, _ = preprocessors_dict[p_name](input_image, res=preprocessor_resolution)
+    if len(input_image.shape) == 4:
+        if p_name in batch_preprocessors_dict:
+            detected_map, _ = batch_preprocessors_dict[p_name](input_image, res=preprocessor_resolution, chunk_size=chunk_size, **options)
+        else:
+            detected_map = np.stack([preprocessors_dict[p_name](frame, res=preprocessor_resolution, **options)[0] for frame in input_image], axis=0)
+        return detected_map
+    detected_map, _ = preprocessors_dict[p_name](input_image, res=preprocessor_resolution, **options)
     return detected_map
@@ -0,0 +1,98 @@
+import numpy as np
+import torch
+from diffusers import DDIMScheduler, DPMSolverMultistepScheduler, DPMSolverMultistepInverseScheduler, UniPCMultistepScheduler
+from diffusers.schedulers.scheduling_ddim import DDIMSchedulerOutput
+from diffusers.utils import randn_tensor
+
+import utils.feature_utils as fu
+
+samplers = ('ddim', 'dpmsolver++', 'unipc', 'lcm')
+
+
+class LCMScheduler(DDIMScheduler):
+    '''
+    Multistep latent consistency sampler on the DDIM noise schedule, for UNets distilled with a consistency (LCM) LoRA,
+    diffusers 0.18 has no LCMScheduler.
+    Timesteps are taken from the original_inference_steps skipping schedule the LoRA was distilled on; every step
+    predicts the denoised latents with the consistency boundary condition and noises them again to the next timestep.
+    '''
+    original_inference_steps = 50
+    sigma_data = 0.5
+    timestep_scaling = 10.0
+
+    def set_timesteps(self, num_inference_steps, device=None):
+        self.num_inference_steps = num_inference_steps
+        step_ratio = self.config.num_train_timesteps // self.original_inference_steps
+        origin_timesteps = np.arange(1, self.original_inference_steps + 1) * step_ratio - 1
+        skipping_step = len(origin_timesteps) // num_inference_steps
+        timesteps = origin_timesteps[::-1][::skipping_step][:num_inference_steps].copy()
+        self.timesteps = torch.from_numpy(timesteps).to(device)
+
+    def step(self, model_output, timestep, sample, generator=None, return_dict=True, **kwargs):
+        step_index = (self.timesteps == timestep).nonzero().item()
+        prev_timestep = self.timesteps[step_index + 1] if step_index + 1 < len(self.timesteps) else None
+        alpha_prod_t = self.alphas_cumprod[timestep]
+        alpha_prod_t_prev = self.alphas_cumprod[prev_timestep] if prev_timestep is not None else self.final_alpha_cumprod
+
+        scaled_timestep = float(timestep) * self.timestep_scaling
+        c_skip = self.sigma_data ** 2 / (scaled_timestep ** 2 + self.sigma_data ** 2)
+        c_out = scaled_timestep / (scaled_timestep ** 2 + self.sigma_data ** 2) ** 0.5
+        pred_original_sample = (sample - (1 - alpha_prod_t) ** 0.5 * model_output) / alpha_prod_t ** 0.5
+        denoised = c_out * pred_original_sample + c_skip * sample
+
+        if prev_timestep is None:
+            prev_sample = denoised
+        else:
+            noise = randn_tensor(model_output.shape, generator=generator, device=model_output.device, dtype=model_output.dtype)
+            prev_sample = alpha_prod_t_prev ** 0.5 * denoised + (1 - alpha_prod_t_prev) ** 0.5 * noise
+
+        if not return_dict:
+            return (prev_sample, denoised)
+        return DDIMSchedulerOutput(prev_sample=prev_sample, pred_original_sample=denoised)
+
+
+def get_scheduler(sampler, scheduler_config, solver_order=2):
+    '''
+    Sampling scheduler of the given sampler, built from the scheduler config of the base model
+    '''
+    assert sampler in samplers, f'unknown sampler {sampler}'
+    if sampler == 'dpmsolver++':
+        return DPMSolverMultistepScheduler.from_config(scheduler_config, algorithm_type='dpmsolver++', solver_order=solver_order)
+    if sampler == 'unipc':
+        return UniPCMultistepScheduler.from_config(scheduler_config, solver_order=solver_order)
+    if sampler == 'lcm':
+        return LCMScheduler.from_config(scheduler_config)
+    return DDIMScheduler.from_config(scheduler_config)
+
+
+def get_inverse_scheduler(sampler, scheduler_config, solver_order=2):
+    '''
+    Inversion scheduler matching the sampler, None for 'ddim' and 'lcm' which are inverted by the pipelines' ddim_step
+    (onto the LCM timesteps for 'lcm').
+    The multistep inverse DPM-Solver++ is used for 'unipc' too: diffusers has no inverse UniPC and both are
+    data-prediction multistep solvers on the same timestep spacing that reduce to DDIM at order 1.
+    '''
+    assert sampler in samplers, f'unknown sampler {sampler}'
+    if sampler in ('ddim', 'lcm'):
+        return None
+    return DPMSolverMultistepInverseScheduler.from_config(scheduler_config, algorithm_type='dpmsolver++', solver_order=solver_order)
+
+
+def permute_solver_state(scheduler, grid, indices):
+    '''
+    Permutes the per-sample state of a multistep solver (previous model outputs, UniPC's last sample) together with the
+    grids it belongs to, DDIM keeps no state
+    '''
+    if getattr(scheduler, 'model_outputs', None) is not None:
+        scheduler.model_outputs = [None if output is None else fu.permute_grids(output, grid, indices) for output in scheduler.model_outputs]
+    if torch.is_tensor(getattr(scheduler, 'last_sample', None)):
+        scheduler.last_sample = fu.permute_grids(scheduler.last_sample, grid, indices)
+
+
+def inversion_key(sampler, solver_order=2):
+    # identifies the inversion run for a sampler, part of the latent store key
+    if sampler == 'ddim':
+        return None
+    if sampler == 'lcm':
+        return 'lcm'
+    return ('dpmsolver++', solver_order)
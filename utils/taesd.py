@@ -0,0 +1,66 @@
+import os
+import re
+
+import torch
+import torch.nn as nn
+import safetensors.torch
+from huggingface_hub import hf_hub_download
+
+
+def conv(n_in, n_out, **kwargs):
+    return nn.Conv2d(n_in, n_out, 3, padding=1, **kwargs)
+
+
+class Clamp(nn.Module):
+    def forward(self, x):
+        return torch.tanh(x / 3) * 3
+
+
+class Block(nn.Module):
+    def __init__(self, n_in, n_out):
+        super().__init__()
+        self.conv = nn.Sequential(conv(n_in, n_out), nn.ReLU(), conv(n_out, n_out), nn.ReLU(), conv(n_out, n_out))
+        self.skip = nn.Conv2d(n_in, n_out, 1, bias=False) if n_in != n_out else nn.Identity()
+        self.fuse = nn.ReLU()
+
+    def forward(self, x):
+        return self.fuse(self.conv(x) + self.skip(x))
+
+
+class TinyDecoder(nn.Sequential):
+    '''
+    TAESD decoder (madebyollin/taesd): an approximate SD VAE decoder of plain conv blocks, taking the scaled SD latents
+    and returning images in [0, 1]. Used for previews and sampling snapshots, the full VAE stays for the final output.
+    '''
+
+    def __init__(self, latent_channels=4):
+        super().__init__(
+            Clamp(), conv(latent_channels, 64), nn.ReLU(),
+            Block(64, 64), Block(64, 64), Block(64, 64), nn.Upsample(scale_factor=2), conv(64, 64, bias=False),
+            Block(64, 64), Block(64, 64), Block(64, 64), nn.Upsample(scale_factor=2), conv(64, 64, bias=False),
+            Block(64, 64), Block(64, 64), Block(64, 64), nn.Upsample(scale_factor=2), conv(64, 64, bias=False),
+            Block(64, 64), conv(64, 3),
+        )
+
+    def forward(self, latents):
+        return super().forward(latents).clamp(0, 1)
+
+
+def load_tiny_decoder(path, device, dtype):
+    '''
+    path is a taesd_decoder.pth file of the original repository or a file / hub repo id of the diffusers AutoencoderTiny
+    weights, whose decoder.layers.N keys lack the leading Clamp layer
+    '''
+    if not os.path.isfile(path):
+        path = hf_hub_download(path, 'diffusion_pytorch_model.safetensors')
+    if os.path.splitext(path)[-1] == '.safetensors':
+        state_dict = safetensors.torch.load_file(path, device='cpu')
+    else:
+        state_dict = torch.load(path, map_location='cpu')
+    if any(key.startswith('decoder.layers.') for key in state_dict):
+        state_dict = {re.sub(r'^decoder\.layers\.(\d+)', lambda m: str(int(m.group(1)) + 1), key): value
+                      for key, value in state_dict.items() if key.startswith('decoder.layers.')}
+    decoder = TinyDecoder()
+    decoder.load_state_dict(state_dict)
+    return decoder.to(device=device, dtype=dtype).eval()
+
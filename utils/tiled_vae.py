@@ -0,0 +1,64 @@
+import torch
+
+
+class FrameTiledVAE:
+    '''
+    Tiled VAE encode/decode of grid images with tiles following the frame boundaries of the grid.
+    A tile holds tile_frames x tile_frames frames and reaches overlap latents (overlap * 8 pixels) into its neighbours
+    for context; tile outputs are blended with weights ramping up over the overlap, so the seams land on the frame
+    boundaries, where frames of a grid meet anyway. Memory scales with the tile instead of the whole grid.
+    '''
+
+    def __init__(self, vae, grid_size, tile_frames=1, overlap=8):
+        self.vae = vae
+        self.grid_size = grid_size
+        self.tile_frames = tile_frames
+        self.overlap = overlap
+        self.scale = 2 ** (len(vae.config.block_out_channels) - 1)
+
+    def spans(self, size):
+        # (start, end) latent rows or columns of the tiles along an axis of size latents
+        step = size // self.grid_size * self.tile_frames
+        return [(max(start - self.overlap, 0), min(start + step + self.overlap, size)) for start in range(0, size, step)]
+
+    @staticmethod
+    def blend_weight(start, end, size, overlap, device):
+        # 1 inside the tile, ramping down towards the tile edges that lie inside the image
+        x = torch.arange(start, end, device=device, dtype=torch.float32)
+        weight = torch.ones_like(x)
+        if start > 0:
+            weight = torch.minimum(weight, (x - start + 1) / (2 * overlap + 1))
+        if end < size:
+            weight = torch.minimum(weight, (end - x) / (2 * overlap + 1))
+        return weight
+
+    def _run_tiled(self, x, fn, in_scale, out_scale, latent_size):
+        height, width = latent_size
+        out_height, out_width, out_overlap = height * out_scale, width * out_scale, self.overlap * out_scale
+        out, weights = None, None
+        for y0, y1 in self.spans(height):
+            for x0, x1 in self.spans(width):
+                tile = fn(x[..., y0 * in_scale:y1 * in_scale, x0 * in_scale:x1 * in_scale])
+                weight = (self.blend_weight(y0 * out_scale, y1 * out_scale, out_height, out_overlap, tile.device)[:, None] *
+                          self.blend_weight(x0 * out_scale, x1 * out_scale, out_width, out_overlap, tile.device)[None, :])
+                if out is None:
+                    out = torch.zeros(tile.shape[0], tile.shape[1], out_height, out_width, device=tile.device, dtype=torch.float32)
+                    weights = torch.zeros(out_height, out_width, device=tile.device, dtype=torch.float32)
+                out[..., y0 * out_scale:y1 * out_scale, x0 * out_scale:x1 * out_scale] += tile.float() * weight
+                weights[y0 * out_scale:y1 * out_scale, x0 * out_scale:x1 * out_scale] += weight
+        return (out / weights).to(tile.dtype)
+
+    @torch.no_grad()
+    def encode(self, images):
+        '''
+        images: B x 3 x H x W in [-1, 1], returns the posterior mean of the latents
+        '''
+        latent_size = (images.shape[-2] // self.scale, images.shape[-1] // self.scale)
+        return self._run_tiled(images, lambda tile: self.vae.encode(tile).latent_dist.mean, self.scale, 1, latent_size)
+
+    @torch.no_grad()
+    def decode(self, latents):
+        '''
+        latents: B x C x h x w unscaled latents, returns the decoded images in [-1, 1]
+        '''
+        return self._run_tiled(latents, lambda tile: self.vae.decode(tile, return_dict=False)[0], 1, self.scale, latents.shape[-2:])